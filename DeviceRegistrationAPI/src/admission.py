@@ -0,0 +1,417 @@
+"""
+This module sheds the requests the workers can't serve in time (admission control), answering them
+at once with 503 & Retry-After instead of letting them queue until the timeouts of nginx.
+
+The requests in flight are counted per route across the workers, in a file memory-mapped by every
+worker (e.g., in /dev/shm): each worker claims a slot of the file, where it alone writes the
+requests it serves, and reads the sum of the slots. The slot of a dead worker is freed by the next
+worker claiming one, or before a request is refused. A request is refused when, counted in flight, it exceeds a limit:
+* the limit of its route (ROUTE_LIMITS), e.g. for an expensive export
+* MAX_IN_FLIGHT requests of every route
+* MAX_READS requests of the read methods (GET, HEAD), the remainder being kept for the writes
+* the time it waited for a worker since nginx received it (X-Request-Start), above
+  READ_MAX_QUEUE_MS or WRITE_MAX_QUEUE_MS
+A request is also refused, without being counted, when the database can't take it: a pool of
+connections of the worker has more than POOL_MAX_WAITING checkouts waiting for a connection, or
+one timed out less than POOL_TIMEOUT_SECONDS ago (routes of POOL_EXEMPT_ROUTES excepted, which
+check no connection out), or when a check added by the application refuses it (add_check()).
+Health checks (HEALTH_ROUTES, e.g. /api/status) are never refused.
+
+* InFlight --> requests in flight per route of all the workers, in a shared memory-mapped file
+* admit() --> count a request in flight, unless it exceeds a limit
+* add_check() --> refuse the requests of a route on a condition of the application, e.g. an open circuit
+* instrument() --> admit or shed the requests of a Flask application
+* get_in_flight() --> returns the in-flight counters of the current process, created after fork
+* get_admission_stats() --> returns the requests in flight & the requests shed by the worker
+
+@author: MMB
+"""
+import fcntl
+import json
+import mmap
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from werkzeug.exceptions import HTTPException
+from werkzeug.wsgi import ClosingIterator
+
+from src import db_pool
+from src import metrics
+from src import settings
+
+# priority of a request
+HEALTH = "health"
+WRITE = "write"
+READ = "read"
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+# route of the requests which match no rule (e.g., 404)
+UNMATCHED = "unmatched"
+# a slot: pid of its worker, requests in flight, reads in flight, then one counter per route
+SLOT_HEADER = 3
+# seconds between two scans for the slots of dead workers, when a request would be refused
+REAP_INTERVAL = 1
+
+# functions of the application refusing a request, see add_check()
+_checks = []
+
+
+def _alive(pid) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class InFlight:
+    """Requests in flight per route of the workers, in a memory-mapped file"""
+
+    def __init__(self, path, routes, slots=64):
+        """
+        :param str path: file of the counters, shared by the workers (e.g., in /dev/shm)
+        :param list routes: rules of the application, in the same order for every worker
+        :param int slots: maximum number of workers counting their requests
+        """
+        self.path = path
+        self.slots = slots
+        self.routes = {route: index for index, route in enumerate(routes)}
+        self.stride = SLOT_HEADER + len(routes)
+
+        self._lock = threading.Lock()
+        self._shed = 0
+        self._reaped = time.monotonic()
+        size = slots * self.stride * 4
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self._locked():
+            if os.fstat(self._fd).st_size != size:
+                # left by a previous version of the routes or of the settings
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, size)
+            self._mmap = mmap.mmap(self._fd, size)
+            self._counts = memoryview(self._mmap).cast("i")
+            self._base = self._scan(claim=True)[0]
+
+        if self._base is None:
+            print(
+                "[Admission] the {} slots of {} are taken, requests of worker {} are not counted".format(
+                    slots, path, os.getpid()
+                )
+            )
+
+    @contextmanager
+    def _locked(self):
+        """Lock the file, a single worker scans the slots at a time"""
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _scan(self, claim=False) -> (int, int):
+        """
+        Free the slots of dead workers, the file being locked
+        :param bool claim: take a free slot for the worker
+        :return tuple: offset of the slot claimed (None if none is free) & requests freed
+        """
+        pid = os.getpid()
+        claimed = None
+        freed = 0
+        for base in range(0, self.slots * self.stride, self.stride):
+            owner = self._counts[base]
+            if owner == pid and not claim:
+                continue
+            if owner and owner != pid and _alive(owner):
+                continue
+
+            # the requests of a dead worker are no more in flight
+            freed += self._counts[base + 1]
+            for offset in range(base, base + self.stride):
+                self._counts[offset] = 0
+            if claim and claimed is None:
+                claimed = base
+
+        if claimed is not None:
+            self._counts[claimed] = pid
+        return (claimed, freed)
+
+    def reap(self) -> bool:
+        """
+        Free the slots of the workers which died serving requests (e.g., killed by harakiri),
+        at most once per REAP_INTERVAL seconds
+        :return bool: True if requests of dead workers were freed
+        """
+        now = time.monotonic()
+        with self._lock:
+            if now - self._reaped < REAP_INTERVAL:
+                return False
+            self._reaped = now
+
+        with self._locked():
+            return self._scan()[1] > 0
+
+    def _add(self, route, priority, delta):
+        if self._base is None:
+            return
+        with self._lock:
+            self._counts[self._base + 1] += delta
+            if priority == READ:
+                self._counts[self._base + 2] += delta
+            index = self._base + SLOT_HEADER + self.routes.get(route, 0)
+            self._counts[index] += delta
+
+    def enter(self, route, priority):
+        """Count a request of the worker in flight"""
+        self._add(route, priority, 1)
+
+    def leave(self, route, priority):
+        """Count a request of the worker done"""
+        self._add(route, priority, -1)
+
+    def counts(self, route) -> (int, int, int):
+        """
+        Requests in flight over the workers
+        :param str route: rule of a route
+        :return tuple: requests in flight, reads in flight & requests of the route in flight
+        """
+        counts = self._counts
+        return (
+            sum(counts[1 :: self.stride]),
+            sum(counts[2 :: self.stride]),
+            sum(counts[SLOT_HEADER + self.routes.get(route, 0) :: self.stride]),
+        )
+
+    def count_shed(self):
+        with self._lock:
+            self._shed += 1
+
+    def stats(self) -> dict:
+        """Return the requests in flight of every worker per route, & the requests shed by the worker"""
+        counts = self._counts
+        with self._lock:
+            shed = self._shed
+        return {
+            "in_flight": sum(counts[1 :: self.stride]),
+            "reads_in_flight": sum(counts[2 :: self.stride]),
+            "routes": {
+                route: sum(counts[SLOT_HEADER + index :: self.stride])
+                for route, index in self.routes.items()
+            },
+            "slots_in_use": sum(1 for pid in counts[:: self.stride] if pid),
+            "slot": None if self._base is None else self._base // self.stride,
+            "shed": shed,
+        }
+
+
+_in_flight = None
+_in_flight_pid = None
+_in_flight_lock = threading.Lock()
+
+
+def get_in_flight(path, routes, slots=64) -> InFlight:
+    """
+    Return the in-flight counters of the current process, mapped after fork
+    :param str path: file of the counters, shared by the workers
+    :param list routes: rules of the application, in the same order for every worker
+    :param int slots: maximum number of workers counting their requests
+    :return: InFlight, None if the file can't be mapped
+    """
+    global _in_flight, _in_flight_pid
+
+    with _in_flight_lock:
+        if _in_flight_pid != os.getpid():
+            _in_flight_pid = os.getpid()
+            try:
+                _in_flight = InFlight(path, routes, slots)
+            except OSError as err:
+                # requests are admitted without counting them
+                print("[Exception] unable to map the in-flight counters:", err)
+                _in_flight = None
+
+        return _in_flight
+
+
+def get_admission_stats() -> dict:
+    """Return the requests in flight & the requests shed, None if admission control isn't started"""
+    with _in_flight_lock:
+        if _in_flight_pid != os.getpid() or _in_flight is None:
+            return None
+        in_flight = _in_flight
+
+    return in_flight.stats()
+
+
+def request_queued_ms(environ) -> float:
+    """Milliseconds the request waited since nginx received it, None without X-Request-Start"""
+    start = environ.get("HTTP_X_REQUEST_START", "")
+    try:
+        # t=<seconds since the epoch>, ${msec} of nginx
+        return (time.time() - float(start[2:] if start.startswith("t=") else start)) * 1000
+    except ValueError:
+        return None
+
+
+def _exceeded(in_flight, route, priority, conf) -> str:
+    """Name of the limit exceeded by the requests in flight, the request included, or None"""
+    total, reads, on_route = in_flight.counts(route)
+    route_limit = dict(conf.admission_route_limits).get(route)
+    if route_limit and on_route > route_limit:
+        return "route"
+    if conf.admission_max_in_flight and total > conf.admission_max_in_flight:
+        return "in_flight"
+    if priority == READ and conf.admission_max_reads and reads > conf.admission_max_reads:
+        return "reads"
+    return None
+
+
+def _pool_saturated(conf) -> bool:
+    """A pool of connections of the worker has checkouts waiting, or one timed out lately"""
+    for stats in db_pool.get_pool_stats():
+        if conf.admission_pool_max_waiting and stats["waiting"] > conf.admission_pool_max_waiting:
+            return True
+        timeout_age = stats["last_timeout_age"]
+        if timeout_age is not None and timeout_age < conf.admission_pool_timeout_seconds:
+            return True
+    return False
+
+
+def add_check(check):
+    """
+    Refuse a request on a condition of the application, before it is counted in flight
+    :param check: called with (route, priority, settings) of a request, other than a health check,
+    returns the name of the limit exceeded, or None to admit the request
+    """
+    _checks.append(check)
+
+
+def _refused(route, priority, conf) -> str:
+    """Name of the limit refusing the request before it is counted in flight, or None"""
+    if route not in conf.admission_pool_exempt_routes and _pool_saturated(conf):
+        return "pool"
+    for check in _checks:
+        limit = check(route, priority, conf)
+        if limit is not None:
+            return limit
+    return None
+
+
+def get_routes(app) -> list:
+    """Rules of a Flask application counted in flight, in the same order for every worker"""
+    return sorted({rule.rule for rule in app.url_map.iter_rules()} | {UNMATCHED})
+
+
+def admit(routes, route, method, queued_ms, conf) -> (str, callable):
+    """
+    Count a request in flight, unless it exceeds a limit
+    :param list routes: rules of the application, from get_routes()
+    :param str route: rule of the request
+    :param str method: method of the request
+    :param float queued_ms: milliseconds the request waited for a worker, None if unknown
+    :param Settings conf: settings of the process
+    :return tuple: limit exceeded (None if the request is admitted) & function to call once
+    the request is done, admitted or not
+    """
+    if route in conf.admission_health_routes:
+        priority = HEALTH
+    elif method in READ_METHODS:
+        priority = READ
+    else:
+        priority = WRITE
+
+    in_flight = None
+    if priority != HEALTH:
+        in_flight = get_in_flight(conf.admission_path, routes, conf.admission_slots)
+    entered = []
+    released = []
+
+    def release():
+        if not released:
+            released.append(True)
+            if entered:
+                in_flight.leave(route, priority)
+            metrics.observe_in_flight(route, priority, -1)
+
+    metrics.observe_in_flight(route, priority, 1)
+    try:
+        limit = None
+        max_queue_ms = {
+            READ: conf.admission_read_max_queue_ms,
+            WRITE: conf.admission_write_max_queue_ms,
+        }.get(priority)
+        if max_queue_ms and queued_ms is not None and queued_ms > max_queue_ms:
+            # the client has waited long enough, it may have gone already
+            limit = "queue"
+        elif priority != HEALTH:
+            limit = _refused(route, priority, conf)
+
+        if limit is None and in_flight is not None:
+            in_flight.enter(route, priority)
+            entered.append(True)
+            limit = _exceeded(in_flight, route, priority, conf)
+            if limit is not None and in_flight.reap():
+                # the requests of a dead worker were counted in flight
+                limit = _exceeded(in_flight, route, priority, conf)
+
+        if limit is not None:
+            release()
+            if in_flight is not None:
+                in_flight.count_shed()
+            metrics.observe_shed(route, priority, limit)
+    except BaseException:
+        release()
+        raise
+
+    return (limit, release)
+
+
+def instrument(app):
+    """
+    Admit or shed the requests of a Flask application, as set in the [ADMISSION] section of the settings
+    :param Flask app: application to protect
+    """
+    wsgi_app = app.wsgi_app
+    routes = []
+
+    def shed_response(conf):
+        data = {"StatusCode": 503}
+        response = app.response_class(
+            response=json.dumps(data), status=503, mimetype="application/json"
+        )
+        # the client should retry later instead of queuing in uWSGI
+        response.headers["Retry-After"] = conf.admission_retry_after
+        return response
+
+    def admitted_wsgi_app(environ, start_response):
+        conf = settings.get_settings()
+        if not conf.admission_enabled:
+            return wsgi_app(environ, start_response)
+
+        if not routes:
+            # every route is registered once a request is served
+            routes.extend(get_routes(app))
+        try:
+            rule, _ = app.url_map.bind_to_environ(environ).match(return_rule=True)
+            route = rule.rule
+        except HTTPException:
+            route = UNMATCHED
+
+        limit, release = admit(
+            routes, route, environ.get("REQUEST_METHOD"), request_queued_ms(environ), conf
+        )
+        if limit is not None:
+            return shed_response(conf)(environ, start_response)
+
+        try:
+            body = wsgi_app(environ, start_response)
+        except BaseException:
+            release()
+            raise
+
+        # a request is in flight until its body is sent, e.g. a streamed export
+        return ClosingIterator(body, release)
+
+    app.wsgi_app = admitted_wsgi_app
@@ -2,65 +2,266 @@
 This module implements a DataBase abstraction layer to get access to a postgresql.
 There are three functions implemented in this module:
 
-* insert_to_db() --> allows to write data to DB
+* insert_to_db() --> allows to write data to DB through the connection pool of the worker
+* insert_many_to_db() --> allows to write a batch of rows to DB in a single transaction
 * read_from_db() --> allows to read data from DB
+* resolve_device_types() --> ids of device types in the normalized layout, through the map of the worker
 * init_db() --> Initializes a database with a given name and table
-* create_table --> creates a given table in the given database
+* create_table --> creates a given table in the given database, optionally partitioned by date_added
+  and with its device types normalized in the device_types table
+* create_partitions() --> creates the partitions of a partitioned table ahead of time
+* detach_old_partitions() --> detaches (or drops) the partitions older than the retention
+* reconcile_counts() --> rebuilds the device type rollups from the devices table
+* get_pool_stats() --> returns statistics of the connection pools of the worker
+* DatabaseUnavailableError --> raised by the writes which failed while the DB is unavailable
+
+A write failing while the DB is unavailable (connection refused or lost, statement cancelled, no
+connection of the pool in time) may succeed later, e.g. from the spool: it raises
+DatabaseUnavailableError. A write of invalid data (e.g., a device type too long) never will: it
+returns False.
+
+Calls through the pool are timed in src.metrics, per phase: connect (checkout), execute & fetch.
 
 @author: MMB
 """
 
-import configparser
+import datetime
+import re
+import threading
+import time
+from contextlib import contextmanager
+
 import psycopg2
-from psycopg2 import sql, DatabaseError
+from psycopg2 import extras, sql, DatabaseError, InterfaceError, OperationalError
+from psycopg2.extensions import make_dsn
+from src import db_pool
+from src import metrics
+from src import settings
+
+# rollups of the number of rows per device_type (all-time and per hour of date_added),
+# maintained by triggers on the devices table
+COUNTS_TABLE = "device_type_counts"
+HOURLY_COUNTS_TABLE = "device_type_hourly_counts"
+
+# channel of the NOTIFY sent by the triggers with the device types written by a transaction,
+# e.g. for the shared snapshot of counts of StatisticsAPI
+COUNTS_CHANNEL = "device_type_counts"
+
+# layouts of the devices table: the name of the device type in every row (inline), or the id of
+# the name in the device_types lookup table (normalized); the rollups are keyed by name in both
+DEVICE_TYPE_LAYOUTS = ("inline", "normalized")
+DEVICE_TYPES_TABLE = "device_types"
+# above this size, the map of device type ids of the worker is emptied and filled again
+DEVICE_TYPE_IDS_MAX_SIZE = 100000
+
+# partitions of a partitioned devices table span a day, a week (from Monday) or a month in UTC
+PARTITION_INTERVALS = ("day", "week", "month")
+# DDL on partitions locks the devices table, writers should not queue behind it for long
+PARTITION_LOCK_TIMEOUT = "5s"
+
+# errors of a DB which is unavailable, or of a worker which can't reach it in time
+TRANSIENT_ERRORS = (OperationalError, InterfaceError, db_pool.PoolTimeoutError)
+
+
+class DatabaseUnavailableError(Exception):
+    """The DB could not be written, the write may succeed later."""
+
+
+def _get_pool(db_user, db_password, db_host, db_port) -> db_pool.ConnectionPool:
+    """Return the connection pool of the current worker for the given DB instance"""
+    conf = settings.get_settings()
+
+    # the DSN of the configured instance is prebuilt by the settings
+    if (db_user, db_password, db_host, db_port) == (
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    ):
+        dsn = conf.db_dsn
+    else:
+        dsn = make_dsn(
+            conf.db_dsn, user=db_user, password=db_password, host=db_host, port=db_port
+        )
+
+    return db_pool.get_pool(
+        dsn,
+        min_size=conf.db_pool_min_size,
+        max_size=conf.db_pool_max_size,
+        max_lifetime=conf.db_pool_max_lifetime,
+        health_check_interval=conf.db_pool_health_check_interval,
+        checkout_timeout=conf.db_pool_checkout_timeout,
+    )
+
+
+@contextmanager
+def _connection(operation, db_user, db_password, db_host, db_port):
+    """Check a connection out of the pool of the worker, timing the checkout"""
+    start = time.perf_counter()
+    pool = _get_pool(db_user, db_password, db_host, db_port)
+    with pool.connection() as db_connect:
+        metrics.DB_LATENCY.labels(operation, "connect").observe(
+            time.perf_counter() - start
+        )
+        yield db_connect
 
 
 def insert_to_db(
     insert_query, insert_data, db_user, db_password, db_host, db_port
 ) -> bool:
     """
-    Inserting to database
+    Inserting to database through the connection pool of the worker
     :param str insert_query: query used to insert to DB
     :param dict insert_data: data to be inserted to DB
     :param str db_user: username to get access to DB
     :param str db_password: password to get access to DB
-    :return: bool
+    :return: bool, False if the data can't be written
+    :raise DatabaseUnavailableError: when the DB is unavailable
     """
     try:
-        # Create an instance of ConfigParser
-        config = configparser.ConfigParser()
+        with _connection("insert", db_user, db_password, db_host, db_port) as db_connect:
+            with metrics.time_db("insert", "execute"):
+                with db_connect.cursor() as cursor:
+                    cursor.execute(insert_query, insert_data)
+                db_connect.commit()
 
-        # Read the configuration file & database section
-        config.read("config/params.ini")
-        conf_db = config["DATABASE"]
+        return True
 
-        db_connect = psycopg2.connect(
-            database=conf_db.get("NAME"),
-            user=db_user,
-            password=db_password,
-            host=db_host,
-            port=db_port,
-        )
-        cursor = db_connect.cursor()
-        cursor.execute(insert_query, insert_data)
-        db_connect.commit()
-        db_connect.close()
+    except TRANSIENT_ERRORS as err:
+        print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("insert").inc()
+        raise DatabaseUnavailableError(str(err).strip() or type(err).__name__) from err
+
+    except DatabaseError as err:
+        print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("insert").inc()
+        return False
+
+    except Exception as err:
+        print("[Exception]", err)
+        metrics.DB_ERRORS.labels("insert").inc()
+        return False
+
+
+def insert_many_to_db(
+    insert_query, rows, db_user, db_password, db_host, db_port, page_size=1000
+) -> bool:
+    """
+    Inserting many rows to database in a single transaction, through multi-row INSERT statements
+    :param str insert_query: query used to insert to DB, with a single %s placeholder for VALUES
+    :param list rows: tuples of data to be inserted to DB
+    :param str db_user: username to get access to DB
+    :param str db_password: password to get access to DB
+    :param int page_size: maximum number of rows sent in one INSERT statement
+    :return: bool, False if the rows can't be written
+    :raise DatabaseUnavailableError: when the DB is unavailable
+    """
+    try:
+        with _connection(
+            "insert_many", db_user, db_password, db_host, db_port
+        ) as db_connect:
+            with metrics.time_db("insert_many", "execute"):
+                with db_connect.cursor() as cursor:
+                    extras.execute_values(
+                        cursor, insert_query, rows, page_size=page_size
+                    )
+                db_connect.commit()
 
         return True
 
+    except TRANSIENT_ERRORS as err:
+        print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("insert_many").inc()
+        raise DatabaseUnavailableError(str(err).strip() or type(err).__name__) from err
+
     except DatabaseError as err:
-        cursor.close()
-        db_connect.close()
         print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("insert_many").inc()
         return False
 
     except Exception as err:
-        cursor.close()
-        db_connect.close()
         print("[Exception]", err)
+        metrics.DB_ERRORS.labels("insert_many").inc()
         return False
 
 
+# map of device type name --> id in device_types, filled by the worker as it meets new names;
+# ids are never reused, thus an entry stays valid as long as the database
+_device_type_ids = {}
+_device_type_ids_lock = threading.Lock()
+
+
+def resolve_device_types(names, db_user, db_password, db_host, db_port) -> dict:
+    """
+    Ids of device types in the device_types table (normalized layout), creating the missing ones.
+    Names already met by the worker are resolved from its map, without any query to the DB.
+    :param list names: names of device types
+    :param str db_user: username to get access to DB
+    :param str db_password: password to get access to DB
+    :return dict: name --> id, None if the ids could not be resolved
+    :raise DatabaseUnavailableError: when the DB is unavailable
+    """
+    with _device_type_ids_lock:
+        ids = {name: _device_type_ids.get(name) for name in names}
+    missing = sorted(name for name, type_id in ids.items() if type_id is None)
+    if not missing:
+        return ids
+
+    # new names are inserted & all names read in one round trip; a name inserted meanwhile by
+    # another session is not seen by the snapshot of the statement, it is read by a second one
+    resolve_query = sql.SQL(
+        "WITH created AS (INSERT INTO {types} (name) SELECT unnest(%(names)s::varchar[]) ON CONFLICT (name) DO NOTHING RETURNING id, name) SELECT id, name FROM created UNION ALL SELECT id, name FROM {types} WHERE name = ANY(%(names)s::varchar[]);"
+    ).format(types=sql.Identifier(DEVICE_TYPES_TABLE))
+
+    try:
+        with _connection(
+            "resolve_device_types", db_user, db_password, db_host, db_port
+        ) as db_connect:
+            with metrics.time_db("resolve_device_types", "execute"):
+                with db_connect.cursor() as cursor:
+                    for _ in range(2):
+                        cursor.execute(resolve_query, {"names": missing})
+                        for type_id, name in cursor.fetchall():
+                            ids[name] = type_id
+                        missing = [name for name in missing if ids[name] is None]
+                        if not missing:
+                            break
+                db_connect.commit()
+
+    except TRANSIENT_ERRORS as err:
+        print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("resolve_device_types").inc()
+        raise DatabaseUnavailableError(str(err).strip() or type(err).__name__) from err
+
+    except DatabaseError as err:
+        print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("resolve_device_types").inc()
+        return None
+
+    except Exception as err:
+        print("[Exception]", err)
+        metrics.DB_ERRORS.labels("resolve_device_types").inc()
+        return None
+
+    if missing:
+        return None
+
+    with _device_type_ids_lock:
+        if len(_device_type_ids) + len(ids) > DEVICE_TYPE_IDS_MAX_SIZE:
+            _device_type_ids.clear()
+        _device_type_ids.update(ids)
+
+    return ids
+
+
+def get_pool_stats() -> list:
+    """
+    Statistics of the connection pools of the current worker
+    :return list: one dict per pool
+    """
+    return db_pool.get_pool_stats()
+
+
 def init_db(db_name, db_user, db_password, db_host, db_port) -> bool:
     """
     Initializes a given database if doesn't exists.
@@ -112,20 +313,254 @@ def init_db(db_name, db_user, db_password, db_host, db_port) -> bool:
         return False
 
 
-def create_table(db_name, table_name, db_user, db_password, db_host, db_port) -> bool:
+# hour of a row in UTC, date_added may be a timestamptz or (tables created before) a date
+HOUR_OF_ROW = "date_trunc('hour', date_added::timestamptz AT TIME ZONE 'UTC')"
+
+
+def _is_normalized(cursor, table_name) -> bool:
+    """The given table exists with the normalized layout, i.e. its rows reference device_types"""
+    cursor.execute(
+        "SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'device_type_id' AND NOT attisdropped);",
+        (table_name,),
+    )
+    return cursor.fetchone()[0]
+
+
+def _named_rows(relation, normalized):
+    """
+    FROM item of the rows of a devices table (or of a transition table of its triggers),
+    with the name of their device type in the device_type column whatever the layout
+    :param sql.Composable relation: table of the rows
+    :param bool normalized: the rows reference device_types
     """
-    Create a given table in the given database if doesn't exists
+    if not normalized:
+        return sql.SQL("{} AS d").format(relation)
+
+    return sql.SQL(
+        "(SELECT t.name AS device_type, r.date_added FROM {} r JOIN {} t ON t.id = r.device_type_id) AS d"
+    ).format(relation, sql.Identifier(DEVICE_TYPES_TABLE))
+
+
+def _rebuild_totals_query(table_name, normalized=False):
+    """Query rebuilding the device_type_counts rollup from the given table"""
+    return sql.SQL(
+        """
+        DELETE FROM {counts};
+        INSERT INTO {counts} (device_type, shard, count)
+            SELECT device_type, 0, count(*) FROM {rows} GROUP BY device_type;
+        """
+    ).format(
+        rows=_named_rows(sql.Identifier(table_name), normalized),
+        counts=sql.Identifier(COUNTS_TABLE),
+    )
+
+
+def _rebuild_hourly_query(table_name, normalized=False):
+    """Query rebuilding the device_type_hourly_counts rollup from the given table"""
+    return sql.SQL(
+        """
+        DELETE FROM {hourly};
+        INSERT INTO {hourly} (device_type, bucket, shard, count)
+            SELECT device_type, {hour}, 0, count(*) FROM {rows} GROUP BY 1, 2;
+        """
+    ).format(
+        rows=_named_rows(sql.Identifier(table_name), normalized),
+        hourly=sql.Identifier(HOURLY_COUNTS_TABLE),
+        hour=sql.SQL(HOUR_OF_ROW),
+    )
+
+
+def _rebuild_counts_query(table_name, normalized=False):
+    """Query rebuilding every rollup from the given table, writers of the table are blocked meanwhile"""
+    return sql.Composed(
+        [
+            sql.SQL("LOCK TABLE {} IN SHARE MODE;").format(sql.Identifier(table_name)),
+            _rebuild_totals_query(table_name, normalized),
+            _rebuild_hourly_query(table_name, normalized),
+        ]
+    )
+
+
+def _notify_statement(relation, normalized, notify):
+    """PL/pgSQL statement notifying the device types of a transition table, empty without notify"""
+    if not notify:
+        return sql.SQL("")
+
+    return sql.SQL(
+        "PERFORM pg_notify({}, device_type) FROM (SELECT DISTINCT device_type FROM {}) n;"
+    ).format(sql.Literal(COUNTS_CHANNEL), _named_rows(relation, normalized))
+
+
+def _install_counters(cursor, table_name, counter_shards, notify=False):
+    """
+    Create the device_type_counts (all-time) and device_type_hourly_counts (per hour of date_added)
+    rollups, and the triggers maintaining them on every write.
+    Each DB session increments its own shard row (pg_backend_pid() % counter_shards), thus
+    concurrent inserts of a hot device type don't queue on the same row lock; reads sum the shards.
+    With the normalized layout, the triggers join device_types: rollups are keyed by name anyway.
+    With notify, the triggers also send a NOTIFY on COUNTS_CHANNEL per device type written, its
+    name as payload; identical notifications of a transaction are sent once, at commit.
+    """
+    normalized = _is_normalized(cursor, table_name)
+    cursor.execute(
+        "SELECT to_regclass(%s) IS NULL, to_regclass(%s) IS NULL",
+        (COUNTS_TABLE, HOURLY_COUNTS_TABLE),
+    )
+    backfill_totals, backfill_hourly = cursor.fetchone()
+
+    # counters are updated in place all the time, free space in pages keeps updates HOT
+    cursor.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} (device_type varchar (150) NOT NULL, shard smallint NOT NULL, count bigint NOT NULL, PRIMARY KEY (device_type, shard)) WITH (fillfactor = 50);"
+        ).format(sql.Identifier(COUNTS_TABLE))
+    )
+    cursor.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {} (device_type varchar (150) NOT NULL, bucket timestamp NOT NULL, shard smallint NOT NULL, count bigint NOT NULL, PRIMARY KEY (device_type, bucket, shard)) WITH (fillfactor = 70);"
+        ).format(sql.Identifier(HOURLY_COUNTS_TABLE))
+    )
+
+    # statement-level triggers see every row of a (multi-row) statement in a transition table
+    cursor.execute(
+        sql.SQL(
+            """
+            CREATE OR REPLACE FUNCTION {function}() RETURNS trigger LANGUAGE plpgsql AS $$
+            BEGIN
+                IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                    INSERT INTO {counts} AS c (device_type, shard, count)
+                        SELECT device_type, pg_backend_pid() % {shards}, count(*)
+                        FROM {new_rows} GROUP BY device_type ORDER BY device_type
+                    ON CONFLICT (device_type, shard) DO UPDATE SET count = c.count + EXCLUDED.count;
+                    INSERT INTO {hourly} AS h (device_type, bucket, shard, count)
+                        SELECT device_type, {hour}, pg_backend_pid() % {shards}, count(*)
+                        FROM {new_rows} GROUP BY 1, 2 ORDER BY 1, 2
+                    ON CONFLICT (device_type, bucket, shard) DO UPDATE SET count = h.count + EXCLUDED.count;
+                    {notify_new}
+                END IF;
+                IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                    INSERT INTO {counts} AS c (device_type, shard, count)
+                        SELECT device_type, pg_backend_pid() % {shards}, -count(*)
+                        FROM {old_rows} GROUP BY device_type ORDER BY device_type
+                    ON CONFLICT (device_type, shard) DO UPDATE SET count = c.count + EXCLUDED.count;
+                    INSERT INTO {hourly} AS h (device_type, bucket, shard, count)
+                        SELECT device_type, {hour}, pg_backend_pid() % {shards}, -count(*)
+                        FROM {old_rows} GROUP BY 1, 2 ORDER BY 1, 2
+                    ON CONFLICT (device_type, bucket, shard) DO UPDATE SET count = h.count + EXCLUDED.count;
+                    {notify_old}
+                END IF;
+                RETURN NULL;
+            END;
+            $$;
+            """
+        ).format(
+            function=sql.Identifier("{}_maintain_counts".format(table_name)),
+            counts=sql.Identifier(COUNTS_TABLE),
+            hourly=sql.Identifier(HOURLY_COUNTS_TABLE),
+            hour=sql.SQL(HOUR_OF_ROW),
+            shards=sql.Literal(counter_shards),
+            new_rows=_named_rows(sql.Identifier("new_rows"), normalized),
+            old_rows=_named_rows(sql.Identifier("old_rows"), normalized),
+            notify_new=_notify_statement(sql.Identifier("new_rows"), normalized, notify),
+            notify_old=_notify_statement(sql.Identifier("old_rows"), normalized, notify),
+        )
+    )
+
+    for operation, transition in (
+        ("INSERT", "NEW TABLE AS new_rows"),
+        ("DELETE", "OLD TABLE AS old_rows"),
+        ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+    ):
+        trigger = sql.Identifier("{}_counts_{}".format(table_name, operation.lower()))
+        cursor.execute(
+            sql.SQL("DROP TRIGGER IF EXISTS {} ON {};").format(
+                trigger, sql.Identifier(table_name)
+            )
+        )
+        cursor.execute(
+            sql.SQL(
+                "CREATE TRIGGER {trigger} AFTER {operation} ON {table} REFERENCING {transition} FOR EACH STATEMENT EXECUTE FUNCTION {function}();"
+            ).format(
+                trigger=trigger,
+                operation=sql.SQL(operation),
+                table=sql.Identifier(table_name),
+                transition=sql.SQL(transition),
+                function=sql.Identifier("{}_maintain_counts".format(table_name)),
+            )
+        )
+
+    # rollup created on an existing table: count the rows already there
+    if backfill_totals or backfill_hourly:
+        cursor.execute(
+            sql.SQL("LOCK TABLE {} IN SHARE MODE;").format(sql.Identifier(table_name))
+        )
+    if backfill_totals:
+        cursor.execute(_rebuild_totals_query(table_name, normalized))
+    if backfill_hourly:
+        cursor.execute(_rebuild_hourly_query(table_name, normalized))
+
+
+def create_table(
+    db_name,
+    table_name,
+    db_user,
+    db_password,
+    db_host,
+    db_port,
+    counter_shards=8,
+    partition_interval=None,
+    layout="inline",
+    notify=False,
+) -> bool:
+    """
+    Create a given table in the given database if doesn't exists, together with
+    the index on device_type and the rollups used by the statistics of StatisticsAPI
     :param str db_name: name of DB to create table inside it
     :param str table_name: name of table to create in the db_name
     :param str db_user: username to get access to DB instance
     :param str db_password: password to get access to DB instance
+    :param int counter_shards: number of rows each device type is spread over in device_type_counts
+    :param str partition_interval: day, week or month to create the table partitioned by range
+    of date_added, None for a plain table. An existing table keeps its partitioning.
+    :param str layout: inline to store the name of the device type in every row, normalized to
+    store the id of the name in the device_types table. An existing table must have this layout.
+    :param bool notify: the triggers notify the device types written on COUNTS_CHANNEL
     :return: bool
     """
+    if layout not in DEVICE_TYPE_LAYOUTS:
+        raise ValueError(
+            "Device type layout must be one of {}, not [{}]".format(
+                DEVICE_TYPE_LAYOUTS, layout
+            )
+        )
+    normalized = layout == "normalized"
 
     try:
-        create_table_query = sql.SQL(
-            "CREATE TABLE IF NOT EXISTS {} (id SERIAL PRIMARY KEY, device_type varchar (150) NOT NULL, date_added date DEFAULT CURRENT_TIMESTAMP);"
-        ).format(sql.Identifier(table_name))
+        if normalized:
+            # a few hundred distinct names: 4 bytes per row instead of the string, in heap & index
+            device_type_column = sql.SQL(
+                "device_type_id integer NOT NULL REFERENCES {} (id)"
+            ).format(sql.Identifier(DEVICE_TYPES_TABLE))
+        else:
+            device_type_column = sql.SQL("device_type varchar (150) NOT NULL")
+
+        if partition_interval is None:
+            create_table_query = sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} (id SERIAL PRIMARY KEY, {}, date_added timestamptz DEFAULT CURRENT_TIMESTAMP);"
+            ).format(sql.Identifier(table_name), device_type_column)
+        else:
+            # the key of a partitioned table must contain the partition key
+            create_table_query = sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} (id SERIAL, {}, date_added timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP, PRIMARY KEY (id, date_added)) PARTITION BY RANGE (date_added);"
+            ).format(sql.Identifier(table_name), device_type_column)
+
+        # covering index: COUNT per device_type (and over date_added) is answered by an index-only scan
+        create_index_query = sql.SQL(
+            "CREATE INDEX IF NOT EXISTS {} ON {} ({}) INCLUDE (date_added);"
+        ).format(
+            sql.Identifier("{}_device_type_idx".format(table_name)),
+            sql.Identifier(table_name),
+            sql.Identifier("device_type_id" if normalized else "device_type"),
+        )
 
         db_connect = psycopg2.connect(
             database=db_name,
@@ -135,9 +570,50 @@ def create_table(db_name, table_name, db_user, db_password, db_host, db_port) ->
             port=db_port,
         )
 
-        db_connect.autocommit = True
+        # DDL of the table and its triggers is applied in a single transaction
         cursor = db_connect.cursor()
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (table_name,))
+        if cursor.fetchone()[0] and _is_normalized(cursor, table_name) != normalized:
+            # rows written in the layout of the settings would not fit the table
+            print(
+                "[Layout] Table [{}] exists with the {} layout, not {}".format(
+                    table_name, "inline" if normalized else "normalized", layout
+                )
+            )
+            db_connect.rollback()
+            cursor.close()
+            db_connect.close()
+            return False
+
+        if normalized:
+            # names are only added, an id is never reused
+            cursor.execute(
+                sql.SQL(
+                    "CREATE TABLE IF NOT EXISTS {} (id integer GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY, name varchar (150) NOT NULL UNIQUE);"
+                ).format(sql.Identifier(DEVICE_TYPES_TABLE))
+            )
         cursor.execute(create_table_query)
+        if partition_interval is not None and _is_partitioned(cursor, table_name):
+            # rows out of the range of every partition are kept instead of failing the insert
+            cursor.execute(
+                sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF {} DEFAULT;").format(
+                    sql.Identifier("{}_default".format(table_name)),
+                    sql.Identifier(table_name),
+                )
+            )
+        elif partition_interval is not None:
+            print(
+                "[Partitioning] Table [{}] exists and is not partitioned, it is kept as is".format(
+                    table_name
+                )
+            )
+        # on a partitioned table, the index is created on every partition
+        cursor.execute(create_index_query)
+        _install_counters(cursor, table_name, counter_shards, notify)
+        db_connect.commit()
+
+        cursor.close()
+        db_connect.close()
 
         return True
 
@@ -152,3 +628,297 @@ def create_table(db_name, table_name, db_user, db_password, db_host, db_port) ->
         db_connect.close()
         print("[Exception]", err)
         return False
+
+
+def _is_partitioned(cursor, table_name) -> bool:
+    """The given table exists and is partitioned"""
+    cursor.execute(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass(%s);",
+        (table_name,),
+    )
+    row = cursor.fetchone()
+    return row is not None and row[0]
+
+
+def _partition_start(moment, interval) -> datetime.datetime:
+    """Start (midnight in UTC) of the partition containing the given moment"""
+    day = moment.astimezone(datetime.timezone.utc).date()
+    if interval == "week":
+        day -= datetime.timedelta(days=day.weekday())
+    elif interval == "month":
+        day = day.replace(day=1)
+    elif interval != "day":
+        raise ValueError(
+            "Partition interval must be one of {}, not [{}]".format(
+                PARTITION_INTERVALS, interval
+            )
+        )
+
+    return datetime.datetime(
+        day.year, day.month, day.day, tzinfo=datetime.timezone.utc
+    )
+
+
+def _shift_partition(start, interval, count) -> datetime.datetime:
+    """Start of the partition count intervals after (or before) the one starting at start"""
+    if interval == "day":
+        return start + datetime.timedelta(days=count)
+    if interval == "week":
+        return start + datetime.timedelta(weeks=count)
+
+    months = start.year * 12 + start.month - 1 + count
+    return start.replace(year=months // 12, month=months % 12 + 1)
+
+
+def _list_partitions(cursor, table_name) -> list:
+    """
+    Partitions of the given table with a bounded range
+    :return list: (name, start, end) of every partition, bounds in UTC
+    """
+    # bounds are printed in the time zone of the session
+    cursor.execute("SET TimeZone = 'UTC';")
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s);",
+        (table_name,),
+    )
+
+    partitions = []
+    for name, bound in cursor.fetchall():
+        # e.g. FOR VALUES FROM ('2024-01-01 00:00:00+00') TO ('2024-02-01 00:00:00+00'),
+        # the DEFAULT partition and MINVALUE/MAXVALUE bounds don't match
+        match = re.search(r"FROM \('([^']+)'\) TO \('([^']+)'\)", bound)
+        if match is None:
+            continue
+        start, end = (
+            datetime.datetime.strptime(value[:19], "%Y-%m-%d %H:%M:%S").replace(
+                tzinfo=datetime.timezone.utc
+            )
+            for value in match.groups()
+        )
+        partitions.append((name, start, end))
+
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def create_partitions(
+    db_name, table_name, db_user, db_password, db_host, db_port, interval, premake
+) -> bool:
+    """
+    Create the partition of the current interval and the premake next ones, if they don't exist.
+    Nothing is done when the given table is not partitioned.
+    :param str db_name: name of DB containing the table
+    :param str table_name: name of the partitioned table
+    :param str db_user: username to get access to DB instance
+    :param str db_password: password to get access to DB instance
+    :param str interval: day, week or month
+    :param int premake: number of partitions created after the current one
+    :return: bool, False when a partition could not be created
+    """
+
+    try:
+        db_connect = psycopg2.connect(
+            database=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port,
+        )
+
+        with db_connect.cursor() as cursor:
+            if not _is_partitioned(cursor, table_name):
+                db_connect.rollback()
+                db_connect.close()
+                return True
+            existing = _list_partitions(cursor, table_name)
+        db_connect.commit()
+
+        res = True
+        start = _partition_start(datetime.datetime.now(datetime.timezone.utc), interval)
+        for _ in range(premake + 1):
+            end = _shift_partition(start, interval, 1)
+            name = "{}_p{}".format(table_name, start.strftime("%Y%m%d"))
+
+            # a range already covered, e.g. by partitions of another interval, is left as is
+            overlap = any(start < p_end and p_start < end for _, p_start, p_end in existing)
+            if not overlap:
+                try:
+                    # one transaction per partition, rows of the range in the DEFAULT
+                    # partition make the creation fail (they are moved by an operator)
+                    with db_connect:
+                        with db_connect.cursor() as cursor:
+                            cursor.execute(
+                                "SET LOCAL lock_timeout = %s;",
+                                (PARTITION_LOCK_TIMEOUT,),
+                            )
+                            cursor.execute(
+                                sql.SQL(
+                                    "CREATE TABLE IF NOT EXISTS {} PARTITION OF {} FOR VALUES FROM ({}) TO ({});"
+                                ).format(
+                                    sql.Identifier(name),
+                                    sql.Identifier(table_name),
+                                    sql.Literal(start.isoformat()),
+                                    sql.Literal(end.isoformat()),
+                                )
+                            )
+                    print("[Partitioning] Partition [{}] is ready".format(name))
+                except DatabaseError as err:
+                    print("[DatabaseError Exception]", err)
+                    res = False
+
+            start = end
+
+        db_connect.close()
+
+        return res
+
+    except DatabaseError as err:
+        print("[DatabaseError Exception]", err)
+        return False
+
+    except Exception as err:
+        print("[Exception]", err)
+        return False
+
+
+def detach_old_partitions(
+    db_name,
+    table_name,
+    db_user,
+    db_password,
+    db_host,
+    db_port,
+    interval,
+    retention,
+    drop=False,
+) -> (bool, list):
+    """
+    Detach the partitions ending before the retention of the given table, i.e. the
+    retention intervals before the current one are kept. The rows of a detached partition
+    are removed from the device type rollups in the same transaction.
+    :param str db_name: name of DB containing the table
+    :param str table_name: name of the partitioned table
+    :param str db_user: username to get access to DB instance
+    :param str db_password: password to get access to DB instance
+    :param str interval: day, week or month
+    :param int retention: number of partitions kept before the current one, 0 keeps all
+    :param bool drop: drop the detached partitions instead of keeping them as tables
+    :return: bool & names of the detached partitions
+    """
+    if retention <= 0:
+        return (True, [])
+
+    detached = []
+    try:
+        db_connect = psycopg2.connect(
+            database=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port,
+        )
+
+        with db_connect.cursor() as cursor:
+            if not _is_partitioned(cursor, table_name):
+                db_connect.rollback()
+                db_connect.close()
+                return (True, [])
+            normalized = _is_normalized(cursor, table_name)
+            partitions = _list_partitions(cursor, table_name)
+        db_connect.commit()
+
+        cutoff = _shift_partition(
+            _partition_start(datetime.datetime.now(datetime.timezone.utc), interval),
+            interval,
+            -retention,
+        )
+
+        for name, start, end in partitions:
+            if end > cutoff:
+                break
+
+            # a partition is detached with its counts, or not at all
+            with db_connect:
+                with db_connect.cursor() as cursor:
+                    cursor.execute(
+                        "SET LOCAL lock_timeout = %s;", (PARTITION_LOCK_TIMEOUT,)
+                    )
+                    cursor.execute(
+                        sql.SQL("ALTER TABLE {} DETACH PARTITION {};").format(
+                            sql.Identifier(table_name), sql.Identifier(name)
+                        )
+                    )
+                    # the partition no longer takes writes, its rows are counted once
+                    cursor.execute(
+                        sql.SQL(
+                            "INSERT INTO {counts} AS c (device_type, shard, count) SELECT device_type, 0, -count(*) FROM {rows} GROUP BY device_type ORDER BY device_type ON CONFLICT (device_type, shard) DO UPDATE SET count = c.count + EXCLUDED.count;"
+                        ).format(
+                            counts=sql.Identifier(COUNTS_TABLE),
+                            rows=_named_rows(sql.Identifier(name), normalized),
+                        )
+                    )
+                    # buckets of the range only hold rows of this partition
+                    cursor.execute(
+                        sql.SQL(
+                            "DELETE FROM {} WHERE bucket >= %s AND bucket < %s;"
+                        ).format(sql.Identifier(HOURLY_COUNTS_TABLE)),
+                        (start.replace(tzinfo=None), end.replace(tzinfo=None)),
+                    )
+                    if drop:
+                        cursor.execute(
+                            sql.SQL("DROP TABLE {};").format(sql.Identifier(name))
+                        )
+            detached.append(name)
+
+        db_connect.close()
+
+        return (True, detached)
+
+    except DatabaseError as err:
+        print("[DatabaseError Exception]", err)
+        return (False, detached)
+
+    except Exception as err:
+        print("[Exception]", err)
+        return (False, detached)
+
+
+def reconcile_counts(
+    db_name, table_name, db_user, db_password, db_host, db_port
+) -> bool:
+    """
+    Rebuild the device type rollups (all-time & hourly) from the given table, e.g. after a drift.
+    Writers of the table are blocked while the counts are rebuilt, readers are not.
+    :param str db_name: name of DB containing the table
+    :param str table_name: name of table to count the device types of
+    :param str db_user: username to get access to DB instance
+    :param str db_password: password to get access to DB instance
+    :return: bool
+    """
+
+    try:
+        db_connect = psycopg2.connect(
+            database=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port,
+        )
+
+        with db_connect:
+            with db_connect.cursor() as cursor:
+                cursor.execute(
+                    _rebuild_counts_query(
+                        table_name, _is_normalized(cursor, table_name)
+                    )
+                )
+        db_connect.close()
+
+        return True
+
+    except DatabaseError as err:
+        print("[DatabaseError Exception]", err)
+        return False
+
+    except Exception as err:
+        print("[Exception]", err)
+        return False
@@ -0,0 +1,278 @@
+"""
+This module implements a pool of PostgreSQL connections owned by a single worker process.
+uWSGI forks its workers from a master process, and a libpq connection must never be shared
+across a fork, thus pools are created lazily in the worker which uses them.
+
+* ConnectionPool --> checks connections out and back in, health-checks and recycles stale ones
+* get_pool() --> returns the pool of the current process for the given connection string
+* get_pool_stats() --> returns usage statistics of every pool of the current process
+
+@author: MMB
+"""
+
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions, InterfaceError, OperationalError
+
+
+class PoolTimeoutError(Exception):
+    """No connection could be checked out of the pool in time."""
+
+
+class ConnectionPool:
+    """A thread-safe pool of psycopg2 connections"""
+
+    def __init__(
+        self,
+        dsn,
+        min_size=1,
+        max_size=5,
+        max_lifetime=3600,
+        health_check_interval=30,
+        checkout_timeout=5,
+    ):
+        """
+        :param str dsn: connection string given to psycopg2.connect()
+        :param int min_size: number of connections opened when the pool is created
+        :param int max_size: maximum number of connections opened at the same time
+        :param float max_lifetime: seconds after which a connection is recycled
+        :param float health_check_interval: idle seconds after which a connection is pinged on checkout
+        :param float checkout_timeout: seconds to wait for a free connection
+        """
+        self.dsn = dsn
+        self._dsn_params = extensions.parse_dsn(dsn)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_interval = health_check_interval
+        self.checkout_timeout = checkout_timeout
+
+        self._cond = threading.Condition()
+        self._idle = []  # LIFO stack, the most recently used connection is the warmest one
+        self._created_at = {}
+        self._last_used = {}
+        self._size = 0
+        self._waiting = 0
+        self._timed_out_at = None
+        self._stats = {
+            "opened": 0,
+            "checkouts": 0,
+            "waits": 0,
+            "timeouts": 0,
+            "recycled": 0,
+            "failed_health_checks": 0,
+        }
+
+        for _ in range(min_size):
+            try:
+                with self._cond:
+                    self._size += 1
+                self.putconn(self._open())
+            except Exception as err:
+                with self._cond:
+                    self._size -= 1
+                print("[Exception] unable to prefill connection pool:", err)
+                break
+
+    def _open(self):
+        conn = psycopg2.connect(self.dsn)
+        now = time.monotonic()
+        with self._cond:
+            self._created_at[conn] = now
+            self._last_used[conn] = now
+            self._stats["opened"] += 1
+        return conn
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._created_at.pop(conn, None)
+            self._last_used.pop(conn, None)
+            self._stats["recycled"] += 1
+            self._cond.notify()
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+
+        now = time.monotonic()
+        # the timestamps are updated by the other threads on checkout & check-in
+        with self._cond:
+            created_at = self._created_at.get(conn, now)
+            last_used = self._last_used.get(conn, now)
+        if now - created_at > self.max_lifetime:
+            return False
+
+        if now - last_used > self.health_check_interval:
+            try:
+                with conn.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                conn.rollback()
+            except (OperationalError, InterfaceError):
+                with self._cond:
+                    self._stats["failed_health_checks"] += 1
+                return False
+
+        return True
+
+    def _reserve(self, deadline):
+        """Return an idle connection, or None when a slot is reserved to open a new one"""
+        with self._cond:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+
+                if self._size < self.max_size:
+                    self._size += 1
+                    return None
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    self._timed_out_at = time.monotonic()
+                    raise PoolTimeoutError(
+                        "No database connection available after {}s".format(
+                            self.checkout_timeout
+                        )
+                    )
+                self._stats["waits"] += 1
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+    def getconn(self):
+        """
+        Check a connection out of the pool
+        :return: psycopg2 connection
+        """
+        deadline = time.monotonic() + self.checkout_timeout
+
+        while True:
+            conn = self._reserve(deadline)
+            if conn is None:
+                try:
+                    conn = self._open()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_healthy(conn):
+                self._discard(conn)
+                continue
+
+            with self._cond:
+                self._stats["checkouts"] += 1
+            return conn
+
+    def putconn(self, conn, discard=False):
+        """
+        Check a connection back in the pool
+        :param conn: psycopg2 connection returned by getconn()
+        :param bool discard: close the connection instead of reusing it
+        """
+        if discard or conn.closed:
+            self._discard(conn)
+            return
+
+        if conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except Exception:
+                self._discard(conn)
+                return
+
+        with self._cond:
+            self._last_used[conn] = time.monotonic()
+            self._idle.append(conn)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Check a connection out for the duration of a with block"""
+        conn = self.getconn()
+        discard = False
+        try:
+            yield conn
+        except (OperationalError, InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.putconn(conn, discard=discard)
+
+    def stats(self) -> dict:
+        """Return usage statistics of the pool"""
+        now = time.monotonic()
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(
+                {
+                    "database": self._dsn_params.get("dbname"),
+                    "host": self._dsn_params.get("host"),
+                    "port": self._dsn_params.get("port"),
+                    "size": self._size,
+                    "idle": len(self._idle),
+                    "in_use": self._size - len(self._idle),
+                    "max_size": self.max_size,
+                    # checkouts waiting for a connection, seconds since the last one timed out
+                    "waiting": self._waiting,
+                    "last_timeout_age": None
+                    if self._timed_out_at is None
+                    else round(now - self._timed_out_at, 3),
+                }
+            )
+        return stats
+
+
+_pools = {}
+_pools_pid = None
+_pools_lock = threading.Lock()
+# pools inherited from a parent process are kept referenced, as closing (or garbage
+# collecting) them in the child would terminate sessions still used by the parent.
+_inherited_pools = []
+
+
+def get_pool(dsn, **pool_kwargs) -> ConnectionPool:
+    """
+    Return the pool of the current process for the given connection string
+    :param str dsn: connection string given to psycopg2.connect()
+    :param pool_kwargs: sizing parameters of ConnectionPool, used when the pool is created
+    :return: ConnectionPool
+    """
+    global _pools_pid
+
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            _inherited_pools.extend(_pools.values())
+            _pools.clear()
+            _pools_pid = os.getpid()
+
+        pool = _pools.get(dsn)
+        if pool is None:
+            pool = ConnectionPool(dsn, **pool_kwargs)
+            _pools[dsn] = pool
+
+        return pool
+
+
+def get_pool_stats() -> list:
+    """
+    Return usage statistics of the pools of the current process
+    :return list: one dict per pool
+    """
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            return []
+        pools = list(_pools.values())
+
+    return [dict(pool.stats(), pid=_pools_pid) for pool in pools]
@@ -3,10 +3,22 @@ Different functions are implemented to handle functionalities of the API:
 
 info() --> return back some information to client about the API
 get_status() --> to be called for any health-check of the API
+get_stats() --> return runtime statistics (e.g., DB connection pool) of the worker
+get_metrics() --> return Prometheus metrics of all the workers (requests, latency, DB timing)
+reload_config() --> reload the settings of every worker (admin)
+list_profiles() & get_profile() --> profiles of slow requests kept by the workers (admin, src.profiler)
 store_login_event() --> main function to handle request recieved on the path /Device/register
+device_rows() & insert_devices() --> rows of the devices table in the layout of the settings (inline or normalized)
+get_write_buffer() --> return the write-behind buffer of the worker, when enabled
+get_spool() & spool_rows() --> spool rows which could not be written to DB, replayed later (202)
+store_login_events() --> handle a batch of events recieved on the path /Device/register/batch
 initilize_database() --> initialize DB for the first time of running application
+reconcile_counts() --> CLI command rebuilding the per device type counts from the devices table
 check_authentication_token --> handle authentication.
 
+Configuration is read once into src.settings. /api/admin/reload-config (or SIGUSR2 outside of uWSGI)
+requests a reload, applied by every worker before its next request.
+
 Authentication is done using a token received in the header of the HTTP request.
 For security reasons, it is better to send tokens in the request header.
 
@@ -15,24 +27,24 @@ For security reasons, it is better to send tokens in the request header.
 
 import json
 import os
-import configparser
-import requests
+import signal
 
-from flask import jsonify, request
+from flask import jsonify, request, send_from_directory
+from src import admission
 from src import db_layer
+from src import metrics
+from src import profiler
+from src import settings
+from src import spool
+from src import write_buffer
 from src import app
 
-# global setting
-requests.adapters.DEFAULT_RETRIES = 5
-
-# ENV variables
-deviceregistration_user_key = os.getenv(
-    "DEVICEREGISTRATION_USER_KEY"
-)  # Token to get access to this api, this is equal to userKey
-database_user = os.getenv("DATABASE_USER")
-database_password = os.getenv("DATABASE_PASSWORD")
-database_host = os.getenv("DATABASE_HOST")
-database_port = os.getenv("DATABASE_PORT")
+metrics.instrument(app)
+profiler.instrument(app)
+# a refused request costs no more than the lookup of its route
+admission.instrument(app)
+# outermost, a reload requested by another worker applies before anything reads the settings
+settings.instrument(app)
 
 
 # implements a special class for the handling of unknown exception/errors.
@@ -101,11 +113,242 @@ def get_status():
     return result
 
 
+@app.route("/api/stats")
+def get_stats():
+    """Get runtime statistics of the worker which serves the request"""
+    data = {
+        "db_pool": db_layer.get_pool_stats(),
+        "write_buffer": write_buffer.get_buffer_stats(),
+        "spool": spool.get_spool_stats(),
+        "profiler": profiler.get_profiler_stats(),
+        "admission": admission.get_admission_stats(),
+    }
+    result = app.response_class(
+        response=json.dumps(data), status=200, mimetype="application/json"
+    )
+
+    return result
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Get Prometheus metrics, aggregated over the workers"""
+    body, content_type = metrics.export()
+    return app.response_class(response=body, status=200, content_type=content_type)
+
+
+@app.route("/api/admin/reload-config", methods=["POST"])
+def reload_config():
+    """Reload the settings of every worker from params.ini and ENV, each before its next request"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    try:
+        settings.request_reload()
+        settings.check_generation()
+        data = {"INFO": "Settings reloaded, every other worker reloads before its next request", "pid": os.getpid()}
+    except OSError as err:
+        print("[Exception] unable to request a reload of the settings:", err)
+        settings.reload_settings()
+        data = {"INFO": "Settings reloaded by this worker only", "pid": os.getpid()}
+    result = app.response_class(
+        response=json.dumps(data), status=200, mimetype="application/json"
+    )
+
+    return result
+
+
+@app.route("/api/admin/profiles", methods=["GET"])
+def list_profiles():
+    """List the most recent profiles of slow requests kept by the workers (admin)"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    conf = settings.get_settings()
+    try:
+        limit = int(request.args.get("limit", 50))
+        min_ms = float(request.args.get("min_ms", 0))
+    except ValueError:
+        data = {"StatusCode": 400, "message": "Invalid limit or min_ms parameter"}
+        return app.response_class(
+            response=json.dumps(data), status=400, mimetype="application/json"
+        )
+
+    data = {
+        "enabled": conf.profiling_enabled,
+        "profiles": profiler.list_profiles(conf.profiling_dir, limit, min_ms),
+    }
+    result = app.response_class(
+        response=json.dumps(data), status=200, mimetype="application/json"
+    )
+
+    return result
+
+
+@app.route("/api/admin/profiles/<string:name>", methods=["GET"])
+def get_profile(name: str):
+    """Download a profile listed by /api/admin/profiles, in the pstats format (admin)"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    if not name.endswith(profiler.PSTATS_SUFFIX):
+        return resource_not_found(None)
+
+    # a name outside of the directory is answered with 404
+    return send_from_directory(
+        settings.get_settings().profiling_dir, name, as_attachment=True
+    )
+
+
+def device_rows(rows) -> (str, list):
+    """
+    Column & rows to insert into the devices table, in the device type layout of the settings:
+    with the normalized layout, the name of every row is replaced by its id in device_types,
+    resolved by the map of the worker
+    :param list rows: tuples (device_type,)
+    :return tuple: column & rows, rows None if the ids could not be resolved
+    :raise DatabaseUnavailableError: when the DB is unavailable
+    """
+    conf = settings.get_settings()
+    if conf.db_device_type_layout != "normalized":
+        return ("device_type", rows)
+
+    ids = db_layer.resolve_device_types(
+        [row[0] for row in rows],
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    if ids is None:
+        return ("device_type_id", None)
+
+    return ("device_type_id", [(ids[row[0]],) + tuple(row[1:]) for row in rows])
+
+
+def insert_devices(rows) -> bool:
+    """
+    Insert rows into the devices table in a single transaction, through the DB adaptor
+    :param list rows: tuples (device_type,)
+    :return: bool, False if the rows can't be written (e.g., invalid device type)
+    :raise DatabaseUnavailableError: when the DB is unavailable
+    """
+    conf = settings.get_settings()
+    column, values = device_rows(rows)
+    if values is None:
+        return False
+
+    return db_layer.insert_many_to_db(
+        "INSERT INTO devices ({}) VALUES %s".format(column),
+        values,
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+
+
+def get_write_buffer() -> write_buffer.WriteBuffer:
+    """Return the write-behind buffer of the worker, inserting its groups through the DB adaptor"""
+    conf = settings.get_settings()
+
+    def write_rows(rows):
+        try:
+            res = insert_devices(rows)
+        except db_layer.DatabaseUnavailableError:
+            res = None
+        if res is True:
+            return True
+
+        # rows of an unavailable DB, and rows already acknowledged, are spooled instead of being
+        # lost; the replayer sets aside the rows which can't be written
+        if res is None or conf.write_behind_durability == write_buffer.DURABILITY_ENQUEUE:
+            try:
+                if spool_rows(rows):
+                    return None
+            except spool.SpoolFullError as err:
+                print("[Exception]", err)
+        return False
+
+    return write_buffer.get_buffer(
+        write_rows,
+        durability=conf.write_behind_durability,
+        max_queue=conf.write_behind_max_queue,
+        flush_max_rows=conf.write_behind_flush_max_rows,
+        flush_interval_ms=conf.write_behind_flush_interval_ms,
+        enqueue_timeout_ms=conf.write_behind_enqueue_timeout_ms,
+        commit_timeout_ms=conf.write_behind_commit_timeout_ms,
+    )
+
+
+def get_spool() -> spool.Spool:
+    """Return the spool of the worker, replaying its rows through the DB adaptor"""
+    conf = settings.get_settings()
+
+    def observe_replay(rows, size):
+        metrics.observe_spool(replayed=rows, size=size)
+
+    def observe_quarantine(rows):
+        metrics.observe_spool(quarantined=rows)
+
+    return spool.get_spool(
+        conf.spool_dir,
+        insert_devices,
+        max_bytes=conf.spool_max_bytes,
+        segment_bytes=conf.spool_segment_bytes,
+        fsync=conf.spool_fsync,
+        replay_interval=conf.spool_replay_interval,
+        replay_batch=conf.spool_replay_batch,
+        replay_rate=conf.spool_replay_rate,
+        on_replay=observe_replay,
+        on_quarantine=observe_quarantine,
+    )
+
+
+def spool_rows(rows) -> bool:
+    """
+    Append rows which could not be written to DB to the spool of the worker
+    :param list rows: tuples of data to be inserted to DB
+    :return bool: True if the rows are spooled, False when the spool is disabled or failed
+    :raise SpoolFullError: when the spool is full
+    """
+    if not settings.get_settings().spool_enabled:
+        return False
+
+    try:
+        get_spool().append(rows)
+    except OSError as err:
+        print("[Exception] unable to spool rows:", err)
+        return False
+
+    metrics.observe_spool(appended=len(rows))
+    return True
+
+
+def unavailable_response():
+    """503 answered when the write-behind buffer or the spool is full (backpressure)"""
+    data = {"StatusCode": 503}
+    result = app.response_class(
+        response=json.dumps(data), status=503, mimetype="application/json"
+    )
+    # the client should retry later instead of queuing in uWSGI
+    result.headers["Retry-After"] = settings.get_settings().write_behind_retry_after
+    return result
+
+
 @app.route("/Device/register", methods=["POST"])
 def store_login_event():
     """Store information about user login event"""
-    s = requests.session()
-    s.keep_alive = False
+    conf = settings.get_settings()
 
     try:
         recv_api_token = request.headers.get("userKey")
@@ -116,22 +359,50 @@ def store_login_event():
         if check_authentication_token(recv_api_token):
             # prepare data and query to insert to database
             data_to_insert = (str(json_data["deviceType"]),)
-            insert_query = "INSERT INTO devices (device_type) VALUES (%s)"
 
-            # call related function in DB adaptor
-            res = db_layer.insert_to_db(
-                insert_query,
-                data_to_insert,
-                database_user,
-                database_password,
-                database_host,
-                database_port,
-            )
+            if conf.spool_enabled:
+                # starts the replayer of the worker, which drains rows spooled before
+                get_spool()
+
+            if conf.write_behind_enabled:
+                # queue the row, it is committed by the flusher of the worker with other rows
+                try:
+                    res = get_write_buffer().submit(data_to_insert)
+                except write_buffer.BufferFullError:
+                    # overflow of the queue goes to the spool, when enabled
+                    if not spool_rows([data_to_insert]):
+                        raise
+                    res = None
+                except write_buffer.CommitTimeoutError:
+                    # the flusher is held by a slow DB: the row is spooled, when enabled
+                    res = None if spool_rows([data_to_insert]) else False
+            else:
+                # call related function in DB adaptor, the row in the layout of the table
+                try:
+                    column, values = device_rows([data_to_insert])
+                    res = values is not None and db_layer.insert_to_db(
+                        "INSERT INTO devices ({}) VALUES (%s)".format(column),
+                        values[0],
+                        conf.db_user,
+                        conf.db_password,
+                        conf.db_host,
+                        conf.db_port,
+                    )
+                except db_layer.DatabaseUnavailableError:
+                    # only a row of an unavailable DB is spooled, invalid data is refused
+                    res = None if spool_rows([data_to_insert]) else False
             if res is True:
                 data = {"StatusCode": 200}
                 result = app.response_class(
                     response=json.dumps(data), status=200, mimetype="application/json"
                 )
+            elif res is None:
+                # accepted: the row is in the spool, written to DB once it is available, or
+                # was being committed by the write-behind flusher when its wait timed out
+                data = {"StatusCode": 202}
+                result = app.response_class(
+                    response=json.dumps(data), status=202, mimetype="application/json"
+                )
             else:
                 data = {"StatusCode": 400}
                 result = app.response_class(
@@ -145,22 +416,101 @@ def store_login_event():
 
         return result
 
-    except requests.exceptions.RequestException as e:
-        raise ThreatStackRequestError(
-            "An unexpected error is occured when storing a device type", status_code=409
-        )
+    except (write_buffer.BufferFullError, spool.SpoolFullError):
+        # backpressure
+        return unavailable_response()
 
     except Exception as e:
         raise ThreatStackError("Unknown Error in storing DeviceType", status_code=409)
 
 
+@app.route("/Device/register/batch", methods=["POST"])
+def store_login_events():
+    """Store a batch of user login events in a single transaction, reporting a result per event"""
+    conf = settings.get_settings()
+
+    try:
+        recv_api_token = request.headers.get("userKey")
+
+        # retrieve data from request
+        json_data = request.json
+
+        if not check_authentication_token(recv_api_token):
+            data = {"ERROR": "Authentication failed"}
+            return app.response_class(
+                response=json.dumps(data), status=403, mimetype="application/json"
+            )
+
+        if not isinstance(json_data, list) or not 0 < len(json_data) <= conf.batch_max_events:
+            data = {
+                "StatusCode": 400,
+                "message": "A list of 1 to {} events is expected".format(
+                    conf.batch_max_events
+                ),
+            }
+            return app.response_class(
+                response=json.dumps(data), status=400, mimetype="application/json"
+            )
+
+        # prepare data to insert, events without a deviceType are reported as bad requests
+        rows = []
+        results = []
+        for event in json_data:
+            if isinstance(event, dict) and event.get("deviceType"):
+                rows.append((str(event["deviceType"]),))
+                results.append({"StatusCode": 200})
+            else:
+                results.append({"StatusCode": 400})
+
+        res = True
+        if rows:
+            if conf.spool_enabled:
+                get_spool()
+
+            # call related function in DB adaptor
+            try:
+                res = insert_devices(rows)
+            except db_layer.DatabaseUnavailableError:
+                # only rows of an unavailable DB are spooled, invalid data is refused
+                res = None if spool_rows(rows) else False
+
+        if res is True:
+            data = {"StatusCode": 200, "results": results}
+            result = app.response_class(
+                response=json.dumps(data), status=200, mimetype="application/json"
+            )
+        elif res is None:
+            # accepted: the valid events are in the spool, written to DB once it is available
+            results = [
+                {"StatusCode": 202 if item["StatusCode"] == 200 else 400}
+                for item in results
+            ]
+            data = {"StatusCode": 202, "results": results}
+            result = app.response_class(
+                response=json.dumps(data), status=202, mimetype="application/json"
+            )
+        else:
+            data = {"StatusCode": 400, "results": [{"StatusCode": 400}] * len(results)}
+            result = app.response_class(
+                response=json.dumps(data), status=400, mimetype="application/json"
+            )
+
+        return result
+
+    except spool.SpoolFullError:
+        return unavailable_response()
+
+    except Exception as e:
+        raise ThreatStackError("Unknown Error in storing DeviceTypes", status_code=409)
+
+
 # Check validity of recieved token(i.e., userKey) for authentication
 def check_authentication_token(token: str) -> bool:
     """Handle authentication of API
     :param str token-> a received token to be validated
     :return bool: True if OK otherwise False
     """
-    if token == deviceregistration_user_key:
+    if token == settings.get_settings().user_key:
         return True
 
     return False
@@ -172,31 +522,43 @@ def initilize_database() -> bool:
     This function only executed everytime the application run. If database exists, nothing happen.
     :return bool
     """
-
-    # Create an instance of ConfigParser
-    config = configparser.ConfigParser()
-
-    # Read the configuration file
-    config.read("config/params.ini")
-    conf_db = config["DATABASE"]
+    conf = settings.get_settings()
 
     res = db_layer.init_db(
-        conf_db.get("NAME"),
-        database_user,
-        database_password,
-        database_host,
-        database_port,
+        conf.db_name,
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
     )
 
     if res:
         res = db_layer.create_table(
-            conf_db.get("NAME"),
-            conf_db.get("TABLE"),
-            database_user,
-            database_password,
-            database_host,
-            database_port,
+            conf.db_name,
+            conf.db_table,
+            conf.db_user,
+            conf.db_password,
+            conf.db_host,
+            conf.db_port,
+            counter_shards=conf.db_counter_shards,
+            partition_interval=conf.partition_interval
+            if conf.partition_enabled
+            else None,
+            layout=conf.db_device_type_layout,
+            notify=conf.db_notify_counts,
         )
+        if res and conf.partition_enabled:
+            # a failed partition is not fatal, rows go to the DEFAULT partition meanwhile
+            db_layer.create_partitions(
+                conf.db_name,
+                conf.db_table,
+                conf.db_user,
+                conf.db_password,
+                conf.db_host,
+                conf.db_port,
+                conf.partition_interval,
+                conf.partition_premake,
+            )
         if res:
             return True
         return False
@@ -207,5 +569,81 @@ def initilize_database() -> bool:
         )
 
 
+@app.cli.command("reconcile-counts")
+def reconcile_counts():
+    """Rebuild the per device type counts from the devices table (flask reconcile-counts)"""
+    conf = settings.get_settings()
+
+    res = db_layer.reconcile_counts(
+        conf.db_name,
+        conf.db_table,
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    if not res:
+        raise SystemExit("Reconciliation of device type counts failed")
+
+    print("Device type counts reconciled.")
+
+
+@app.cli.command("maintain-partitions")
+def maintain_partitions():
+    """Create the next partitions & detach the expired ones (flask maintain-partitions)"""
+    conf = settings.get_settings()
+    if not conf.partition_enabled:
+        print("Partitioning is disabled.")
+        return
+
+    db_args = (
+        conf.db_name,
+        conf.db_table,
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    created = db_layer.create_partitions(
+        *db_args, conf.partition_interval, conf.partition_premake
+    )
+    res, detached = db_layer.detach_old_partitions(
+        *db_args,
+        conf.partition_interval,
+        conf.partition_retention,
+        drop=conf.partition_retention_drop,
+    )
+    for name in detached:
+        print(
+            "Partition [{}] {}.".format(
+                name, "dropped" if conf.partition_retention_drop else "detached"
+            )
+        )
+    if not created or not res:
+        raise SystemExit("Maintenance of partitions failed")
+
+
+def reload_settings_on_signal(signum, frame):
+    """
+    Reload the settings of every worker, e.g. on `kill -USR2` of a server other than uWSGI
+    (uWSGI handles SIGUSR2 in its workers, use /api/admin/reload-config)
+    """
+    try:
+        settings.request_reload()
+    except OSError as err:
+        print("[Exception] unable to request a reload of the settings:", err)
+        settings.reload_settings()
+        return
+    settings.check_generation()
+
+
+# signal handlers can only be installed from the main thread (i.e., not under a threaded server)
+try:
+    signal.signal(signal.SIGUSR2, reload_settings_on_signal)
+    # outside of uWSGI, queued rows are flushed on SIGTERM
+    write_buffer.exit_on_sigterm()
+except ValueError:
+    pass
+
 # call initilize database when app is started, for the first time.
 app.before_request_funcs = [(None, initilize_database())]
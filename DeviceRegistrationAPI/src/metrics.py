@@ -0,0 +1,199 @@
+"""
+This module exposes Prometheus metrics of DeviceRegistrationAPI.
+uWSGI serves requests from several worker processes, each one counting its own requests; when the
+ENV variable PROMETHEUS_MULTIPROC_DIR is set (see config/uwsgi.ini), every worker writes its
+values to memory-mapped files of this directory and export() aggregates the files of all workers,
+so /metrics reports the same totals whatever the worker serving the scrape.
+
+* instrument() --> count requests & observe their latency per route, method and status code
+* time_db() --> observe the time spent in a phase (connect, execute, fetch) of a db_layer call
+* observe_in_flight() & observe_shed() --> requests in flight & requests shed (src.admission)
+* observe_spool() --> rows spooled, replayed & size of the spool (src.spool)
+* export() --> metrics of all the workers, in the Prometheus text format
+
+@author: MMB
+"""
+import atexit
+import os
+import time
+from contextlib import contextmanager
+
+from flask import request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+try:
+    # only importable in a process run by uWSGI
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests served",
+    ["route", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving HTTP requests",
+    ["route", "method", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+# requests being served by the live workers, priority is health, write or read
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests in flight, admitted by admission control",
+    ["route", "priority"],
+    multiprocess_mode="livesum",
+)
+# limit is route, in_flight, reads, queue or pool
+SHED = Counter(
+    "http_requests_shed_total",
+    "HTTP requests answered with 503 by admission control",
+    ["route", "priority", "limit"],
+)
+# connect is the checkout of a connection from the pool of the worker, opening it when none is idle
+DB_LATENCY = Histogram(
+    "db_operation_duration_seconds",
+    "Time spent in db_layer calls, per phase",
+    ["operation", "phase"],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+)
+DB_ERRORS = Counter(
+    "db_operation_errors_total",
+    "db_layer calls which failed",
+    ["operation"],
+)
+SPOOLED = Counter(
+    "spool_rows_appended_total",
+    "Rows which could not be written to the database, appended to the spool",
+)
+# rate() of this counter is the replay rate
+REPLAYED = Counter(
+    "spool_rows_replayed_total",
+    "Spooled rows written to the database by the replayer",
+)
+QUARANTINED = Counter(
+    "spool_rows_quarantined_total",
+    "Spooled rows refused by the database, set aside by the replayer",
+)
+# every worker sees the same directory, the last size seen by a live worker is reported
+SPOOL_BYTES = Gauge(
+    "spool_bytes",
+    "Size of the segments of the spool waiting to be replayed",
+    multiprocess_mode="livemax",
+)
+
+
+def instrument(app):
+    """
+    Count the requests of a Flask application and observe their latency
+    :param Flask app: application to instrument
+    """
+    wsgi_app = app.wsgi_app
+
+    def timed_wsgi_app(environ, start_response):
+        environ["metrics.start"] = time.perf_counter()
+        return wsgi_app(environ, start_response)
+
+    @app.after_request
+    def observe_request(response):
+        start = request.environ.get("metrics.start")
+        if start is not None:
+            # the rule, not the path, to keep one serie per route (e.g., /Device/register)
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            labels = (route, request.method, str(response.status_code))
+            REQUESTS.labels(*labels).inc()
+            REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+        return response
+
+    app.wsgi_app = timed_wsgi_app
+
+
+@contextmanager
+def time_db(operation, phase):
+    """
+    Observe the time spent in the with block
+    :param str operation: db_layer call (e.g., insert, insert_many)
+    :param str phase: connect, execute or fetch
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_LATENCY.labels(operation, phase).observe(time.perf_counter() - start)
+
+
+def observe_in_flight(route, priority, delta):
+    """Count a request admitted (delta 1) or done (delta -1) by src.admission"""
+    IN_FLIGHT.labels(route, priority).inc(delta)
+
+
+def observe_shed(route, priority, limit):
+    """Count a request refused by src.admission"""
+    SHED.labels(route, priority, limit).inc()
+
+
+def observe_spool(appended=0, replayed=0, size=None, quarantined=0):
+    """
+    Observe the spool of the worker
+    :param int appended: rows appended to the spool
+    :param int replayed: rows written to the database by the replayer
+    :param int size: bytes of the spool, None when unknown
+    :param int quarantined: rows refused by the database, set aside by the replayer
+    """
+    if appended:
+        SPOOLED.inc(appended)
+    if replayed:
+        REPLAYED.inc(replayed)
+    if quarantined:
+        QUARANTINED.inc(quarantined)
+    if size is not None:
+        SPOOL_BYTES.set(size)
+
+
+def _mark_process_dead():
+    # gauges of a worker which exits are no more reported
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+
+def _at_exit(func):
+    """Call func when the worker exits, uWSGI ending its workers without the atexit hooks"""
+    atexit.register(func)
+    if uwsgi is not None:
+        previous = getattr(uwsgi, "atexit", None)
+
+        def hook():
+            func()
+            if previous is not None:
+                previous()
+
+        uwsgi.atexit = hook
+
+
+_at_exit(_mark_process_dead)
+
+
+def export() -> (bytes, str):
+    """
+    Metrics of all the workers, in the Prometheus text format
+    :return tuple: body & content type of the response
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        # a single process, e.g. the Flask development server
+        registry = REGISTRY
+
+    return (generate_latest(registry), CONTENT_TYPE_LATEST)
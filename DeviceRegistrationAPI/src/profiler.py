@@ -0,0 +1,291 @@
+"""
+This module profiles requests of the Flask application with cProfile, to tell where the time of a
+slow request goes (e.g., parsing, JSON, the DB or a remote server).
+
+When ENABLED in the [PROFILING] section of the settings, a request is profiled when it is sampled
+(SAMPLE_RATE) or, with HEADER set, when it carries the header X-Profile with the userKey of the
+API. The whole request is profiled, from the WSGI call to the last chunk of its body (e.g., a
+streamed export). A sampled profile is kept when the request took SLOW_MS or more, a requested one
+is always kept: it is written to DIR as <time>-<pid>.pstats (read with `python -m pstats` or
+snakeviz), with a <time>-<pid>.json describing the request. The oldest profiles are removed above
+MAX_FILES. When disabled, a request costs one lookup in the settings.
+
+cProfile follows a single thread, and a single profiler can be active in a process: a request is
+not profiled while another one is profiled by the worker. A request served by a coroutine is
+profiled step by step, the other tasks of the event loop are left out of its profile.
+
+* instrument() --> profile the requests of a Flask application
+* profile_coroutine() --> profile a request served by a coroutine, out of the Flask application
+* list_profiles() --> describe the most recent profiles kept in a directory
+* get_profiler_stats() --> returns the requests profiled & profiles kept by the worker
+
+@author: MMB
+"""
+import cProfile
+import hmac
+import json
+import os
+import random
+import threading
+import time
+
+from src import settings
+
+HEADER = "HTTP_X_PROFILE"
+PSTATS_SUFFIX = ".pstats"
+INFO_SUFFIX = ".json"
+
+# a single profiler can be active in the process
+_active = threading.Lock()
+_stats_lock = threading.Lock()
+_stats = {"profiled": 0, "kept": 0, "busy": 0, "write_failures": 0}
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def _requested(environ, conf) -> bool:
+    """True when the request carries X-Profile with the userKey of the API"""
+    token = environ.get(HEADER)
+    return bool(
+        conf.profiling_header
+        and token
+        and conf.user_key
+        and hmac.compare_digest(token.encode(), conf.user_key.encode())
+    )
+
+
+class _ProfiledBody:
+    """Body of a profiled response, profiling the iteration of its chunks until it is closed"""
+
+    def __init__(self, profile, body, info, keep, conf):
+        self.profile = profile
+        self.body = body
+        self.info = info
+        self.keep = keep
+        self.conf = conf
+        self.chunks = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self.profile.enable()
+        try:
+            if self.chunks is None:
+                self.chunks = iter(self.body)
+            return next(self.chunks)
+        finally:
+            self.profile.disable()
+
+    def close(self):
+        try:
+            if hasattr(self.body, "close"):
+                self.profile.enable()
+                try:
+                    self.body.close()
+                finally:
+                    self.profile.disable()
+        finally:
+            self.info["duration_ms"] = round(
+                (time.perf_counter() - self.info.pop("start")) * 1000, 1
+            )
+            try:
+                if self.keep or self.info["duration_ms"] >= self.conf.profiling_slow_ms:
+                    _write(self.profile, self.info, self.conf)
+            finally:
+                _active.release()
+
+
+def _write(profile, info, conf):
+    """Write a profile & its description to the directory of the settings"""
+    name = "{:020d}-{}".format(time.time_ns(), os.getpid())
+    path = os.path.join(conf.profiling_dir, name)
+    try:
+        os.makedirs(conf.profiling_dir, exist_ok=True)
+        profile.dump_stats(path + PSTATS_SUFFIX + ".tmp")
+        os.replace(path + PSTATS_SUFFIX + ".tmp", path + PSTATS_SUFFIX)
+        # the description is written last, a profile is listed once complete
+        with open(path + INFO_SUFFIX + ".tmp", "w") as info_file:
+            json.dump(dict(info, profile=name + PSTATS_SUFFIX), info_file)
+        os.replace(path + INFO_SUFFIX + ".tmp", path + INFO_SUFFIX)
+        _prune(conf.profiling_dir, conf.profiling_max_files)
+    except OSError as err:
+        print("[Exception] unable to write profile:", err)
+        _count("write_failures")
+        return
+
+    _count("kept")
+
+
+def _prune(directory, max_files):
+    """Remove the oldest profiles above max_files"""
+    names = sorted(
+        name[: -len(INFO_SUFFIX)]
+        for name in os.listdir(directory)
+        if name.endswith(INFO_SUFFIX)
+    )
+    for name in names[: max(len(names) - max_files, 0)]:
+        for suffix in (INFO_SUFFIX, PSTATS_SUFFIX):
+            try:
+                os.unlink(os.path.join(directory, name + suffix))
+            except FileNotFoundError:
+                pass
+
+
+def _start(environ, conf) -> dict:
+    """
+    Decide whether a request is profiled, taking the profiler of the process if so
+    :return dict: description of the request to profile, None if it isn't profiled
+    """
+    if not conf.profiling_enabled:
+        return None
+
+    requested = _requested(environ, conf)
+    if not requested and random.random() >= conf.profiling_sample_rate:
+        return None
+
+    if not _active.acquire(blocking=False):
+        # another request of the worker is being profiled
+        _count("busy")
+        return None
+
+    return {
+        "at": time.time(),
+        "start": time.perf_counter(),
+        "method": environ.get("REQUEST_METHOD"),
+        "path": environ.get("PATH_INFO"),
+        "status": None,
+        "trigger": "header" if requested else "sample",
+    }
+
+
+def instrument(app):
+    """
+    Profile the requests of a Flask application, as set in the [PROFILING] section of the settings
+    :param Flask app: application to profile
+    """
+    wsgi_app = app.wsgi_app
+
+    def profiled_wsgi_app(environ, start_response):
+        conf = settings.get_settings()
+        info = _start(environ, conf)
+        if info is None:
+            return wsgi_app(environ, start_response)
+
+        def profiled_start_response(status, headers, exc_info=None):
+            info["status"] = int(status.split(" ", 1)[0])
+            return start_response(status, headers, exc_info)
+
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            try:
+                body = wsgi_app(environ, profiled_start_response)
+            finally:
+                profile.disable()
+        except BaseException:
+            _active.release()
+            raise
+
+        _count("profiled")
+        # released when the server closes the body
+        return _ProfiledBody(profile, body, info, info["trigger"] == "header", conf)
+
+    app.wsgi_app = profiled_wsgi_app
+
+
+class _ProfiledCoroutine:
+    """Awaitable running a coroutine, profiling its own steps but not the tasks run meanwhile"""
+
+    def __init__(self, profile, coroutine):
+        self.profile = profile
+        self.coroutine = coroutine
+
+    def __await__(self):
+        value = None
+        error = None
+        while True:
+            self.profile.enable()
+            try:
+                if error is None:
+                    future = self.coroutine.send(value)
+                else:
+                    future = self.coroutine.throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                self.profile.disable()
+
+            try:
+                value = yield future
+                error = None
+            except BaseException as err:
+                value = None
+                error = err
+
+
+async def profile_coroutine(environ, coroutine) -> int:
+    """
+    Await the handler of a request served out of the Flask application (e.g., /Log/auth in
+    src/asgi.py), profiling it as set in the [PROFILING] section of the settings
+    :param dict environ: REQUEST_METHOD, PATH_INFO & HTTP_X_PROFILE of the request
+    :param coroutine: handler of the request, returning the status code of its response
+    :return int: status code of the response
+    """
+    conf = settings.get_settings()
+    info = _start(environ, conf)
+    if info is None:
+        return await coroutine
+
+    try:
+        profile = cProfile.Profile()
+        info["status"] = await _ProfiledCoroutine(profile, coroutine)
+        _count("profiled")
+        info["duration_ms"] = round((time.perf_counter() - info.pop("start")) * 1000, 1)
+        if info["trigger"] == "header" or info["duration_ms"] >= conf.profiling_slow_ms:
+            _write(profile, info, conf)
+    finally:
+        _active.release()
+
+    return info["status"]
+
+
+def list_profiles(directory, limit=50, min_ms=0.0) -> list:
+    """
+    Describe the most recent profiles kept in a directory
+    :param str directory: directory of the profiles
+    :param int limit: maximum number of profiles returned
+    :param float min_ms: only profiles of the requests which took as long or longer
+    :return list: descriptions (method, path, status, duration_ms, trigger, profile), newest first
+    """
+    try:
+        names = sorted(
+            (name for name in os.listdir(directory) if name.endswith(INFO_SUFFIX)),
+            reverse=True,
+        )
+    except FileNotFoundError:
+        return []
+
+    profiles = []
+    for name in names:
+        if len(profiles) >= limit:
+            break
+        try:
+            with open(os.path.join(directory, name)) as info_file:
+                info = json.load(info_file)
+        except (FileNotFoundError, ValueError):
+            # removed by another worker meanwhile
+            continue
+        if info["duration_ms"] >= min_ms:
+            profiles.append(info)
+
+    return profiles
+
+
+def get_profiler_stats() -> dict:
+    """Return the requests profiled & the profiles kept by the current process"""
+    with _stats_lock:
+        return dict(_stats)
@@ -0,0 +1,322 @@
+"""
+This module loads the configuration of DeviceRegistrationAPI once, into an immutable object.
+Values of config/params.ini are merged with ENV variables (DATABASE_*, DEVICEREGISTRATION_USER_KEY),
+ENV variables taking precedence, and derived values (e.g., DB connection DSN) are prebuilt.
+
+* Settings --> immutable configuration of the application
+* get_settings() --> returns the current settings, without any I/O
+* reload_settings() --> reloads the settings of the process from disk and ENV
+* request_reload() --> asks every worker to reload its settings, e.g. on SIGUSR2 or an admin call
+* check_generation() --> reloads the settings of the worker when a reload was requested
+* on_reload() --> registers a function rebuilding an object from the settings once they are reloaded
+* instrument() --> checks the generation of the settings before every request of a Flask application
+
+A reload is requested by replacing the generation file (GENERATION_FILE, shared by the workers of
+a host): each worker compares it with the one of its settings once per request (a stat), and
+reloads its settings when it changed.
+
+@author: MMB
+"""
+
+import configparser
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from psycopg2.extensions import make_dsn
+
+CONFIG_FILE = "config/params.ini"
+# replaced to ask every worker to reload its settings
+GENERATION_FILE = os.getenv(
+    "SETTINGS_GENERATION_FILE", "/tmp/deviceregistrationapi-settings.generation"
+)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuration of DeviceRegistrationAPI"""
+
+    # Token to get access to this api, this is equal to userKey
+    user_key: str
+
+    # DATABASE section & ENV
+    db_name: str
+    db_table: str
+    db_user: str
+    db_password: str
+    db_host: str
+    db_port: str
+    db_dsn: str
+    db_connect_timeout: int
+    db_pool_min_size: int
+    db_pool_max_size: int
+    db_pool_max_lifetime: float
+    db_pool_health_check_interval: float
+    db_pool_checkout_timeout: float
+    db_counter_shards: int
+    db_device_type_layout: str
+    db_notify_counts: bool
+
+    # BATCH section
+    batch_max_events: int
+
+    # WRITE_BEHIND section
+    write_behind_enabled: bool
+    write_behind_durability: str
+    write_behind_max_queue: int
+    write_behind_flush_max_rows: int
+    write_behind_flush_interval_ms: int
+    write_behind_enqueue_timeout_ms: int
+    write_behind_commit_timeout_ms: int
+    write_behind_retry_after: str
+
+    # SPOOL section
+    spool_enabled: bool
+    spool_dir: str
+    spool_max_bytes: int
+    spool_segment_bytes: int
+    spool_fsync: bool
+    spool_replay_interval: float
+    spool_replay_batch: int
+    spool_replay_rate: int
+
+    # PARTITIONING section
+    partition_enabled: bool
+    partition_interval: str
+    partition_premake: int
+    partition_retention: int
+    partition_retention_drop: bool
+
+    # PROFILING section
+    profiling_enabled: bool
+    profiling_sample_rate: float
+    profiling_header: bool
+    profiling_dir: str
+    profiling_slow_ms: float
+    profiling_max_files: int
+
+    # ADMISSION section
+    admission_enabled: bool
+    admission_path: str
+    admission_slots: int
+    admission_health_routes: tuple
+    admission_max_in_flight: int
+    admission_max_reads: int
+    admission_route_limits: tuple
+    admission_read_max_queue_ms: float
+    admission_write_max_queue_ms: float
+    admission_pool_max_waiting: int
+    admission_pool_timeout_seconds: float
+    admission_pool_exempt_routes: tuple
+    admission_retry_after: str
+
+
+def load_settings(config_file=CONFIG_FILE) -> Settings:
+    """
+    Read the configuration file and ENV variables
+    :param str config_file: path of the configuration file
+    :return: Settings
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    conf_db = config["DATABASE"]
+    conf_batch = config["BATCH"]
+    conf_write_behind = config["WRITE_BEHIND"]
+    conf_spool = config["SPOOL"]
+    conf_partitioning = config["PARTITIONING"]
+    conf_profiling = config["PROFILING"]
+    conf_admission = config["ADMISSION"]
+
+    db_name = os.getenv("DATABASE_NAME", conf_db.get("NAME"))
+    db_user = os.getenv("DATABASE_USER", conf_db.get("USER"))
+    db_password = os.getenv("DATABASE_PASSWORD", conf_db.get("PASSWORD"))
+    db_host = os.getenv("DATABASE_HOST", conf_db.get("HOST"))
+    db_port = os.getenv("DATABASE_PORT", conf_db.get("PORT"))
+    db_connect_timeout = conf_db.getint("CONNECT_TIMEOUT", 5)
+
+    return Settings(
+        user_key=os.getenv("DEVICEREGISTRATION_USER_KEY"),
+        db_name=db_name,
+        db_table=conf_db.get("TABLE", "devices"),
+        db_user=db_user,
+        db_password=db_password,
+        db_host=db_host,
+        db_port=db_port,
+        db_dsn=make_dsn(
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port,
+            connect_timeout=db_connect_timeout,
+        ),
+        db_connect_timeout=db_connect_timeout,
+        db_pool_min_size=conf_db.getint("POOL_MIN_SIZE", 1),
+        db_pool_max_size=conf_db.getint("POOL_MAX_SIZE", 5),
+        db_pool_max_lifetime=conf_db.getfloat("POOL_MAX_LIFETIME", 3600),
+        db_pool_health_check_interval=conf_db.getfloat(
+            "POOL_HEALTH_CHECK_INTERVAL", 30
+        ),
+        db_pool_checkout_timeout=conf_db.getfloat("POOL_CHECKOUT_TIMEOUT", 5),
+        db_counter_shards=conf_db.getint("COUNTER_SHARDS", 8),
+        db_device_type_layout=conf_db.get("DEVICE_TYPE_LAYOUT", "inline"),
+        db_notify_counts=conf_db.getboolean("NOTIFY_COUNTS", False),
+        batch_max_events=conf_batch.getint("MAX_EVENTS", 1000),
+        write_behind_enabled=conf_write_behind.getboolean("ENABLED", False),
+        write_behind_durability=conf_write_behind.get("DURABILITY", "commit"),
+        write_behind_max_queue=conf_write_behind.getint("MAX_QUEUE", 10000),
+        write_behind_flush_max_rows=conf_write_behind.getint("FLUSH_MAX_ROWS", 500),
+        write_behind_flush_interval_ms=conf_write_behind.getint(
+            "FLUSH_INTERVAL_MS", 10
+        ),
+        write_behind_enqueue_timeout_ms=conf_write_behind.getint(
+            "ENQUEUE_TIMEOUT_MS", 100
+        ),
+        write_behind_commit_timeout_ms=conf_write_behind.getint(
+            "COMMIT_TIMEOUT_MS", 5000
+        ),
+        write_behind_retry_after=conf_write_behind.get("RETRY_AFTER", "1"),
+        spool_enabled=conf_spool.getboolean("ENABLED", False),
+        spool_dir=conf_spool.get("DIR", "/var/spool/safra"),
+        spool_max_bytes=conf_spool.getint("MAX_BYTES", 104857600),
+        spool_segment_bytes=conf_spool.getint("SEGMENT_BYTES", 1048576),
+        spool_fsync=conf_spool.getboolean("FSYNC", True),
+        spool_replay_interval=conf_spool.getfloat("REPLAY_INTERVAL", 1),
+        spool_replay_batch=conf_spool.getint("REPLAY_BATCH", 500),
+        spool_replay_rate=conf_spool.getint("REPLAY_RATE", 1000),
+        partition_enabled=conf_partitioning.getboolean("ENABLED", False),
+        partition_interval=conf_partitioning.get("INTERVAL", "month"),
+        partition_premake=conf_partitioning.getint("PREMAKE", 3),
+        partition_retention=conf_partitioning.getint("RETENTION", 0),
+        partition_retention_drop=conf_partitioning.getboolean("RETENTION_DROP", False),
+        profiling_enabled=conf_profiling.getboolean("ENABLED", False),
+        profiling_sample_rate=conf_profiling.getfloat("SAMPLE_RATE", 0.01),
+        profiling_header=conf_profiling.getboolean("HEADER", True),
+        profiling_dir=conf_profiling.get("DIR", "/tmp/deviceregistrationapi-profiles"),
+        profiling_slow_ms=conf_profiling.getfloat("SLOW_MS", 100),
+        profiling_max_files=conf_profiling.getint("MAX_FILES", 200),
+        admission_enabled=conf_admission.getboolean("ENABLED", False),
+        admission_path=conf_admission.get("PATH", "/dev/shm/deviceregistrationapi-in-flight"),
+        admission_slots=conf_admission.getint("SLOTS", 64),
+        admission_health_routes=tuple(
+            route.strip()
+            for route in conf_admission.get(
+                "HEALTH_ROUTES", "/api/status, /metrics"
+            ).split(",")
+            if route.strip()
+        ),
+        admission_max_in_flight=conf_admission.getint("MAX_IN_FLIGHT", 0),
+        admission_max_reads=conf_admission.getint("MAX_READS", 0),
+        # rule=limit separated by commas, e.g. /Device/register/batch=4
+        admission_route_limits=tuple(
+            (route.strip(), int(limit))
+            for route, _, limit in (
+                item.rpartition("=")
+                for item in conf_admission.get("ROUTE_LIMITS", "").split(",")
+            )
+            if route.strip()
+        ),
+        admission_read_max_queue_ms=conf_admission.getfloat("READ_MAX_QUEUE_MS", 0),
+        admission_write_max_queue_ms=conf_admission.getfloat("WRITE_MAX_QUEUE_MS", 0),
+        admission_pool_max_waiting=conf_admission.getint("POOL_MAX_WAITING", 0),
+        admission_pool_timeout_seconds=conf_admission.getfloat("POOL_TIMEOUT_SECONDS", 0),
+        admission_pool_exempt_routes=tuple(
+            route.strip()
+            for route in conf_admission.get("POOL_EXEMPT_ROUTES", "").split(",")
+            if route.strip()
+        ),
+        admission_retry_after=conf_admission.get("RETRY_AFTER", "1"),
+    )
+
+
+def _read_generation() -> tuple:
+    """Identity of the generation file, None when no reload was ever requested"""
+    try:
+        stat = os.stat(GENERATION_FILE)
+    except FileNotFoundError:
+        return None
+    # the file is replaced, not written: a new inode even within the resolution of mtime
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+_settings = load_settings()
+_generation = _read_generation()
+# reentrant: a reload may be requested by a signal handler while the thread reloads
+_reload_lock = threading.RLock()
+_reload_callbacks = []
+
+
+def get_settings() -> Settings:
+    """Return the current settings of the process"""
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """
+    Reload the settings from the configuration file and ENV variables of the process, then call
+    the functions registered with on_reload(). Other objects built from the settings
+    (e.g., connection pools) keep their sizing until the worker restarts.
+    :return: the new Settings
+    """
+    global _settings
+
+    # the reference is swapped at once, requests being served keep a consistent object
+    _settings = load_settings()
+    for callback in _reload_callbacks:
+        try:
+            callback(_settings)
+        except Exception as err:
+            print("[Exception] unable to apply the reloaded settings:", err)
+    return _settings
+
+
+def on_reload(callback):
+    """
+    Register a function called with the new settings after every reload of the process
+    :param callable callback: function of the Settings, e.g. rebuilding a cache
+    """
+    _reload_callbacks.append(callback)
+
+
+def request_reload():
+    """Ask every worker of the host to reload its settings, at its next request"""
+    tmp_path = "{}.{}.tmp".format(GENERATION_FILE, os.getpid())
+    with open(tmp_path, "w") as generation_file:
+        generation_file.write(str(time.time_ns()))
+    os.replace(tmp_path, GENERATION_FILE)
+
+
+def check_generation() -> bool:
+    """
+    Reload the settings of the worker when a reload was requested since they were loaded
+    :return bool: True if the settings were reloaded
+    """
+    global _generation
+
+    generation = _read_generation()
+    if generation == _generation:
+        return False
+
+    with _reload_lock:
+        if generation == _generation:
+            return False
+        # a reload requested meanwhile changes the generation again, it is not missed
+        _generation = generation
+        reload_settings()
+
+    return True
+
+
+def instrument(app):
+    """
+    Reload the settings of the worker before a request, when a reload was requested
+    :param Flask app: application whose requests check the generation of the settings
+    """
+    wsgi_app = app.wsgi_app
+
+    def reloading_wsgi_app(environ, start_response):
+        check_generation()
+        return wsgi_app(environ, start_response)
+
+    app.wsgi_app = reloading_wsgi_app
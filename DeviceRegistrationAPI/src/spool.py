@@ -0,0 +1,406 @@
+"""
+This module implements a durable local spool of the registrations which could not be written to
+the database (e.g., database down or slow, write-behind queue full), replayed once it recovers.
+
+Rows are appended to segment files of a directory shared by the workers. Each record is framed as
+<length (4 bytes), crc32 (4 bytes), JSON of the row>, so a torn or corrupted record is detected
+when the segment is read back. Each worker appends to its own open segment (<time>-<pid>.open),
+holding an exclusive flock on it; the segment is sealed (renamed to .seg) when it is full or by
+the replayer thread of the worker every REPLAY_INTERVAL seconds. The replayer thread of every
+worker drains sealed segments, and the open segments of dead workers, in groups of REPLAY_BATCH
+rows at most REPLAY_RATE rows per second; a flock on replay.lock elects one replayer at a time.
+The offset replayed in a segment is kept in <segment>.offset, thus a row is replayed at least once.
+A group the writer can't write (it returns False, e.g. invalid data) is bisected down to the rows
+it refuses, which are set aside in <segment>.quarantine (records of the same format) so the rows
+after them are replayed; a group failing with an exception (e.g., DB unavailable) is retried at
+the next replay.
+
+* SpoolFullError --> raised when the spool reached MAX_BYTES
+* Spool --> appends rows to segments, and the thread replaying them
+* get_spool() --> returns the spool of the current worker process, started after fork
+* get_spool_stats() --> returns depth & counters of the spool of the worker
+
+@author: MMB
+"""
+
+import atexit
+import fcntl
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+
+HEADER = struct.Struct("<II")
+NEW_SUFFIX = ".new"
+OPEN_SUFFIX = ".open"
+SEALED_SUFFIX = ".seg"
+OFFSET_SUFFIX = ".offset"
+CORRUPT_SUFFIX = ".corrupt"
+QUARANTINE_SUFFIX = ".quarantine"
+REPLAY_LOCK = "replay.lock"
+
+
+class SpoolFullError(Exception):
+    """The spool reached its maximum size."""
+
+
+def encode_record(row) -> bytes:
+    """Frame a row as a record: length & crc32 of the payload, then the payload"""
+    payload = json.dumps(list(row), separators=(",", ":")).encode()
+    return HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def decode_records(data, offset=0):
+    """
+    Read the records of a segment
+    :param bytes data: content of the segment
+    :param int offset: position of the first record to read
+    :return generator: (end offset of the record, row), stops at the first torn or corrupt record
+    """
+    while offset + HEADER.size <= len(data):
+        length, crc = HEADER.unpack_from(data, offset)
+        start = offset + HEADER.size
+        payload = data[start : start + length]
+        if len(payload) < length or zlib.crc32(payload) != crc:
+            return
+        offset = start + length
+        yield (offset, tuple(json.loads(payload)))
+
+
+class Spool:
+    """Segment files of failed rows and their replayer thread"""
+
+    def __init__(
+        self,
+        directory,
+        writer,
+        max_bytes=100 * 1024 * 1024,
+        segment_bytes=1024 * 1024,
+        fsync=True,
+        replay_interval=1,
+        replay_batch=500,
+        replay_rate=1000,
+        on_replay=None,
+        on_quarantine=None,
+    ):
+        """
+        :param str directory: directory of the segments, shared by the workers
+        :param callable writer: function writing a list of rows in one transaction, returns False
+        when they can't be written, raises when they may be later
+        :param int max_bytes: size of the segments above which rows are refused
+        :param int segment_bytes: size above which the open segment is sealed
+        :param bool fsync: flush every appended row to disk before append() returns
+        :param float replay_interval: seconds between two replays
+        :param int replay_batch: maximum number of rows written in one transaction
+        :param int replay_rate: maximum rows replayed per second, 0 for no limit
+        :param on_replay: called with (rows, None) after every group replayed, and with
+        (0, bytes of the spool) after every replay
+        :param on_quarantine: called with the number of rows refused by the writer, set aside
+        """
+        self.directory = directory
+        self.writer = writer
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        self.replay_interval = replay_interval
+        self.replay_batch = replay_batch
+        self.replay_rate = replay_rate
+        self.on_replay = on_replay
+        self.on_quarantine = on_quarantine
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._fd = None
+        self._path = None
+        self._size = 0
+        self._bytes = self._scan()[0]
+        self._stopping = threading.Event()
+        self._stats = {
+            "appended": 0,
+            "rejected": 0,
+            "replayed": 0,
+            "replay_failures": 0,
+            "quarantined": 0,
+            "corrupt_segments": 0,
+            "replay_rate": 0.0,
+        }
+
+        self._thread = threading.Thread(
+            target=self._run, name="spool-replayer", daemon=True
+        )
+        self._thread.start()
+
+    def _scan(self) -> (int, list):
+        """Bytes of the segments (corrupt ones excluded) & sealed segments, oldest first"""
+        total = 0
+        sealed = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith((OPEN_SUFFIX, SEALED_SUFFIX)):
+                total += entry.stat().st_size
+            if entry.name.endswith(SEALED_SUFFIX):
+                sealed.append(entry.name)
+        return (total, sorted(sealed))
+
+    def _open_segment(self):
+        name = "{:020d}-{}".format(time.time_ns(), os.getpid())
+        path = os.path.join(self.directory, name + OPEN_SUFFIX)
+        new_path = os.path.join(self.directory, name + NEW_SUFFIX)
+        fd = os.open(new_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        # held as long as the segment is open: a replayer never reads a segment being appended.
+        # The segment is only named .open once locked, so it is never taken for an orphan.
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        os.rename(new_path, path)
+        self._fd, self._path, self._size = fd, path, 0
+
+    def _seal(self):
+        """Seal the open segment, the lock being held"""
+        if self._fd is None:
+            return
+        if self._size:
+            os.rename(self._path, self._path[: -len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        else:
+            os.unlink(self._path)
+        os.close(self._fd)
+        self._fd, self._path, self._size = None, None, 0
+
+    def append(self, rows):
+        """
+        Append rows to the spool, durable on return when fsync is enabled
+        :param list rows: tuples of data, as given to the writer
+        :raise SpoolFullError: when the spool reached its maximum size
+        """
+        data = b"".join(encode_record(row) for row in rows)
+        with self._lock:
+            if self._bytes + len(data) > self.max_bytes:
+                self._stats["rejected"] += len(rows)
+                raise SpoolFullError(
+                    "Spool is full ({} bytes)".format(self.max_bytes)
+                )
+
+            if self._fd is None:
+                self._open_segment()
+            os.write(self._fd, data)
+            if self.fsync:
+                os.fsync(self._fd)
+            self._size += len(data)
+            self._bytes += len(data)
+            self._stats["appended"] += len(rows)
+
+            if self._size >= self.segment_bytes:
+                self._seal()
+
+    def _orphans(self):
+        """Seal the open segments of dead workers, i.e. whose flock is free"""
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(OPEN_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.rename(path, path[: -len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+            except (BlockingIOError, FileNotFoundError):
+                pass
+            finally:
+                os.close(fd)
+
+    @staticmethod
+    def _save_offset(offset_path, offset):
+        with open(offset_path + ".tmp", "w") as offset_file:
+            offset_file.write(str(offset))
+        os.replace(offset_path + ".tmp", offset_path)
+
+    def _quarantine(self, name, rows):
+        """Set aside rows refused by the writer, in <segment>.quarantine"""
+        path = os.path.join(self.directory, name + QUARANTINE_SUFFIX)
+        print("[Spool] {} rows of {} refused by the writer, kept in {}".format(len(rows), name, path))
+        with open(path, "ab") as quarantine:
+            quarantine.write(b"".join(encode_record(row) for row in rows))
+            if self.fsync:
+                os.fsync(quarantine.fileno())
+        with self._lock:
+            self._stats["quarantined"] += len(rows)
+        if self.on_quarantine is not None:
+            self.on_quarantine(len(rows))
+
+    def _write(self, name, offset_path, group) -> bool:
+        """
+        Write a group of records, bisecting it down to the rows refused by the writer
+        :param list group: (end offset of the record, row)
+        :return bool: True once every row is written or set aside, False if the writer failed
+        """
+        rows = [row for _, row in group]
+        try:
+            written = self.writer(rows)
+        except Exception as err:
+            print("[Spool] replay of {} failed: {}".format(name, err))
+            with self._lock:
+                self._stats["replay_failures"] += 1
+            return False
+
+        if not written:
+            if len(group) > 1:
+                half = len(group) // 2
+                return self._write(name, offset_path, group[:half]) and self._write(
+                    name, offset_path, group[half:]
+                )
+            self._quarantine(name, rows)
+        else:
+            with self._lock:
+                self._stats["replayed"] += len(rows)
+            if self.on_replay is not None:
+                self.on_replay(len(rows), None)
+
+        # the offset is saved after the commit: a crash in between replays the rows again
+        self._save_offset(offset_path, group[-1][0])
+        return True
+
+    def _replay_segment(self, name) -> bool:
+        """Write the rows of a sealed segment, return True once it is fully replayed"""
+        path = os.path.join(self.directory, name)
+        offset_path = path + OFFSET_SUFFIX
+        try:
+            with open(offset_path) as offset_file:
+                offset = int(offset_file.read() or 0)
+        except FileNotFoundError:
+            offset = 0
+        with open(path, "rb") as segment:
+            data = segment.read()
+
+        records = decode_records(data, offset)
+        while True:
+            group = []
+            for record in records:
+                group.append(record)
+                if len(group) >= self.replay_batch:
+                    break
+            if not group:
+                break
+
+            start = time.monotonic()
+            if not self._write(name, offset_path, group):
+                return False
+            offset = group[-1][0]
+
+            elapsed = time.monotonic() - start
+            if self.replay_rate:
+                pause = len(group) / self.replay_rate - elapsed
+                if pause > 0:
+                    self._stopping.wait(pause)
+                    elapsed += pause
+            with self._lock:
+                self._stats["replay_rate"] = round(len(group) / max(elapsed, 1e-6), 1)
+
+        if offset < len(data):
+            # torn tail of a worker killed while appending, or corrupted bytes
+            print(
+                "[Spool] {} bytes of {} can't be read, kept as {}".format(
+                    len(data) - offset, name, name + CORRUPT_SUFFIX
+                )
+            )
+            os.rename(path, path + CORRUPT_SUFFIX)
+            with self._lock:
+                self._stats["corrupt_segments"] += 1
+        else:
+            os.unlink(path)
+        try:
+            os.unlink(offset_path)
+        except FileNotFoundError:
+            pass
+
+        return True
+
+    def replay(self):
+        """Seal the segment of the worker and, when elected, replay the sealed segments"""
+        with self._lock:
+            self._seal()
+
+        lock_fd = os.open(
+            os.path.join(self.directory, REPLAY_LOCK), os.O_RDWR | os.O_CREAT, 0o644
+        )
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # another worker is replaying
+                return
+
+            self._orphans()
+            for name in self._scan()[1]:
+                if self._stopping.is_set() or not self._replay_segment(name):
+                    break
+        finally:
+            os.close(lock_fd)
+            total = self._scan()[0]
+            with self._lock:
+                self._bytes = total
+            if self.on_replay is not None:
+                self.on_replay(0, total)
+
+    def _run(self):
+        while not self._stopping.wait(self.replay_interval):
+            try:
+                self.replay()
+            except Exception as err:
+                print("[Exception] spool replay failed:", err)
+
+    def close(self, timeout=10):
+        """Stop replaying & seal the open segment, e.g. when the worker exits"""
+        self._stopping.set()
+        self._thread.join(timeout)
+        with self._lock:
+            self._seal()
+
+    def stats(self) -> dict:
+        """Return depth & counters of the spool"""
+        total, sealed = self._scan()
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(
+            {
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "sealed_segments": len(sealed),
+            }
+        )
+        return stats
+
+
+_spool = None
+_spool_pid = None
+_spool_lock = threading.Lock()
+
+
+def get_spool(directory, writer, **spool_kwargs) -> Spool:
+    """
+    Return the spool of the current process, created (with its thread) after fork.
+    The open segment is sealed when the process exits.
+    :param str directory: directory of the segments, shared by the workers
+    :param callable writer: function writing a list of rows in one transaction, see Spool
+    :param spool_kwargs: parameters of Spool, used when the spool is created
+    :return: Spool
+    """
+    global _spool, _spool_pid
+
+    with _spool_lock:
+        if _spool_pid != os.getpid():
+            _spool = Spool(directory, writer, **spool_kwargs)
+            _spool_pid = os.getpid()
+            atexit.register(_spool.close)
+
+        return _spool
+
+
+def get_spool_stats() -> dict:
+    """Return depth & counters of the spool of the current process, None if there is none"""
+    with _spool_lock:
+        if _spool_pid != os.getpid():
+            return None
+        spool = _spool
+
+    return spool.stats()
@@ -0,0 +1,289 @@
+"""
+This module implements a write-behind buffer grouping the inserts of a worker into fewer commits.
+Rows are put on a bounded in-process queue, and a background flusher writes them in groups,
+every FLUSH_INTERVAL_MS milliseconds or FLUSH_MAX_ROWS rows, whichever comes first.
+
+Two durability policies are supported:
+* commit --> submit() returns once the group containing the row is committed (group commit).
+  A row still queued when COMMIT_TIMEOUT_MS elapses is cancelled, i.e. never written by the
+  flusher (CommitTimeoutError); a row already being written is reported as pending.
+* enqueue --> submit() returns as soon as the row is queued, rows are lost if the process crashes
+
+Queued rows are flushed when the worker exits: through uwsgi.atexit under uWSGI, atexit otherwise
+(exit_on_sigterm() turns SIGTERM into a normal exit outside of uWSGI).
+
+* WriteBuffer --> the queue and its flusher thread
+* get_buffer() --> returns the buffer of the current worker process, started after fork
+* exit_on_sigterm() --> exit normally on SIGTERM, so the buffer is flushed (not under uWSGI)
+
+@author: MMB
+"""
+
+import atexit
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+
+try:
+    # only importable in a process run by uWSGI
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+DURABILITY_COMMIT = "commit"
+DURABILITY_ENQUEUE = "enqueue"
+# put on the queue by close(), wakes up the flusher waiting for rows
+_WAKE_UP = (None, None)
+
+
+class BufferFullError(Exception):
+    """The queue stayed full during the enqueue timeout (backpressure)."""
+
+
+class CommitTimeoutError(Exception):
+    """The row was still queued when the commit timeout elapsed, it is not written."""
+
+
+class _Waiter:
+    """Completion of a row submitted with the commit durability policy"""
+
+    __slots__ = ("event", "result", "taken", "cancelled")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = False
+        # taken by the flusher for a group, or given up by submit(); guarded by the buffer lock
+        self.taken = False
+        self.cancelled = False
+
+
+class WriteBuffer:
+    """Bounded queue of rows committed in groups by a background thread"""
+
+    def __init__(
+        self,
+        writer,
+        durability=DURABILITY_COMMIT,
+        max_queue=10000,
+        flush_max_rows=500,
+        flush_interval_ms=10,
+        enqueue_timeout_ms=100,
+        commit_timeout_ms=5000,
+    ):
+        """
+        :param callable writer: function writing a list of rows in one transaction, returns True
+        once written, False if they are not written, None if they are kept elsewhere (e.g. spooled)
+        :param str durability: commit or enqueue, see module documentation
+        :param int max_queue: maximum number of rows waiting to be written
+        :param int flush_max_rows: maximum number of rows written in one group
+        :param int flush_interval_ms: maximum time a row waits for its group to fill up
+        :param int enqueue_timeout_ms: time to wait for room in a full queue before rejecting a row
+        :param int commit_timeout_ms: time to wait for the commit of a row (commit durability)
+        """
+        self.writer = writer
+        self.durability = durability
+        self.flush_max_rows = flush_max_rows
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.enqueue_timeout = enqueue_timeout_ms / 1000.0
+        self.commit_timeout = commit_timeout_ms / 1000.0
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stopping = threading.Event()
+        self._waiters_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "submitted": 0,
+            "rejected": 0,
+            "cancelled": 0,
+            "flushes": 0,
+            "flushed_rows": 0,
+            "failed_rows": 0,
+        }
+
+        self._thread = threading.Thread(
+            target=self._run, name="write-buffer-flusher", daemon=True
+        )
+        self._thread.start()
+
+    def _count(self, key, value=1):
+        with self._stats_lock:
+            self._stats[key] += value
+
+    def submit(self, row) -> bool:
+        """
+        Queue a row to be written
+        :param tuple row: data of the row
+        :return bool: True if the row is queued (enqueue) or committed (commit), False if it is
+        not written, None if it was being written when the commit timeout elapsed, or was kept
+        elsewhere by the writer
+        :raise BufferFullError: when the queue is full (backpressure)
+        :raise CommitTimeoutError: when the row was cancelled before the flusher took it
+        """
+        if self._stopping.is_set():
+            return False
+
+        waiter = _Waiter() if self.durability == DURABILITY_COMMIT else None
+        try:
+            self._queue.put((row, waiter), timeout=self.enqueue_timeout)
+        except queue.Full:
+            self._count("rejected")
+            raise BufferFullError(
+                "Write buffer is full ({} rows)".format(self._queue.maxsize)
+            )
+
+        self._count("submitted")
+        if waiter is None:
+            return True
+
+        if waiter.event.wait(self.commit_timeout):
+            return waiter.result
+
+        with self._waiters_lock:
+            if not waiter.taken:
+                # still queued: the flusher skips it, the caller may write it elsewhere
+                waiter.cancelled = True
+                self._count("cancelled")
+                raise CommitTimeoutError(
+                    "Row not written within {}s".format(self.commit_timeout)
+                )
+
+        # its group is being written, the row may still be committed
+        return waiter.result if waiter.event.is_set() else None
+
+    def _next_group(self) -> list:
+        """Wait for a first row, then gather rows until the group is full or the interval elapsed"""
+        try:
+            group = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.flush_interval
+        while len(group) < self.flush_max_rows:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining > 0 and not self._stopping.is_set():
+                    group.append(self._queue.get(timeout=remaining))
+                else:
+                    group.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+
+        return group
+
+    def _run(self):
+        while not (self._stopping.is_set() and self._queue.empty()):
+            group = [item for item in self._next_group() if item is not _WAKE_UP]
+            with self._waiters_lock:
+                for _, waiter in group:
+                    if waiter is not None:
+                        waiter.taken = True
+                group = [
+                    (row, waiter)
+                    for row, waiter in group
+                    if waiter is None or not waiter.cancelled
+                ]
+            if not group:
+                continue
+
+            try:
+                res = self.writer([row for row, _ in group])
+            except Exception as err:
+                print("[Exception] write buffer flush failed:", err)
+                res = False
+
+            self._count("flushes")
+            self._count("failed_rows" if res is False else "flushed_rows", len(group))
+            if res is False and self.durability == DURABILITY_ENQUEUE:
+                print("[Exception] {} acknowledged rows were not written".format(len(group)))
+
+            for _, waiter in group:
+                if waiter is not None:
+                    waiter.result = res
+                    waiter.event.set()
+
+    def close(self, timeout=10):
+        """Stop accepting rows and flush the queued ones, e.g. when the worker exits"""
+        self._stopping.set()
+        try:
+            self._queue.put_nowait(_WAKE_UP)
+        except queue.Full:
+            # the flusher doesn't wait for rows
+            pass
+        self._thread.join(timeout)
+
+    def stats(self) -> dict:
+        """Return the counters of the buffer"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats.update(
+            {
+                "queued": self._queue.qsize(),
+                "max_queue": self._queue.maxsize,
+                "durability": self.durability,
+            }
+        )
+        return stats
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer(writer, **buffer_kwargs) -> WriteBuffer:
+    """
+    Return the write buffer of the current process, created (with its thread) after fork.
+    The buffer is flushed when the process exits, e.g. when uWSGI stops on SIGTERM (--die-on-term).
+    :param callable writer: function writing a list of rows in one transaction
+    :param buffer_kwargs: parameters of WriteBuffer, used when the buffer is created
+    :return: WriteBuffer
+    """
+    global _buffer, _buffer_pid
+
+    with _buffer_lock:
+        if _buffer_pid != os.getpid():
+            _buffer = WriteBuffer(writer, **buffer_kwargs)
+            _buffer_pid = os.getpid()
+            _at_exit(_buffer.close)
+
+        return _buffer
+
+
+def _at_exit(func):
+    """Call func when the worker exits, uWSGI ending its workers without the atexit hooks"""
+    atexit.register(func)
+    if uwsgi is not None:
+        previous = getattr(uwsgi, "atexit", None)
+
+        def hook():
+            func()
+            if previous is not None:
+                previous()
+
+        uwsgi.atexit = hook
+
+
+def exit_on_sigterm():
+    """
+    Exit through SystemExit on SIGTERM, which runs the atexit hooks (e.g., flush of the buffer)
+    instead of killing the process. Not installed under uWSGI, which handles SIGTERM itself.
+    Must be called from the main thread.
+    """
+    if uwsgi is not None:
+        return
+
+    def handler(signum, frame):
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, handler)
+
+
+def get_buffer_stats() -> dict:
+    """Return the counters of the buffer of the current process, None if there is none"""
+    with _buffer_lock:
+        if _buffer_pid != os.getpid():
+            return None
+        return _buffer.stats()
@@ -0,0 +1,82 @@
+"""
+Tests of the spool (src/spool.py), run from DeviceRegistrationAPI/:
+python -m unittest discover tests
+
+@author: MMB
+"""
+import os
+import tempfile
+import unittest
+
+from src import spool
+
+
+class SpoolTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.written = []
+        self.unavailable = False
+
+    def tearDown(self):
+        self.spool.close()
+        self.directory.cleanup()
+
+    def write_rows(self, rows):
+        # the DB refuses the "bad" row, and every group containing it
+        if self.unavailable:
+            raise ConnectionError("DB unavailable")
+        if ("bad",) in rows:
+            return False
+        self.written.extend(rows)
+        return True
+
+    def make_spool(self, **spool_kwargs):
+        self.spool = spool.Spool(
+            self.directory.name,
+            self.write_rows,
+            fsync=False,
+            replay_interval=3600,
+            replay_rate=0,
+            **spool_kwargs
+        )
+        return self.spool
+
+    def test_rows_after_a_refused_row_are_replayed(self):
+        quarantined = []
+        rows = [("IOS",), ("bad",), ("Android",), ("Linux",), ("Windows",)]
+        spooled = self.make_spool(replay_batch=4, on_quarantine=quarantined.append)
+        spooled.append(rows)
+        spooled.replay()
+
+        self.assertEqual(self.written, [row for row in rows if row != ("bad",)])
+        self.assertEqual(quarantined, [1])
+        self.assertEqual(spooled.stats()["quarantined"], 1)
+        self.assertEqual(spooled.stats()["sealed_segments"], 0)
+
+        (name,) = [
+            name
+            for name in os.listdir(self.directory.name)
+            if name.endswith(spool.QUARANTINE_SUFFIX)
+        ]
+        with open(os.path.join(self.directory.name, name), "rb") as quarantine:
+            records = list(spool.decode_records(quarantine.read()))
+        self.assertEqual([row for _, row in records], [("bad",)])
+
+    def test_rows_are_kept_while_the_writer_fails(self):
+        spooled = self.make_spool()
+        spooled.append([("IOS",), ("Android",)])
+        self.unavailable = True
+        spooled.replay()
+
+        self.assertEqual(self.written, [])
+        self.assertEqual(spooled.stats()["sealed_segments"], 1)
+        self.assertEqual(spooled.stats()["quarantined"], 0)
+
+        self.unavailable = False
+        spooled.replay()
+        self.assertEqual(self.written, [("IOS",), ("Android",)])
+        self.assertEqual(spooled.stats()["sealed_segments"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+"""
+Tests of the write-behind buffer (src/write_buffer.py), run from DeviceRegistrationAPI/:
+python -m unittest discover tests
+
+@author: MMB
+"""
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import unittest
+
+from src import write_buffer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# a worker queuing a row, then stopped with SIGTERM before its flusher runs
+WORKER = textwrap.dedent(
+    """
+    import sys, time
+    from src import write_buffer
+
+    def write_rows(rows):
+        with open(sys.argv[1], "a") as output:
+            output.writelines(row[0] + "\\n" for row in rows)
+        return True
+
+    write_buffer.exit_on_sigterm()
+    buffer = write_buffer.get_buffer(
+        write_rows, durability=write_buffer.DURABILITY_ENQUEUE, flush_interval_ms=60000
+    )
+    buffer.submit(("IOS",))
+    print("queued", flush=True)
+    time.sleep(60)
+    """
+)
+
+
+class WriteBufferTest(unittest.TestCase):
+    def test_queued_row_is_committed_on_sigterm(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "rows")
+            worker = subprocess.Popen(
+                [sys.executable, "-c", WORKER, output],
+                cwd=ROOT,
+                env=dict(os.environ, PYTHONPATH=ROOT),
+                stdout=subprocess.PIPE,
+                text=True,
+            )
+            try:
+                self.assertEqual(worker.stdout.readline().strip(), "queued")
+                worker.send_signal(signal.SIGTERM)
+                worker.wait(10)
+            finally:
+                worker.kill()
+                worker.stdout.close()
+
+            with open(output) as rows:
+                self.assertEqual(rows.read(), "IOS\n")
+
+    def test_row_queued_at_timeout_is_not_written(self):
+        written = []
+        release = threading.Event()
+
+        def write_rows(rows):
+            # the first group blocks the flusher, the next rows stay queued
+            release.wait(5)
+            written.extend(rows)
+            return True
+
+        buffer = write_buffer.WriteBuffer(
+            write_rows, flush_max_rows=1, flush_interval_ms=1, commit_timeout_ms=50
+        )
+        first = threading.Thread(target=buffer.submit, args=(("first",),))
+        first.start()
+        time.sleep(0.05)
+
+        with self.assertRaises(write_buffer.CommitTimeoutError):
+            buffer.submit(("second",))
+        release.set()
+        first.join()
+        buffer.close()
+
+        self.assertEqual(written, [("first",)])
+        self.assertEqual(buffer.stats()["cancelled"], 1)
+
+    def test_row_being_written_at_timeout_is_pending(self):
+        release = threading.Event()
+
+        def write_rows(rows):
+            release.wait(5)
+            return True
+
+        buffer = write_buffer.WriteBuffer(
+            write_rows, flush_interval_ms=1, commit_timeout_ms=50
+        )
+        self.assertIsNone(buffer.submit(("IOS",)))
+        release.set()
+        buffer.close()
+
+        self.assertEqual(buffer.stats()["flushed_rows"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,316 @@
+"""
+This module is the ASGI entry point of StatisticsAPI, an alternative to src/wsgi.py.
+Login events received on /Log/auth are forwarded to DeviceRegistrationAPI by a non-blocking
+handler, so a single process holds many in-flight forwards while DeviceRegistrationAPI answers;
+every other route is served by the Flask application in a thread pool. As for the routes of the
+Flask application, the forwards are admitted or shed (src/admission.py), profiled (src/profiler.py),
+and answered with 500 on an unexpected error.
+With DEVICEREGISTRATIONAPI_SOCKET set, the client of the process connects to the unix socket of
+DeviceRegistrationAPI instead of its host & port.
+
+* forward_login_event() --> async version of main.send_login_event(), same responses & status codes
+* post_event() --> POST through the circuit breaker of the process, with the retries of request_handler
+* serve_login_event() --> admit, profile & serve POST /Log/auth
+* app() --> the ASGI application, e.g. `uvicorn src.asgi:app --uds /tmp/uvicorn.sock`
+
+@author: MMB
+"""
+import asyncio
+import json
+import time
+from urllib.parse import urlsplit
+
+import httpx
+from a2wsgi import WSGIMiddleware
+
+from src import admission
+from src import metrics
+from src import profiler
+from src import request_handler
+from src import settings
+from src.main import app as flask_app
+from src.main import (
+    check_authentication_token,
+    circuit_open_response,
+    login_event_response,
+    parse_login_event,
+)
+
+LOGIN_ROUTE = "/Log/auth"
+
+_client = None
+_semaphore = None
+# counted in flight with the routes of the Flask application, in the same order
+_routes = admission.get_routes(flask_app)
+
+wsgi_app = WSGIMiddleware(
+    flask_app, workers=settings.get_settings().async_wsgi_threads
+)
+
+
+def _get_client() -> httpx.AsyncClient:
+    """Return the pooled HTTP client of the process, created in its event loop"""
+    global _client, _semaphore
+
+    if _client is None:
+        conf = settings.get_settings()
+        transport = httpx.AsyncHTTPTransport(
+            verify=False,
+            uds=conf.deviceregistration_socket,
+            limits=httpx.Limits(
+                max_connections=conf.http_pool_maxsize,
+                max_keepalive_connections=conf.http_pool_maxsize
+                if conf.http_keep_alive
+                else 0,
+            ),
+        )
+        _client = httpx.AsyncClient(
+            transport=transport,
+            timeout=httpx.Timeout(
+                conf.http_read_timeout, connect=conf.http_connect_timeout
+            ),
+        )
+        _semaphore = asyncio.Semaphore(conf.async_max_concurrency)
+
+    return _client
+
+
+async def _close_client():
+    global _client
+
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _read_body(receive) -> bytes:
+    body = b""
+    more_body = True
+    while more_body:
+        message = await receive()
+        body += message.get("body", b"")
+        more_body = message.get("more_body", False)
+
+    return body
+
+
+async def _respond(send, data, status, headers=None):
+    body = json.dumps(data).encode()
+    response_headers = [
+        (b"content-type", b"application/json"),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    for key, value in (headers or {}).items():
+        response_headers.append((key.lower().encode(), value.encode()))
+
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": response_headers,
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+async def post_event(url, content, headers) -> httpx.Response:
+    """
+    Send a POST request through the circuit breaker of the process, retrying with a jittered
+    backoff within the deadline of the request, as request_handler does for the WSGI routes
+    :raise CircuitOpenError: when the circuit of the remote host is open
+    :raise httpx.HTTPError: when no response was received
+    """
+    conf = settings.get_settings()
+    client = _get_client()
+    host = request_handler.remote_host(url)
+    parts = urlsplit(url)
+    if parts.scheme == "http+unix":
+        # the transport of the client connects to the socket, the URL only gives the path
+        url = parts._replace(scheme="http", netloc="localhost").geturl()
+    breaker = request_handler.get_breaker(host)
+    deadline = time.monotonic() + conf.http_deadline
+
+    attempt = 0
+    while True:
+        if breaker is not None:
+            try:
+                breaker.before_call()
+            except request_handler.CircuitOpenError:
+                metrics.observe_circuit_rejection(host)
+                raise
+
+        remaining = max(deadline - time.monotonic(), 0.001)
+        timeout = httpx.Timeout(
+            min(conf.http_read_timeout, remaining),
+            connect=min(conf.http_connect_timeout, remaining),
+        )
+        res = None
+        error = None
+        start = time.perf_counter()
+        try:
+            res = await client.post(url, content=content, headers=headers, timeout=timeout)
+        except httpx.HTTPError as err:
+            error = err
+        finally:
+            status = res.status_code if res is not None else "error"
+            metrics.observe_upstream(host, "POST", status, time.perf_counter() - start)
+            if breaker is not None:
+                breaker.record(failed=res is None or res.status_code >= 500)
+
+        if res is not None:
+            if res.status_code not in request_handler.RETRY_STATUS_POST:
+                return res
+            delay = max(
+                request_handler.backoff_delay(attempt),
+                request_handler.retry_after_seconds(res),
+            )
+        else:
+            # a POST which may have reached the server is not sent twice
+            if not isinstance(error, (httpx.ConnectError, httpx.ConnectTimeout)):
+                raise error
+            delay = request_handler.backoff_delay(attempt)
+
+        if attempt >= conf.http_retries or time.monotonic() + delay >= deadline:
+            if res is not None:
+                return res
+            raise error
+
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+async def forward_login_event(scope, receive, send) -> int:
+    """
+    Store information about user login event, without blocking the process meanwhile
+    :return int: status code of the response
+    """
+    body = await _read_body(receive)
+    headers = {key.decode().lower(): value.decode() for key, value in scope["headers"]}
+    recv_api_token = headers.get("userkey")
+
+    if not check_authentication_token(recv_api_token):
+        data = {"ERROR": "Authentication failed", "StatusCode": "403"}
+        await _respond(send, data, 403)
+        return 403
+
+    try:
+        data = parse_login_event(json.loads(body))
+    except (TypeError, ValueError, KeyError):
+        data = {"message": "Invalide JSON data, Key, syntax or value."}
+        await _respond(send, data, 400)
+        return 400
+
+    _get_client()
+    # the concurrency limit bounds the forwards in flight, the others wait for a slot
+    async with _semaphore:
+        try:
+            res = await post_event(
+                settings.get_settings().deviceregistration_url,
+                json.dumps(data),
+                {"Content-Type": "application/json", "userKey": recv_api_token},
+            )
+        except request_handler.CircuitOpenError as err:
+            data, status, headers = circuit_open_response(err)
+            await _respond(send, data, status, headers)
+            return status
+        except httpx.HTTPError:
+            res = None
+
+    if res is None:
+        data = {
+            "message": "Error in request for storing DeviceType [{}]".format(
+                data["deviceType"]
+            )
+        }
+        await _respond(send, data, 500)
+        return 500
+
+    data, status = login_event_response(res.status_code)
+    await _respond(send, data, status)
+    return status
+
+
+def _environ(scope) -> dict:
+    """WSGI keys of a request read by admission control & the profiler"""
+    environ = {"REQUEST_METHOD": scope["method"], "PATH_INFO": scope["path"]}
+    for key, value in scope["headers"]:
+        environ["HTTP_" + key.decode().upper().replace("-", "_")] = value.decode()
+    return environ
+
+
+async def serve_login_event(scope, receive, send) -> int:
+    """
+    Serve POST /Log/auth as the Flask application serves its routes: admitted or shed with 503,
+    profiled, and answered with 500 on an unexpected error
+    :return int: status code of the response
+    """
+    # outside of the Flask application, a reload requested by another worker applies here too
+    settings.check_generation()
+    conf = settings.get_settings()
+    environ = _environ(scope)
+
+    release = None
+    if conf.admission_enabled:
+        limit, release = admission.admit(
+            _routes,
+            LOGIN_ROUTE,
+            scope["method"],
+            admission.request_queued_ms(environ),
+            conf,
+        )
+        if limit is not None:
+            data = {"StatusCode": 503}
+            await _respond(send, data, 503, {"Retry-After": conf.admission_retry_after})
+            return 503
+
+    started = []
+
+    async def tracked_send(message):
+        if message["type"] == "http.response.start":
+            started.append(True)
+        await send(message)
+
+    try:
+        return await profiler.profile_coroutine(
+            environ, forward_login_event(scope, receive, tracked_send)
+        )
+    except Exception as err:
+        print("[Exception] unable to forward login event:", err)
+        if started:
+            raise
+        data = {"ERROR": "Internal server error", "StatusCode": "500"}
+        await _respond(send, data, 500)
+        return 500
+    finally:
+        if release is not None:
+            release()
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _get_client()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await _close_client()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI application of StatisticsAPI"""
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+    elif (
+        scope["type"] == "http"
+        and scope["path"] == LOGIN_ROUTE
+        and scope["method"] == "POST"
+    ):
+        start = time.perf_counter()
+        status = await serve_login_event(scope, receive, send)
+        labels = (LOGIN_ROUTE, "POST", str(status))
+        metrics.REQUESTS.labels(*labels).inc()
+        metrics.REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+    else:
+        await wsgi_app(scope, receive, send)
@@ -0,0 +1,97 @@
+"""
+This module implements a bounded in-process cache, used to answer repeated statistics
+requests without a round trip to the DB.
+
+* TTLCache --> LRU cache whose entries expire after a TTL, and may be served stale while refreshed
+
+@author: MMB
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+# status of a value returned by TTLCache.get_or_load()
+HIT = "HIT"
+STALE = "STALE"
+MISS = "MISS"
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a time-to-live and a stale-while-revalidate window"""
+
+    def __init__(self, max_size=1024, ttl=5.0, stale_ttl=30.0):
+        """
+        :param int max_size: maximum number of entries, the least recently used is evicted first; 0 disables the cache
+        :param float ttl: seconds during which an entry is fresh
+        :param float stale_ttl: seconds after the TTL during which an entry is served while another caller refreshes it
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key --> (value, stored_at)
+        self._refreshing = set()
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "evictions": 0}
+
+    def get_or_load(self, key, loader) -> (object, str, float):
+        """
+        Return the cached value of key, calling loader() to (re)load it when needed.
+        A value of None returned by the loader is not cached.
+        :param key: key of the entry
+        :param callable loader: function without argument returning the value of key
+        :return tuple: value, status (HIT, STALE or MISS) & age of the value in seconds
+        """
+        if self.max_size <= 0:
+            return (loader(), MISS, 0.0)
+
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, stored_at = entry
+                age = now - stored_at
+
+                if age <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return (value, HIT, age)
+
+                if age <= self.ttl + self.stale_ttl and key in self._refreshing:
+                    self._entries.move_to_end(key)
+                    self._stats["stale_hits"] += 1
+                    return (value, STALE, age)
+
+            self._stats["misses"] += 1
+            self._refreshing.add(key)
+
+        try:
+            value = loader()
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+        if value is not None:
+            self.set(key, value)
+
+        return (value, MISS, 0.0)
+
+    def set(self, key, value):
+        """Store the value of key, evicting the least recently used entries above max_size"""
+        with self._lock:
+            self._entries[key] = (value, time.monotonic())
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        """Return the hit/miss/eviction counters of the cache"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(
+                {"size": len(self._entries), "max_size": self.max_size, "ttl": self.ttl}
+            )
+        return stats
@@ -0,0 +1,178 @@
+"""
+This module implements a circuit breaker guarding the requests of a worker to a remote server.
+While the remote server fails, requests are refused at once instead of each one waiting for its
+timeout, so the workers of StatisticsAPI stay available and the remote server gets time to recover.
+
+* CircuitBreaker --> closed, open & half-open states over a window of the last calls
+* CircuitOpenError --> raised when a call is refused by an open circuit
+
+States:
+* closed: calls go through; the circuit opens when FAILURE_RATIO of the last WINDOW calls failed
+* open: calls are refused during OPEN_SECONDS
+* half_open: HALF_OPEN_MAX_CALLS trial calls go through; the circuit closes when all of them
+  succeed, and opens again at the first failure
+
+@author: MMB
+"""
+import threading
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """A call is refused as the circuit of the remote server is open."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(
+            "Circuit of [{}] is open, retry after {:.1f}s".format(name, retry_after)
+        )
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """A thread-safe circuit breaker"""
+
+    def __init__(
+        self,
+        name,
+        window=20,
+        min_calls=10,
+        failure_ratio=0.5,
+        open_seconds=5,
+        half_open_max_calls=2,
+        on_transition=None,
+    ):
+        """
+        :param str name: name of the guarded remote server, e.g. host:port
+        :param int window: number of last calls over which failures are counted
+        :param int min_calls: calls in the window before the circuit may open
+        :param float failure_ratio: ratio of failed calls in the window which opens the circuit
+        :param float open_seconds: seconds during which calls are refused
+        :param int half_open_max_calls: trial calls, which all must succeed to close the circuit
+        :param on_transition: called with (name, old state, new state) on every transition
+        """
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_ratio = failure_ratio
+        self.open_seconds = open_seconds
+        self.half_open_max_calls = half_open_max_calls
+        self.on_transition = on_transition
+
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._outcomes = deque(maxlen=window)  # True for a failed call
+        self._opened_at = 0.0
+        self._trials = 0
+        self._trial_successes = 0
+        self._stats = {"calls": 0, "failures": 0, "rejected": 0, "transitions": {}}
+
+    def _transition(self, state):
+        """Change the state, the lock being held"""
+        old_state = self._state
+        self._state = state
+        key = "{}->{}".format(old_state, state)
+        self._stats["transitions"][key] = self._stats["transitions"].get(key, 0) + 1
+
+        if state == OPEN:
+            self._opened_at = time.monotonic()
+        elif state == HALF_OPEN:
+            self._trials = 0
+            self._trial_successes = 0
+        else:
+            self._outcomes.clear()
+
+        return (old_state, state)
+
+    def _notify(self, transition):
+        if transition is not None and self.on_transition is not None:
+            self.on_transition(self.name, *transition)
+
+    def before_call(self):
+        """
+        Ask the permission to call the remote server
+        :raise CircuitOpenError: when the call is refused
+        """
+        transition = None
+        with self._lock:
+            if self._state == OPEN:
+                remaining = self._opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    self._stats["rejected"] += 1
+                    raise CircuitOpenError(self.name, remaining)
+                transition = self._transition(HALF_OPEN)
+
+            if self._state == HALF_OPEN:
+                if self._trials >= self.half_open_max_calls:
+                    self._stats["rejected"] += 1
+                    # trials are in flight, their outcome is expected within a timeout
+                    raise CircuitOpenError(self.name, self.open_seconds)
+                self._trials += 1
+
+            self._stats["calls"] += 1
+
+        self._notify(transition)
+
+    def record(self, failed):
+        """
+        Record the outcome of a call allowed by before_call()
+        :param bool failed: the remote server failed (no response, or a server error)
+        """
+        transition = None
+        with self._lock:
+            if failed:
+                self._stats["failures"] += 1
+
+            if self._state == HALF_OPEN:
+                if failed:
+                    transition = self._transition(OPEN)
+                else:
+                    self._trial_successes += 1
+                    if self._trial_successes >= self.half_open_max_calls:
+                        transition = self._transition(CLOSED)
+
+            elif self._state == CLOSED:
+                self._outcomes.append(failed)
+                failures = sum(self._outcomes)
+                if (
+                    len(self._outcomes) >= self.min_calls
+                    and failures >= self.failure_ratio * len(self._outcomes)
+                ):
+                    transition = self._transition(OPEN)
+
+        self._notify(transition)
+
+    def retry_after(self) -> float:
+        """Seconds during which calls are still refused, 0 when a call would be allowed"""
+        with self._lock:
+            if self._state == OPEN:
+                return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+            if self._state == HALF_OPEN and self._trials >= self.half_open_max_calls:
+                return self.open_seconds
+            return 0.0
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def stats(self) -> dict:
+        """Return the state & counters of the circuit"""
+        with self._lock:
+            stats = dict(self._stats, transitions=dict(self._stats["transitions"]))
+            stats.update(
+                {
+                    "state": self._state,
+                    "window_calls": len(self._outcomes),
+                    "window_failures": sum(self._outcomes),
+                }
+            )
+            if self._state == OPEN:
+                stats["retry_after"] = round(
+                    max(0.0, self._opened_at + self.open_seconds - time.monotonic()), 3
+                )
+        return stats
@@ -0,0 +1,390 @@
+"""
+This module shares a snapshot of the count of every device type between the workers, so that
+/Log/auth/statistics/<deviceType> is answered without any query to the DB.
+
+The snapshot is a file of fixed-size slots (e.g., in /dev/shm), memory-mapped by every worker:
+a header (magic, number of slots, flags, heartbeat) followed by an open-addressing hash table of
+<seq, name, count> slots. A single updater, the worker holding the flock of <path>.lock, listens
+for the NOTIFY of the rollup triggers of DeviceRegistrationAPI (one notification per device type
+written by a transaction), re-reads the counts of the notified types and writes their slots; it
+also reloads every count each RESYNC_INTERVAL seconds, and writes a heartbeat every second.
+
+Readers never lock: every slot (and the header) is guarded by a sequence number, odd while the
+updater writes it, and a read is retried when the sequence changed meanwhile (seqlock). A snapshot
+whose heartbeat is older than MAX_AGE seconds (e.g., updater or DB connection down) is stale,
+and the caller reads the DB instead.
+
+* CountSnapshot --> reads counts from the shared file, and the thread updating it when elected
+* get_snapshot() --> returns the snapshot of the current worker process, started after fork
+* get_snapshot_stats() --> returns the state of the snapshot seen by the worker
+
+@author: MMB
+"""
+
+import fcntl
+import mmap
+import os
+import select
+import struct
+import threading
+import time
+import zlib
+
+import psycopg2
+
+MAGIC = b"SAFRACNT"
+# magic, slots, seq, flags, heartbeat (time.time() of the last update)
+HEADER = struct.Struct("<8sIIIxxxxd")
+# seq, length of the name, count, time of the update, name (UTF-8)
+NAME_SIZE = 152
+SLOT = struct.Struct("<IHxxqd{}s".format(NAME_SIZE))
+SEQ = struct.Struct("<I")
+HEADER_SEQ_OFFSET = 12
+
+# flags of the header
+LOADED = 1  # every count was loaded once
+OVERFLOW = 2  # a device type did not fit, an unknown type may have a count
+
+# channel of the NOTIFY sent by the rollup triggers of DeviceRegistrationAPI
+CHANNEL = "device_type_counts"
+READ_RETRIES = 100
+
+
+class CountSnapshot:
+    """Counts of the device types shared by the workers through a memory-mapped file"""
+
+    def __init__(
+        self,
+        path,
+        dsn,
+        table="devices",
+        slots=4096,
+        max_age=5,
+        resync_interval=60,
+    ):
+        """
+        :param str path: file of the snapshot, shared by the workers
+        :param str dsn: connection string of the primary DB, the one receiving the NOTIFY
+        :param str table: table whose rollup triggers notify the writes
+        :param int slots: number of device types the snapshot can hold
+        :param float max_age: seconds without heartbeat after which the snapshot is stale
+        :param float resync_interval: seconds between two reloads of every count
+        """
+        self.path = path
+        self.dsn = dsn
+        self.table = table
+        self.slots = slots
+        self.max_age = max_age
+        self.resync_interval = resync_interval
+        self.heartbeat_interval = min(1.0, max_age / 2)
+
+        self._lock = threading.Lock()
+        self._mm = None
+        self._reopen_at = 0
+        self._stopping = threading.Event()
+        self._updater = False
+        self._stats = {"updates": 0, "resyncs": 0, "notifications": 0}
+
+        self._thread = threading.Thread(
+            target=self._run, name="snapshot-updater", daemon=True
+        )
+        self._thread.start()
+
+    # readers
+
+    def _mapping(self, reopen=False) -> mmap.mmap:
+        """The mapping of the snapshot file, opened again when it was replaced by an updater"""
+        with self._lock:
+            if self._mm is not None and not reopen:
+                return self._mm
+            # throttled: a stale snapshot is checked at most once per second
+            if time.monotonic() < self._reopen_at:
+                return self._mm
+            self._reopen_at = time.monotonic() + 1
+
+            try:
+                fd = os.open(self.path, os.O_RDONLY)
+            except FileNotFoundError:
+                return self._mm
+            try:
+                if os.fstat(fd).st_size >= HEADER.size:
+                    # the mapping keeps the file even when the updater replaces it
+                    self._mm = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+            finally:
+                os.close(fd)
+
+            return self._mm
+
+    @staticmethod
+    def _read_header(mm):
+        for _ in range(READ_RETRIES):
+            magic, slots, seq, flags, heartbeat = HEADER.unpack_from(mm, 0)
+            if not seq & 1 and SEQ.unpack_from(mm, HEADER_SEQ_OFFSET)[0] == seq:
+                if magic != MAGIC or len(mm) < HEADER.size + slots * SLOT.size:
+                    return None
+                return (slots, flags, heartbeat)
+        return None
+
+    @staticmethod
+    def _read_slot(mm, index):
+        offset = HEADER.size + index * SLOT.size
+        for _ in range(READ_RETRIES):
+            seq, length, count, updated_at, name = SLOT.unpack_from(mm, offset)
+            if not seq & 1 and SEQ.unpack_from(mm, offset)[0] == seq:
+                return (name[:length], count)
+        return None
+
+    def _fresh_header(self):
+        """Header of a fresh snapshot, or None when there is none"""
+        for reopen in (False, True):
+            mm = self._mapping(reopen)
+            header = self._read_header(mm) if mm is not None else None
+            if (
+                header is not None
+                and header[1] & LOADED
+                and time.time() - header[2] <= self.max_age
+            ):
+                return (mm, header)
+        return (None, None)
+
+    def get(self, device_type) -> (int, float):
+        """
+        Count of a device type in the snapshot, without any lock nor query to the DB
+        :param str device_type: type of device
+        :return tuple: count & age of the snapshot in seconds, None when the snapshot is stale
+        or can't tell (e.g., slots full)
+        """
+        mm, header = self._fresh_header()
+        if mm is None:
+            return None
+        slots, flags, heartbeat = header
+
+        name = device_type.encode()
+        start = zlib.crc32(name) % slots
+        for probe in range(slots):
+            slot = self._read_slot(mm, (start + probe) % slots)
+            if slot is None:
+                return None
+            if not slot[0]:
+                # free slot: the type has no count, unless it did not fit
+                if flags & OVERFLOW:
+                    return None
+                return (0, max(0.0, time.time() - heartbeat))
+            if slot[0] == name:
+                return (slot[1], max(0.0, time.time() - heartbeat))
+
+        return None
+
+    # updater
+
+    def _run(self):
+        lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        while not self._stopping.is_set():
+            try:
+                # released when the process exits: another worker takes over
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                self._stopping.wait(self.heartbeat_interval)
+                continue
+
+            self._updater = True
+            try:
+                self._update()
+            except Exception as err:
+                print("[Snapshot] update failed:", err)
+            self._stopping.wait(self.heartbeat_interval)
+
+    def _write_header(self, mm, flags, heartbeat):
+        seq = SEQ.unpack_from(mm, HEADER_SEQ_OFFSET)[0]
+        SEQ.pack_into(mm, HEADER_SEQ_OFFSET, (seq + 1) & 0xFFFFFFFF)
+        HEADER.pack_into(
+            mm, 0, MAGIC, self.slots, (seq + 1) & 0xFFFFFFFF, flags, heartbeat
+        )
+        SEQ.pack_into(mm, HEADER_SEQ_OFFSET, (seq + 2) & 0xFFFFFFFF)
+
+    def _write_count(self, mm, index, name, count):
+        offset = HEADER.size + index * SLOT.size
+        seq = SEQ.unpack_from(mm, offset)[0]
+        SEQ.pack_into(mm, offset, (seq + 1) & 0xFFFFFFFF)
+        SLOT.pack_into(
+            mm, offset, (seq + 1) & 0xFFFFFFFF, len(name), count, time.time(), name
+        )
+        SEQ.pack_into(mm, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def _store(self, mm, indexes, counts) -> bool:
+        """Write counts {name: count} to their slots, return False when one did not fit"""
+        fitted = True
+        taken = set(indexes.values())
+        for device_type, count in counts.items():
+            name = device_type.encode()
+            index = indexes.get(name)
+            if index is None:
+                if len(name) > NAME_SIZE or len(indexes) >= self.slots:
+                    fitted = False
+                    continue
+                # linear probing, as readers do
+                index = zlib.crc32(name) % self.slots
+                while index in taken:
+                    index = (index + 1) % self.slots
+                indexes[name] = index
+                taken.add(index)
+            self._write_count(mm, index, name, count)
+
+        return fitted
+
+    def _update(self):
+        """Build a new snapshot file, then keep it up to date until an error"""
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cursor:
+                # the counts of a table whose triggers don't notify would silently age
+                cursor.execute(
+                    "SELECT EXISTS (SELECT 1 FROM pg_proc WHERE proname = %s AND prosrc LIKE '%%pg_notify%%')",
+                    ("{}_maintain_counts".format(self.table),),
+                )
+                if not cursor.fetchone()[0]:
+                    print(
+                        "[Snapshot] triggers of [{}] don't notify the counts (NOTIFY_COUNTS of DeviceRegistrationAPI), retrying in {}s".format(
+                            self.table, self.resync_interval
+                        )
+                    )
+                    self._stopping.wait(self.resync_interval)
+                    return
+                # listening before the load: no write is missed in between
+                cursor.execute("LISTEN {};".format(CHANNEL))
+
+            # readers keep the mapping of the previous file until they see it stale
+            tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.ftruncate(fd, HEADER.size + self.slots * SLOT.size)
+                mm = mmap.mmap(fd, 0)
+            finally:
+                os.close(fd)
+
+            indexes = {}
+            flags = 0
+            resync_at = 0
+            published = False
+            try:
+                while not self._stopping.is_set():
+                    if time.monotonic() >= resync_at:
+                        counts = self._read_counts(conn, None)
+                        # types no more in the rollup (e.g., rebuilt) count 0
+                        counts.update(
+                            {
+                                name.decode(): 0
+                                for name in indexes
+                                if name.decode() not in counts
+                            }
+                        )
+                        if not self._store(mm, indexes, counts):
+                            flags |= OVERFLOW
+                        flags |= LOADED
+                        resync_at = time.monotonic() + self.resync_interval
+                        self._count("resyncs")
+                        if not published:
+                            self._write_header(mm, flags, time.time())
+                            os.replace(tmp_path, self.path)
+                            published = True
+                            print(
+                                "[Snapshot] {} device types loaded".format(len(indexes))
+                            )
+
+                    if select.select([conn], [], [], self.heartbeat_interval)[0]:
+                        conn.poll()
+                        names = {notify.payload for notify in conn.notifies}
+                        conn.notifies.clear()
+                        if names:
+                            counts = dict.fromkeys(names, 0)
+                            counts.update(self._read_counts(conn, sorted(names)))
+                            if not self._store(mm, indexes, counts):
+                                flags |= OVERFLOW
+                            self._count("notifications", len(names))
+                            self._count("updates")
+
+                    self._write_header(mm, flags, time.time())
+            finally:
+                # a stale snapshot: readers go to the DB until another updater takes over
+                self._write_header(mm, flags, 0)
+                mm.close()
+                if not published:
+                    os.unlink(tmp_path)
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _read_counts(conn, device_types) -> dict:
+        """Counts of the given device types (all when None) in the rollup"""
+        with conn.cursor() as cursor:
+            if device_types is None:
+                cursor.execute(
+                    "SELECT device_type, sum(count)::bigint FROM device_type_counts GROUP BY device_type"
+                )
+            else:
+                cursor.execute(
+                    "SELECT device_type, sum(count)::bigint FROM device_type_counts WHERE device_type = ANY(%s) GROUP BY device_type",
+                    (device_types,),
+                )
+            return dict(cursor.fetchall())
+
+    def _count(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def close(self):
+        """Stop updating the snapshot"""
+        self._stopping.set()
+
+    def stats(self) -> dict:
+        """Return the state of the snapshot seen by the worker"""
+        mm = self._mapping()
+        header = self._read_header(mm) if mm is not None else None
+        with self._lock:
+            stats = dict(self._stats)
+        stats.update(
+            {
+                "updater": self._updater,
+                "slots": self.slots,
+                "loaded": bool(header and header[1] & LOADED),
+                "overflow": bool(header and header[1] & OVERFLOW),
+                "age": round(time.time() - header[2], 3)
+                if header and header[2]
+                else None,
+            }
+        )
+        return stats
+
+
+_snapshot = None
+_snapshot_pid = None
+_snapshot_lock = threading.Lock()
+
+
+def get_snapshot(path, dsn, **snapshot_kwargs) -> CountSnapshot:
+    """
+    Return the snapshot of the current process, created (with its thread) after fork
+    :param str path: file of the snapshot, shared by the workers
+    :param str dsn: connection string of the primary DB
+    :param snapshot_kwargs: parameters of CountSnapshot, used when the snapshot is created
+    :return: CountSnapshot
+    """
+    global _snapshot, _snapshot_pid
+
+    with _snapshot_lock:
+        if _snapshot_pid != os.getpid():
+            _snapshot = CountSnapshot(path, dsn, **snapshot_kwargs)
+            _snapshot_pid = os.getpid()
+
+        return _snapshot
+
+
+def get_snapshot_stats() -> dict:
+    """Return the state of the snapshot of the current process, None if there is none"""
+    with _snapshot_lock:
+        if _snapshot_pid != os.getpid():
+            return None
+        snapshot = _snapshot
+
+    return snapshot.stats()
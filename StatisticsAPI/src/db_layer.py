@@ -1,63 +1,326 @@
 """
 This module implements a DataBase abstraction layer to get access to a postgresql DB.
-There is one function implemented in this module:
+There are five functions implemented in this module:
 
-* read_from_db() --> allows to read data from DB
+* read_from_db() --> allows to read data from DB through the connection pool of the worker
+* stream_from_db() --> reads the rows of a query in batches through a server-side cursor
+* get_read_endpoint() & reset_read_endpoint() --> endpoint (replica or primary) of the last read
+  of the thread, i.e. of the request it serves
+* get_pool_stats() --> returns statistics of the connection pools of the worker
+* get_replica_stats() --> returns health & lag of the read replicas of the worker
+
+With READ_HOSTS set in the settings, reads are routed to a healthy read replica (src.replicas),
+and to the primary when none is healthy or the replica fails the read.
+
+Calls through the pool are timed in src.metrics, per phase: connect (checkout), execute & fetch.
 
 @author: MMB
 """
-import configparser
-import psycopg2
-from psycopg2 import DatabaseError
+import threading
+import time
+from contextlib import contextmanager
+
+from psycopg2 import DatabaseError, InterfaceError, OperationalError
+from psycopg2.extensions import make_dsn
+from src import db_pool
+from src import metrics
+from src import replicas
+from src import settings
+
+# endpoint of the last read of each thread, i.e. of the request it serves
+_local = threading.local()
+
+# replay lag of a replica in seconds, 0 when every WAL received is replayed (e.g. an idle primary),
+# infinite while nothing is replayed yet; 0 on a server which is not in recovery.
+# NULL while its WAL receiver isn't streaming (e.g. primary unreachable): nothing new is received,
+# so every WAL received being replayed doesn't tell the replica is up to date.
+# The status of the WAL receiver is only visible to a member of pg_read_all_stats (or pg_monitor),
+# other users only see whether it runs
+REPLICA_LAG_QUERY = (
+    "SELECT CASE WHEN NOT pg_is_in_recovery() THEN 0"
+    " WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE COALESCE(status = 'streaming', true))"
+    " THEN NULL"
+    " WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0"
+    " ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())::float8,"
+    " 'Infinity') END"
+)
+
+
+def _get_pool(db_user, db_password, db_host, db_port) -> db_pool.ConnectionPool:
+    """Return the connection pool of the current worker for the given DB instance"""
+    conf = settings.get_settings()
+
+    # the DSN of the configured instance is prebuilt by the settings
+    if (db_user, db_password, db_host, db_port) == (
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    ):
+        dsn = conf.db_dsn
+    else:
+        dsn = make_dsn(
+            conf.db_dsn, user=db_user, password=db_password, host=db_host, port=db_port
+        )
+
+    return db_pool.get_pool(
+        dsn,
+        min_size=conf.db_pool_min_size,
+        max_size=conf.db_pool_max_size,
+        max_lifetime=conf.db_pool_max_lifetime,
+        health_check_interval=conf.db_pool_health_check_interval,
+        checkout_timeout=conf.db_pool_checkout_timeout,
+    )
+
+
+@contextmanager
+def _connection(operation, db_user, db_password, db_host, db_port):
+    """Check a connection out of the pool of the worker, timing the checkout"""
+    start = time.perf_counter()
+    pool = _get_pool(db_user, db_password, db_host, db_port)
+    with pool.connection() as db_connect:
+        metrics.DB_LATENCY.labels(operation, "connect").observe(
+            time.perf_counter() - start
+        )
+        yield db_connect
+
+
+def _read(select_query, select_key, db_user, db_password, db_host, db_port) -> list:
+    """Run a read query on the given DB instance"""
+    with _connection("read", db_user, db_password, db_host, db_port) as db_connect:
+        with db_connect.cursor() as cursor:
+            with metrics.time_db("read", "execute"):
+                cursor.execute(select_query, select_key)
+            with metrics.time_db("read", "fetch"):
+                result = cursor.fetchall()
+        # end the read-only transaction before the connection goes back to the pool
+        db_connect.rollback()
+
+    return result
+
+
+def _replica_lag(db_host, db_port) -> float:
+    """
+    Replay lag of a replica in seconds, queried through the pool of the worker
+    :raise RuntimeError: when the replica doesn't stream the WAL of the primary
+    """
+    conf = settings.get_settings()
+    with _get_pool(conf.db_user, conf.db_password, db_host, db_port).connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(REPLICA_LAG_QUERY)
+            lag = cursor.fetchone()[0]
+        conn.rollback()
+
+    if lag is None:
+        raise RuntimeError("WAL receiver not streaming")
+    return float(lag)
+
+
+def _get_replica_set() -> replicas.ReplicaSet:
+    """Return the replica set of the worker, None when reads go to the primary"""
+    conf = settings.get_settings()
+    return replicas.get_replica_set(
+        conf.db_read_hosts,
+        _replica_lag,
+        max_lag=conf.replica_max_lag,
+        check_interval=conf.replica_check_interval,
+        on_check=metrics.observe_replica,
+    )
+
+
+def _set_read_endpoint(endpoint, role):
+    _local.endpoint = "{} {}".format(role, endpoint)
+    metrics.observe_read(endpoint, role)
 
 
 def read_from_db(
     select_query, select_key, db_user, db_password, db_host, db_port
 ) -> (bool, list):
     """
-    Reading from database
+    Reading from database through the connection pool of the worker.
+    The query is read-only: it is sent to a healthy read replica if any, else to the given DB.
     :param str select_query: query used to select data from DB
     :param str selecy_key: used in the select query in the condition
     :param str db_user: username to get access to DB
     :param str db_password: password to get access to DB
-    :param str db_host: host of DB instance
-    :param str db_port: port of DB instance
+    :param str db_host: host of DB instance (the primary)
+    :param str db_port: port of DB instance (the primary)
     :return: list otherwise an empty list
     """
+    conf = settings.get_settings()
 
     try:
-        # Read the configuration file and DATABASE section
-        config = configparser.ConfigParser()
-        config.read("config/params.ini")
-        conf_db = config["DATABASE"]
-
-        db_connect = psycopg2.connect(
-            database=conf_db.get("NAME"),
-            user=db_user,
-            password=db_password,
-            host=db_host,
-            port=db_port,
-        )
+        replica_set = _get_replica_set()
+        candidates = replica_set.candidates() if replica_set is not None else []
+        for replica in candidates:
+            try:
+                result = _read(
+                    select_query,
+                    select_key,
+                    db_user,
+                    db_password,
+                    replica.host,
+                    replica.port,
+                )
+            except (OperationalError, InterfaceError, db_pool.PoolTimeoutError) as err:
+                # e.g. replica down, or a query cancelled by a conflict with recovery
+                metrics.DB_ERRORS.labels("read").inc()
+                replica_set.eject(replica, err)
+                continue
 
-        cursor = db_connect.cursor()
-        cursor.execute(select_query, select_key)
-        result = cursor.fetchall()
+            replica_set.record_read(replica)
+            _set_read_endpoint(replica.name, "replica")
+            return (True, result)
 
-        cursor.close()
-        db_connect.close()
+        if replica_set is not None and not conf.replica_fallback_to_primary:
+            print("[Replica] No healthy replica to read from")
+            metrics.DB_ERRORS.labels("read").inc()
+            return (False, [])
+
+        result = _read(select_query, select_key, db_user, db_password, db_host, db_port)
+        _set_read_endpoint("{}:{}".format(db_host, db_port), "primary")
 
         return (True, result)
 
     except DatabaseError as err:
-        cursor.close()
-        db_connect.close()
         print("[DatabaseError Exception]", err)
+        metrics.DB_ERRORS.labels("read").inc()
 
         return (False, [])
 
     except Exception as err:
-        cursor.close()
-        db_connect.close()
         print("[Exception]", err)
+        metrics.DB_ERRORS.labels("read").inc()
 
         return (False, [])
+
+
+def _stream(select_query, select_key, batch_size, db_user, db_password, db_host, db_port):
+    """Generator of the batches of rows of a read query, run through a named cursor"""
+    with _connection("stream", db_user, db_password, db_host, db_port) as db_connect:
+        # a named cursor keeps the result on the server, the worker holds one batch at a time
+        with db_connect.cursor(name="stream") as cursor:
+            cursor.itersize = batch_size
+            with metrics.time_db("stream", "execute"):
+                cursor.execute(select_query, select_key)
+            while True:
+                with metrics.time_db("stream", "fetch"):
+                    rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        # end the read-only transaction (and the cursor) before the connection goes back to the pool
+        db_connect.rollback()
+
+
+def _prepend(first, batches):
+    """The batches of a stream whose first batch is already fetched"""
+    try:
+        if first:
+            yield first
+        yield from batches
+    finally:
+        # e.g. client gone: the connection goes back to the pool at once
+        batches.close()
+
+
+def stream_from_db(
+    select_query,
+    select_key,
+    db_user,
+    db_password,
+    db_host,
+    db_port,
+    batch_size=1000,
+):
+    """
+    Reading a large result from database in batches, through a server-side (named) cursor,
+    so the memory of the worker does not depend on the number of rows.
+    The query is sent to a healthy read replica if any, else to the given DB; the first batch is
+    fetched before returning, so a failure is raised here rather than in the middle of a stream.
+    A connection of the pool is checked out until the generator is exhausted or closed.
+    :param str select_query: query used to select data from DB
+    :param select_key: parameters of the select query
+    :param str db_user: username to get access to DB
+    :param str db_password: password to get access to DB
+    :param str db_host: host of DB instance (the primary)
+    :param str db_port: port of DB instance (the primary)
+    :param int batch_size: rows fetched from the server at a time
+    :return generator: lists of at most batch_size rows
+    :raise DatabaseError: when the query can't be run
+    """
+    conf = settings.get_settings()
+
+    try:
+        replica_set = _get_replica_set()
+        candidates = replica_set.candidates() if replica_set is not None else []
+        for replica in candidates:
+            batches = _stream(
+                select_query,
+                select_key,
+                batch_size,
+                db_user,
+                db_password,
+                replica.host,
+                replica.port,
+            )
+            try:
+                first = next(batches, None)
+            except (OperationalError, InterfaceError, db_pool.PoolTimeoutError) as err:
+                metrics.DB_ERRORS.labels("stream").inc()
+                replica_set.eject(replica, err)
+                continue
+
+            replica_set.record_read(replica)
+            _set_read_endpoint(replica.name, "replica")
+            return _prepend(first, batches)
+
+        if replica_set is not None and not conf.replica_fallback_to_primary:
+            raise OperationalError("No healthy replica to read from")
+
+        batches = _stream(
+            select_query,
+            select_key,
+            batch_size,
+            db_user,
+            db_password,
+            db_host,
+            db_port,
+        )
+        first = next(batches, None)
+        _set_read_endpoint("{}:{}".format(db_host, db_port), "primary")
+
+        return _prepend(first, batches)
+
+    except Exception:
+        metrics.DB_ERRORS.labels("stream").inc()
+        raise
+
+
+def get_read_endpoint() -> str:
+    """
+    Endpoint of the last read of the current thread, e.g. "replica 10.0.0.2:5432"
+    :return str: or None when the thread did not read since reset_read_endpoint()
+    """
+    return getattr(_local, "endpoint", None)
+
+
+def reset_read_endpoint():
+    """Forget the endpoint of the last read of the current thread, e.g. when a request starts"""
+    _local.endpoint = None
+
+
+def get_pool_stats() -> list:
+    """
+    Statistics of the connection pools of the worker
+    :return list: one dict per pool
+    """
+    return db_pool.get_pool_stats()
+
+
+def get_replica_stats() -> list:
+    """
+    Health, lag & reads of the read replicas of the worker
+    :return list: one dict per replica
+    """
+    return replicas.get_replica_stats()
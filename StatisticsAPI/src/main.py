@@ -3,36 +3,110 @@ Different functions are implemented to handle functionalities of the API:
 
 info() --> return back some information to client about the API
 get_status() --> to be called for any health-check of the API
+get_stats() --> return runtime statistics (e.g., DB connection pool, read replicas) of the worker
+get_metrics() --> return Prometheus metrics of all the workers (requests, latency, DB & upstream timing)
+reload_config() --> reload the settings of every worker (admin)
+rebuild_on_reload() --> rebuild the cache & single flight of the worker from reloaded settings
+list_profiles() & get_profile() --> profiles of slow requests kept by the workers (admin, src.profiler)
 send_login_event() --> main function to handle request recieved on the path /Device/register
-get_device_count() --> to rerieve count of deviceType sent by client
+parse_login_event() & login_event_response() --> validation & status mapping of /Log/auth, shared with src.asgi
+circuit_open_response() --> 503 answered while the circuit to DeviceRegistrationAPI is open
+upstream_unavailable() --> admission check, sheds the forwarded events while that circuit is open
+send_login_events() --> forward a batch of events recieved on the path /Log/auth/batch
+get_device_count() --> to rerieve count of deviceType sent by client, through the cache of the worker
+read_snapshot_count() --> count of a deviceType in the snapshot shared by the workers, without DB round trip
+statistics_response() --> statistics response with a strong ETag & Cache-Control, 304 on If-None-Match
+count_etag() --> ETag of the count of a deviceType, checked before the body is built
+read_device_count() --> read count of a deviceType from DB
+coalesced_read() --> run a statistics read once for the identical reads in flight (src.single_flight)
+get_device_counts() --> retrieve count of many (or all) deviceTypes in one request
+read_device_counts() --> read count of many deviceTypes from DB in a single query
+get_device_series() --> retrieve count of deviceType per hour/day/week between two dates
+read_device_series() --> read count of a deviceType per bucket of time from DB
+export_devices() --> stream the registered devices as NDJSON or CSV (authenticated)
+read_devices() --> read the devices table in batches, through a server-side cursor
 check_authentication_token --> handle authentication part.
+reset_read_endpoint() & add_read_endpoint_header() --> X-DB-Endpoint header, the DB endpoint which served the reads
+
+Configuration is read once into src.settings. /api/admin/reload-config (or SIGUSR2 outside of uWSGI)
+requests a reload, applied by every worker before its next request.
 
 Authentication is done using a token received in the header of the HTTP request.
 For security reasons, it is better to send tokens in the request header.
 
 @Author: MMB
 """
+import csv
+import datetime
+import hashlib
+import io
 import json
+import math
 import os
-import configparser
+import signal
 import requests
 
-from flask import jsonify, request
+from flask import jsonify, request, send_from_directory
+from psycopg2 import sql
+from src import admission
+from src import cache
+from src import count_snapshot
 from src import db_layer
+from src import metrics
+from src import profiler
 from src import request_handler
+from src import settings
+from src import single_flight
 from src import app
 
-# global setting
-requests.adapters.DEFAULT_RETRIES = 5
+metrics.instrument(app)
+profiler.instrument(app)
+# a refused request costs no more than the lookup of its route
+admission.instrument(app)
+# outermost, a reload requested by another worker applies before anything reads the settings
+settings.instrument(app)
+
+
+def build_count_cache(conf) -> cache.TTLCache:
+    """Cache of counts of the worker, as set in the [CACHE] section of the settings"""
+    return cache.TTLCache(
+        max_size=conf.cache_max_size, ttl=conf.cache_ttl, stale_ttl=conf.cache_stale_ttl
+    )
+
+
+def build_read_flight(conf) -> single_flight.SingleFlight:
+    """Identical statistics reads in flight, across the workers when CROSS_WORKER is set"""
+    return single_flight.SingleFlight(
+        directory=conf.single_flight_dir if conf.single_flight_cross_worker else None,
+        wait_timeout=conf.single_flight_wait_timeout,
+    )
+
+
+# cache of counts, lives as long as the worker or until its settings change
+count_cache = build_count_cache(settings.get_settings())
+read_flight = build_read_flight(settings.get_settings())
 
-# ENV variables
-statistics_user_key = os.getenv("STATISTICS_USER_KEY")
-deviceregistrationapi_host = os.getenv("DEVICEREGISTRATIONAPI_HOST")
-deviceregistrationapi_port = os.getenv("DEVICEREGISTRATIONAPI_PORT")
-database_host = os.getenv("DATABASE_HOST")
-database_port = os.getenv("DATABASE_PORT")
-database_user = os.getenv("DATABASE_USER")
-database_password = os.getenv("DATABASE_PASSWORD")
+
+def rebuild_on_reload(conf):
+    """Rebuild the cache & the single flight of the worker when their settings changed"""
+    global count_cache, read_flight
+
+    if (count_cache.max_size, count_cache.ttl, count_cache.stale_ttl) != (
+        conf.cache_max_size,
+        conf.cache_ttl,
+        conf.cache_stale_ttl,
+    ):
+        count_cache = build_count_cache(conf)
+
+    directory = conf.single_flight_dir if conf.single_flight_cross_worker else None
+    if (read_flight.directory, read_flight.wait_timeout) != (
+        directory,
+        conf.single_flight_wait_timeout,
+    ):
+        read_flight = build_read_flight(conf)
+
+
+settings.on_reload(rebuild_on_reload)
 
 
 # implements a special class for handling of unknown exception/errors.
@@ -78,6 +152,21 @@ def resource_not_found(e):
     return jsonify(error="Resource not found"), 404
 
 
+@app.before_request
+def reset_read_endpoint():
+    """Forget the DB endpoint of the previous request served by the thread"""
+    db_layer.reset_read_endpoint()
+
+
+@app.after_request
+def add_read_endpoint_header(response):
+    """Tell which DB endpoint (e.g., replica 10.0.0.2:5432 or primary) served the reads of the request"""
+    endpoint = db_layer.get_read_endpoint()
+    if endpoint is not None:
+        response.headers["X-DB-Endpoint"] = endpoint
+    return response
+
+
 @app.route("/")
 def info():
     """return basic information about the API to client."""
@@ -102,23 +191,182 @@ def get_status():
     return result
 
 
+@app.route("/api/stats")
+def get_stats():
+    """Get runtime statistics of the worker which serves the request"""
+    data = {
+        "db_pool": db_layer.get_pool_stats(),
+        "cache": count_cache.stats(),
+        "single_flight": read_flight.stats(),
+        "snapshot": count_snapshot.get_snapshot_stats(),
+        "profiler": profiler.get_profiler_stats(),
+        "admission": admission.get_admission_stats(),
+        "http_session": request_handler.get_session_stats(),
+        "circuit_breakers": request_handler.get_breaker_stats(),
+        "replicas": db_layer.get_replica_stats(),
+    }
+    result = app.response_class(
+        response=json.dumps(data), status=200, mimetype="application/json"
+    )
+
+    return result
+
+
+@app.route("/metrics")
+def get_metrics():
+    """Get Prometheus metrics, aggregated over the workers"""
+    body, content_type = metrics.export()
+    return app.response_class(response=body, status=200, content_type=content_type)
+
+
+@app.route("/api/admin/reload-config", methods=["POST"])
+def reload_config():
+    """Reload the settings of every worker from params.ini and ENV, each before its next request"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed", "StatusCode": "403"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    try:
+        settings.request_reload()
+        settings.check_generation()
+        data = {"INFO": "Settings reloaded, every other worker reloads before its next request", "pid": os.getpid()}
+    except OSError as err:
+        print("[Exception] unable to request a reload of the settings:", err)
+        settings.reload_settings()
+        data = {"INFO": "Settings reloaded by this worker only", "pid": os.getpid()}
+    result = app.response_class(
+        response=json.dumps(data), status=200, mimetype="application/json"
+    )
+
+    return result
+
+
+@app.route("/api/admin/profiles", methods=["GET"])
+def list_profiles():
+    """List the most recent profiles of slow requests kept by the workers (admin)"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed", "StatusCode": "403"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    conf = settings.get_settings()
+    try:
+        limit = int(request.args.get("limit", 50))
+        min_ms = float(request.args.get("min_ms", 0))
+    except ValueError:
+        raise ThreatStackRequestError(
+            "Invalid limit or min_ms parameter.", status_code=400
+        )
+
+    data = {
+        "enabled": conf.profiling_enabled,
+        "profiles": profiler.list_profiles(conf.profiling_dir, limit, min_ms),
+    }
+    result = app.response_class(
+        response=json.dumps(data), status=200, mimetype="application/json"
+    )
+
+    return result
+
+
+@app.route("/api/admin/profiles/<string:name>", methods=["GET"])
+def get_profile(name: str):
+    """Download a profile listed by /api/admin/profiles, in the pstats format (admin)"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed", "StatusCode": "403"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    if not name.endswith(profiler.PSTATS_SUFFIX):
+        return resource_not_found(None)
+
+    # a name outside of the directory is answered with 404
+    return send_from_directory(
+        settings.get_settings().profiling_dir, name, as_attachment=True
+    )
+
+
+def parse_login_event(json_data) -> dict:
+    """
+    Validate a login event received from client
+    :param dict json_data: body of the request
+    :return dict: event to send to DeviceRegistrationAPI
+    :raise ValueError, KeyError, TypeError: when the body is invalid
+    """
+    if len(json_data["deviceType"]) == 0:
+        raise ValueError("Null value in Json.")
+
+    return {"deviceType": str(json_data["deviceType"])}
+
+
+def login_event_response(status_code: int) -> (dict, int):
+    """
+    Map the status code answered by DeviceRegistrationAPI to the response of /Log/auth
+    :param int status_code: status code answered by DeviceRegistrationAPI
+    :return tuple: body & status code of the response
+    """
+    if status_code == 200:
+        return ({"StatusCode": 200, "message": "success"}, 200)
+
+    # the event is spooled by DeviceRegistrationAPI, and stored once its DB is available
+    if status_code == 202:
+        return ({"StatusCode": 202, "message": "accepted"}, 202)
+
+    if status_code == 400:
+        return ({"StatusCode": 400, "message": "bad_request"}, 400)
+
+    return (
+        {"StatusCode": 409, "message": "An error occured during device registration"},
+        409,
+    )
+
+
+def circuit_open_response(err) -> (dict, int, dict):
+    """
+    Response of a request refused as the circuit to DeviceRegistrationAPI is open
+    :param CircuitOpenError err: raised by request_handler
+    :return tuple: body, status code & headers of the response
+    """
+    data = {
+        "StatusCode": 503,
+        "message": "DeviceRegistrationAPI is unavailable, retry later",
+    }
+    return (data, 503, {"Retry-After": str(max(1, math.ceil(err.retry_after)))})
+
+
+# routes whose events are forwarded to DeviceRegistrationAPI
+FORWARDED_ROUTES = ("/Log/auth", "/Log/auth/batch")
+
+
+def upstream_unavailable(route, priority, conf) -> str:
+    """
+    Admission check (src.admission): refuse the events forwarded to DeviceRegistrationAPI at once,
+    before their body is read, while the circuit of the worker to it refuses calls
+    :return str: "upstream" if the request is refused, otherwise None
+    """
+    if route not in FORWARDED_ROUTES:
+        return None
+
+    host = request_handler.remote_host(conf.deviceregistration_url)
+    breaker = request_handler.get_breaker(host)
+    if breaker is not None and breaker.retry_after() > 0:
+        return "upstream"
+    return None
+
+
+admission.add_check(upstream_unavailable)
+
+
 @app.route("/Log/auth", methods=["POST"])
 def send_login_event():
     """Store information about user login event"""
-    s = requests.session()
-    s.keep_alive = False
-
-    # Read the configuration file and DEVICEREGISTRATIONAPI section
-    config = configparser.ConfigParser()
-    config.read("config/params.ini")
-    conf_deviceregfistration = config["DEVICEREGISTRATIONAPI"]
 
     # Deviceregistration Api target URL
-    deviceregistration_api_url = "http://{}:{}{}".format(
-        deviceregistrationapi_host,
-        deviceregistrationapi_port,
-        conf_deviceregfistration.get("ENDPOINT_STORE_EVENT"),
-    )
+    deviceregistration_api_url = settings.get_settings().deviceregistration_url
 
     try:
         recv_api_token = request.headers.get("userKey")
@@ -127,11 +375,7 @@ def send_login_event():
 
         if check_authentication_token(recv_api_token):
             # check if body contain device_type & user_key header
-
-            if len(json_data["deviceType"]) == 0:
-                raise ValueError("Null value in Json.")
-
-            data = {"deviceType": str(json_data["deviceType"])}
+            data = parse_login_event(json_data)
             headers = {"Content-Type": "application/json", "userKey": recv_api_token}
 
             # send request to DeviceRegistrationAPI
@@ -139,20 +383,82 @@ def send_login_event():
                 deviceregistration_api_url, json.dumps(data), headers
             )
 
-            if res[0] == 200:
-                data = {
-                    "StatusCode": res[0],
-                    "message": "success",
-                }
-                result = app.response_class(
-                    response=json.dumps(data),
-                    status=res[0],
-                    mimetype="application/json",
-                )
-            elif res[0] == 400:
+            data, status = login_event_response(res[0])
+            result = app.response_class(
+                response=json.dumps(data),
+                status=status,
+                mimetype="application/json",
+            )
+
+        else:
+            data = {"ERROR": "Authentication failed", "StatusCode": "403"}
+            result = app.response_class(
+                response=json.dumps(data), status=403, mimetype="application/json"
+            )
+
+        return result
+
+    except (TypeError, ValueError, KeyError, json.JSONDecodeError):
+        raise ThreatStackRequestError(
+            "Invalide JSON data, Key, syntax or value.", status_code=400
+        )
+    except request_handler.CircuitOpenError as e:
+        data, status, headers = circuit_open_response(e)
+        return app.response_class(
+            response=json.dumps(data),
+            status=status,
+            headers=headers,
+            mimetype="application/json",
+        )
+    except requests.exceptions.RequestException as e:
+        raise ThreatStackRequestError(
+            "Error in request for storing DeviceType [{}]".format(json_data["deviceType"]),
+            status_code=500,
+        )
+
+    except Exception as e:
+        raise ThreatStackError(
+            "Unknown Error in storing DeviceType [{}]".format(json_data["deviceType"]),
+            status_code=500,
+        )
+
+
+@app.route("/Log/auth/batch", methods=["POST"])
+def send_login_events():
+    """Store information about a batch of user login events, reporting a result per event"""
+
+    # Deviceregistration Api target URL
+    deviceregistration_api_url = settings.get_settings().deviceregistration_batch_url
+
+    try:
+        recv_api_token = request.headers.get("userKey")
+        # retrieve data from request
+        json_data = request.json
+
+        if check_authentication_token(recv_api_token):
+            # check if body is a list of events
+            if not isinstance(json_data, list) or len(json_data) == 0:
+                raise ValueError("A non empty list of events is expected.")
+
+            headers = {"Content-Type": "application/json", "userKey": recv_api_token}
+
+            # send the whole batch to DeviceRegistrationAPI in one request
+            res = request_handler.send_post_request(
+                deviceregistration_api_url, json.dumps(json_data), headers
+            )
+
+            if res[0] in (200, 202, 400):
+                messages = {200: "success", 202: "accepted", 400: "bad_request"}
                 data = {
                     "StatusCode": res[0],
-                    "message": "bad_request",
+                    "message": messages[res[0]],
+                    "results": [
+                        {
+                            "StatusCode": item["StatusCode"],
+                            "message": messages.get(item["StatusCode"], "bad_request"),
+                        }
+                        for item in res[1].get("results", [])
+                    ],
                 }
                 result = app.response_class(
                     response=json.dumps(data),
@@ -182,49 +488,384 @@ def send_login_event():
         raise ThreatStackRequestError(
             "Invalide JSON data, Key, syntax or value.", status_code=400
         )
+    except request_handler.CircuitOpenError as e:
+        data, status, headers = circuit_open_response(e)
+        return app.response_class(
+            response=json.dumps(data),
+            status=status,
+            headers=headers,
+            mimetype="application/json",
+        )
     except requests.exceptions.RequestException as e:
         raise ThreatStackRequestError(
-            "Error in request for storing DeviceType [{}]".format(json_data["deviceType"]),
-            status_code=500,
+            "Error in request for storing a batch of DeviceTypes", status_code=500
         )
 
     except Exception as e:
         raise ThreatStackError(
-            "Unknown Error in storing DeviceType [{}]".format(json_data["deviceType"]),
-            status_code=500,
+            "Unknown Error in storing a batch of DeviceTypes", status_code=500
+        )
+
+
+def coalesced_read(operation: str, key: str, loader):
+    """
+    Run a statistics read, shared with the identical reads in flight: when a cache entry
+    expires, the requests of the type waiting for it send one query to the DB
+    :param str operation: kind of read (e.g., count), a label of the metrics
+    :param str key: parameters of the read, identical reads have the same key
+    :param callable loader: function without argument running the read
+    :return: result of the loader
+    """
+    if not settings.get_settings().single_flight_enabled:
+        return loader()
+
+    value, role = read_flight.do("{}:{}".format(operation, key), loader)
+    metrics.observe_single_flight(operation, role)
+
+    return value
+
+
+def read_snapshot_count(device_type: str):
+    """
+    Read the count of a deviceType from the snapshot shared by the workers (src.count_snapshot)
+    :param str device_type: type of device to count
+    :return tuple: count & age in seconds, None when disabled or stale (the DB is read instead)
+    """
+    conf = settings.get_settings()
+    if not conf.snapshot_enabled:
+        return None
+
+    snapshot = count_snapshot.get_snapshot(
+        conf.snapshot_path,
+        conf.db_dsn,
+        table=conf.db_table,
+        slots=conf.snapshot_slots,
+        max_age=conf.snapshot_max_age,
+        resync_interval=conf.snapshot_resync_interval,
+    )
+    res = snapshot.get(device_type)
+    metrics.observe_snapshot("stale" if res is None else "hit")
+
+    return res
+
+
+def read_device_count(device_type: str):
+    """
+    Read the amount of devices registered for a type from DB
+    :param str device_type: type of device to count
+    :return int: count, or None if the DB could not be read
+    """
+
+    # parameterized SQL query to qvoid SQL Injection attacks.
+    # The count is read from the rollup maintained on insert, summing the shard rows of the type.
+    select_query = "SELECT COALESCE(sum(count), 0)::bigint FROM device_type_counts WHERE device_type=%s"
+
+    conf = settings.get_settings()
+    res = db_layer.read_from_db(
+        select_query,
+        (device_type,),
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    if res[0]:
+        return res[1][0][0]
+
+    return None
+
+
+def read_device_counts(device_types=None, after="", limit=None):
+    """
+    Read the amount of devices registered for many types from DB, in a single grouped query
+    :param list device_types: types of device to count, None to count every type
+    :param str after: with device_types None, only types sorted after this one are counted (paging)
+    :param int limit: with device_types None, maximum number of types counted
+    :return list: (device_type, count) sorted by device_type, or None if the DB could not be read
+    """
+
+    if device_types is not None:
+        select_query = (
+            "SELECT device_type, sum(count)::bigint FROM device_type_counts"
+            " WHERE device_type = ANY(%(device_types)s)"
+            " GROUP BY device_type ORDER BY device_type"
+        )
+    else:
+        select_query = (
+            "SELECT device_type, sum(count)::bigint FROM device_type_counts"
+            " WHERE device_type > %(after)s"
+            " GROUP BY device_type HAVING sum(count) > 0 ORDER BY device_type LIMIT %(limit)s"
+        )
+
+    conf = settings.get_settings()
+    res = db_layer.read_from_db(
+        select_query,
+        {"device_types": device_types, "after": after, "limit": limit},
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    if res[0]:
+        return res[1]
+
+    return None
+
+
+def count_etag(device_type: str, count) -> str:
+    """
+    Strong ETag of the count of a device type, its version: known as soon as the count is,
+    before the body of the response is built
+    :param str device_type: type of device
+    :param count: count of the type, from the snapshot, the cache or the DB
+    :return str: ETag
+    """
+    return hashlib.sha1("{}:{}".format(device_type, count).encode()).hexdigest()[:20]
+
+
+def statistics_response(data, etag=None):
+    """
+    Build the response of a statistics request, with a strong ETag derived from its content
+    (e.g., the count of the device type) and the Cache-Control policy of the settings.
+    A request whose If-None-Match matches the ETag is answered with 304 and no body.
+    :param dict data: body of the response
+    :param str etag: version of the content (e.g., count_etag()), derived from the body when None
+    :return: response
+    """
+    if etag is not None and request.if_none_match.contains(etag):
+        # the client has this version, the body isn't built
+        result = app.response_class(status=304)
+    else:
+        body = json.dumps(data)
+        result = app.response_class(response=body, status=200, mimetype="application/json")
+        etag = etag or hashlib.sha1(body.encode()).hexdigest()[:20]
+    result.set_etag(etag)
+    result.headers["Cache-Control"] = settings.get_settings().statistics_cache_control
+
+    return result.make_conditional(request)
+
+
+@app.route("/Log/auth/statistics", methods=["GET"])
+def get_device_counts():
+    """Retrieve the amount of devices registered for the deviceType parameters, or for every type"""
+    conf = settings.get_settings()
+
+    device_types = request.args.getlist("deviceType") or None
+    after = request.args.get("after", "")
+    try:
+        limit = min(
+            int(request.args.get("limit", conf.statistics_bulk_page_size)),
+            conf.statistics_bulk_page_size,
         )
+        if limit <= 0:
+            raise ValueError("limit must be positive")
+        if device_types is not None and len(device_types) > conf.statistics_bulk_max_types:
+            raise ValueError("Too many deviceType parameters")
+
+    except ValueError:
+        raise ThreatStackRequestError(
+            "Invalid deviceType, after or limit parameter.", status_code=400
+        )
+
+    rows = coalesced_read(
+        "counts",
+        json.dumps([device_types, after, limit]),
+        lambda: read_device_counts(device_types, after, limit),
+    )
+    if rows is None:
+        data = {"Error Message": "Fetching resulted in Error"}
+        return app.response_class(
+            response=json.dumps(data), status=520, mimetype="application/json"
+        )
+
+    # the counts just read also refresh the cache of /Log/auth/statistics/<deviceType>
+    counts = dict(rows)
+    for device_type in device_types or counts:
+        count_cache.set(device_type, counts.get(device_type, 0))
+
+    if device_types is not None:
+        # same contract as /Log/auth/statistics/<deviceType>, in the order of the request
+        data = {
+            "counts": [
+                {"deviceType": device_type, "count": counts.get(device_type) or "-1"}
+                for device_type in dict.fromkeys(device_types)
+            ],
+            "next": None,
+        }
+    else:
+        # keyset paging: the next page starts after the last type of this one
+        data = {
+            "counts": [
+                {"deviceType": device_type, "count": count} for device_type, count in rows
+            ],
+            "next": rows[-1][0] if len(rows) == limit else None,
+        }
+
+    return statistics_response(data)
+
+
+# length of the buckets of a time series
+BUCKETS = {
+    "hour": datetime.timedelta(hours=1),
+    "day": datetime.timedelta(days=1),
+    "week": datetime.timedelta(weeks=1),
+}
+
+
+def parse_time_param(value: str) -> datetime.datetime:
+    """
+    Parse an ISO 8601 date or datetime received in a query string
+    :param str value: e.g. 2024-01-31 or 2024-01-31T10:00:00+02:00, UTC if no offset is given
+    :return datetime: naive datetime in UTC
+    """
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    return parsed
+
+
+def truncate_to_bucket(moment: datetime.datetime, bucket: str) -> datetime.datetime:
+    """Return the start of the bucket containing moment, as date_trunc() of postgresql"""
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    if bucket in ("day", "week"):
+        moment = moment.replace(hour=0)
+    if bucket == "week":
+        moment -= datetime.timedelta(days=moment.weekday())
+
+    return moment
+
+
+def read_device_series(device_type: str, bucket: str, start, end):
+    """
+    Read the amount of devices registered for a type per bucket of time from the hourly rollup
+    :param str device_type: type of device to count
+    :param str bucket: hour, day or week
+    :param datetime start: first bucket to read (inclusive), aligned on the bucket
+    :param datetime end: end of the period (exclusive)
+    :return dict: count per start of bucket, or None if the DB could not be read
+    """
+
+    select_query = (
+        "SELECT date_trunc(%(bucket)s, bucket) AS period, sum(count)::bigint"
+        " FROM device_type_hourly_counts"
+        " WHERE device_type = %(device_type)s AND bucket >= %(start)s AND bucket < %(end)s"
+        " GROUP BY period"
+    )
+
+    conf = settings.get_settings()
+    res = db_layer.read_from_db(
+        select_query,
+        {"bucket": bucket, "device_type": device_type, "start": start, "end": end},
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    if res[0]:
+        return dict(res[1])
+
+    return None
+
+
+def get_device_series(device_type: str):
+    """Retrieve the amount of devices registered by type, as a time series between from and to"""
+    conf = settings.get_settings()
+
+    try:
+        bucket = request.args.get("bucket", "day")
+        if bucket not in BUCKETS:
+            raise ValueError("Unknown bucket [{}]".format(bucket))
+
+        end = (
+            parse_time_param(request.args["to"])
+            if "to" in request.args
+            else datetime.datetime.utcnow()
+        )
+        start = (
+            parse_time_param(request.args["from"])
+            if "from" in request.args
+            else end - datetime.timedelta(days=conf.statistics_default_range_days)
+        )
+        start = truncate_to_bucket(start, bucket)
+        if start >= end:
+            raise ValueError("from must be before to")
+        if (end - start) / BUCKETS[bucket] > conf.statistics_max_series_points:
+            raise ValueError("Too many points in the series")
+
+    except ValueError:
+        raise ThreatStackRequestError(
+            "Invalid from, to or bucket parameter.", status_code=400
+        )
+
+    counts = read_device_series(device_type, bucket, start, end)
+    if counts is None:
+        data = {"Error Message": "Fetching resulted in Error"}
+        return app.response_class(
+            response=json.dumps(data), status=520, mimetype="application/json"
+        )
+
+    # every bucket of the period is reported, including the empty ones
+    series = []
+    period = start
+    while period < end:
+        series.append({"start": period.isoformat() + "Z", "count": counts.get(period, 0)})
+        period = truncate_to_bucket(period + BUCKETS[bucket], bucket)
+
+    data = {
+        "deviceType": device_type,
+        "bucket": bucket,
+        "from": start.isoformat() + "Z",
+        "to": end.isoformat() + "Z",
+        "series": series,
+    }
+
+    return statistics_response(data)
 
 
 @app.route("/Log/auth/statistics/<string:deviceType>", methods=["GET"])
 def get_device_count(deviceType: str):
-    """Retrieve the amount of devices registered by type"""
+    """Retrieve the amount of devices registered by type, or a time series with from, to & bucket"""
 
     DEVICE_TYPE_RECEIVED = deviceType
 
-    # parameterized SQL query to qvoid SQL Injection attacks.
-    select_query = "SELECT * FROM devices WHERE device_type=%s"
+    if any(key in request.args for key in ("from", "to", "bucket")):
+        return get_device_series(DEVICE_TYPE_RECEIVED)
 
     try:
-        res = db_layer.read_from_db(
-            select_query,
-            (DEVICE_TYPE_RECEIVED,),
-            database_user,
-            database_password,
-            database_host,
-            database_port,
-        )
-        if res[0]:
-            if len(res[1]) == 0:
+        # answered by the snapshot shared by the workers when it is fresh, by the cache otherwise:
+        # the DB is only read when neither has the count, If-None-Match included
+        snapshot_count = read_snapshot_count(DEVICE_TYPE_RECEIVED)
+        if snapshot_count is not None:
+            (count, age), cache_status = snapshot_count, "SNAPSHOT"
+        else:
+            count, cache_status, age = count_cache.get_or_load(
+                DEVICE_TYPE_RECEIVED,
+                lambda: coalesced_read(
+                    "count",
+                    DEVICE_TYPE_RECEIVED,
+                    lambda: read_device_count(DEVICE_TYPE_RECEIVED),
+                ),
+            )
+        if count is not None:
+            if count == 0:
                 data = {"deviceType": DEVICE_TYPE_RECEIVED, "count": "-1"}
-                result = app.response_class(
-                    response=json.dumps(data), status=200, mimetype="application/json"
-                )
-
             else:
-                data = {"deviceType": DEVICE_TYPE_RECEIVED, "count": len(res[1])}
-                result = app.response_class(
-                    response=json.dumps(data), status=200, mimetype="application/json"
-                )
+                data = {"deviceType": DEVICE_TYPE_RECEIVED, "count": count}
+
+            # the ETag is the version of the count, not a digest of the body: If-None-Match is
+            # answered with 304 as soon as the count is known
+            result = statistics_response(data, count_etag(DEVICE_TYPE_RECEIVED, count))
+
+            # tell client whether the count was served from the cache of the worker and how old it is;
+            # a 304 only refreshes the stored response, a stale count has no Age, and the Age of a
+            # fresh one never exceeds the max-age caches keep it for
+            if result.status_code == 200:
+                result.headers["X-Cache"] = cache_status
+                if cache_status != "STALE":
+                    max_age = result.cache_control.max_age
+                    age = int(age) if max_age is None else min(int(age), max_age)
+                    result.headers["Age"] = str(age)
         else:
             data = {"Error Message": "Fetching resulted in Error"}
             result = app.response_class(
@@ -245,13 +886,177 @@ def get_device_count(deviceType: str):
         )
 
 
+# formats of /Log/auth/export: mimetype & extension of the file
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+
+
+def read_devices(device_types=None, start=None, end=None):
+    """
+    Read the registered devices from DB in batches, whatever the layout of the devices table
+    (device type name inline, or id of device_types when normalized)
+    :param list device_types: types of device to read, None for every type
+    :param datetime start: aware datetime, only devices added from this moment
+    :param datetime end: aware datetime, only devices added before this moment
+    :return generator: lists of (id, device_type, date_added), or None if the DB could not be read
+    """
+    conf = settings.get_settings()
+
+    res = db_layer.read_from_db(
+        "SELECT EXISTS (SELECT 1 FROM pg_attribute WHERE attrelid = to_regclass(%s) AND attname = 'device_type_id' AND NOT attisdropped)",
+        (conf.db_table,),
+        conf.db_user,
+        conf.db_password,
+        conf.db_host,
+        conf.db_port,
+    )
+    if not res[0]:
+        return None
+
+    if res[1][0][0]:
+        select_query = "SELECT d.id, t.name, d.date_added FROM {table} d JOIN device_types t ON t.id = d.device_type_id"
+        conditions = ["t.name = ANY(%(device_types)s)"] if device_types else []
+    else:
+        select_query = "SELECT d.id, d.device_type, d.date_added FROM {table} d"
+        conditions = ["d.device_type = ANY(%(device_types)s)"] if device_types else []
+    if start is not None:
+        conditions.append("d.date_added >= %(start)s")
+    if end is not None:
+        conditions.append("d.date_added < %(end)s")
+    if conditions:
+        select_query += " WHERE " + " AND ".join(conditions)
+
+    # rows are streamed in the order of the scan, sorting the whole table would only move the cost to the DB
+    try:
+        return db_layer.stream_from_db(
+            sql.SQL(select_query).format(table=sql.Identifier(conf.db_table)),
+            {"device_types": device_types, "start": start, "end": end},
+            conf.db_user,
+            conf.db_password,
+            conf.db_host,
+            conf.db_port,
+            batch_size=conf.export_batch_size,
+        )
+    except Exception as err:
+        print("[Exception] export failed:", err)
+        return None
+
+
+def format_date_added(value) -> str:
+    """date_added in ISO 8601, in UTC for a timestamptz"""
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        return value.astimezone(datetime.timezone.utc).isoformat().replace("+00:00", "Z")
+
+    return value.isoformat()
+
+
+@app.route("/Log/auth/export", methods=["GET"])
+def export_devices():
+    """Stream the devices registered, optionally of some deviceTypes & between from and to"""
+    if not check_authentication_token(request.headers.get("userKey")):
+        data = {"ERROR": "Authentication failed", "StatusCode": "403"}
+        return app.response_class(
+            response=json.dumps(data), status=403, mimetype="application/json"
+        )
+
+    export_format = request.args.get("format", "ndjson")
+    try:
+        mimetype, extension = EXPORT_FORMATS[export_format]
+        start, end = (
+            parse_time_param(request.args[name]).replace(tzinfo=datetime.timezone.utc)
+            if name in request.args
+            else None
+            for name in ("from", "to")
+        )
+    except (KeyError, ValueError):
+        raise ThreatStackRequestError(
+            "Invalid format, from or to parameter.", status_code=400
+        )
+
+    batches = read_devices(request.args.getlist("deviceType") or None, start, end)
+    if batches is None:
+        data = {"Error Message": "Fetching resulted in Error"}
+        return app.response_class(
+            response=json.dumps(data), status=520, mimetype="application/json"
+        )
+
+    def generate():
+        # one chunk per batch of rows, the worker never holds more than a batch
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        if export_format == "csv":
+            writer.writerow(("id", "deviceType", "dateAdded"))
+        try:
+            for rows in batches:
+                for device_id, device_type, date_added in rows:
+                    if export_format == "csv":
+                        writer.writerow(
+                            (device_id, device_type, format_date_added(date_added))
+                        )
+                    else:
+                        buffer.write(
+                            json.dumps(
+                                {
+                                    "id": device_id,
+                                    "deviceType": device_type,
+                                    "dateAdded": format_date_added(date_added),
+                                }
+                            )
+                            + "\n"
+                        )
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+            # header of an empty CSV export
+            if buffer.tell():
+                yield buffer.getvalue()
+        except Exception as e:
+            # the status is sent already: the stream is cut, the client sees an incomplete body
+            print("[Exception] export interrupted:", e)
+            raise
+        finally:
+            batches.close()
+
+    result = app.response_class(generate(), status=200, mimetype=mimetype)
+    result.headers["Content-Disposition"] = "attachment; filename=devices.{}".format(
+        extension
+    )
+    # nginx passes the chunks on as they come instead of buffering the export
+    result.headers["X-Accel-Buffering"] = "no"
+
+    return result
+
+
 # Check validity of recieved token(i.e., userKey) for authentication
 def check_authentication_token(token: str) -> bool:
     """Handle authentication of API
     :param str token-> a received token to be validated
     :return bool: True if OK otherwise False
     """
-    if token == statistics_user_key:
+    if token == settings.get_settings().user_key:
         return True
 
     return False
+
+
+def reload_settings_on_signal(signum, frame):
+    """
+    Reload the settings of every worker, e.g. on `kill -USR2` of a server other than uWSGI
+    (uWSGI handles SIGUSR2 in its workers, use /api/admin/reload-config)
+    """
+    try:
+        settings.request_reload()
+    except OSError as err:
+        print("[Exception] unable to request a reload of the settings:", err)
+        settings.reload_settings()
+        return
+    settings.check_generation()
+
+
+# signal handlers can only be installed from the main thread (i.e., not under a threaded server)
+try:
+    signal.signal(signal.SIGUSR2, reload_settings_on_signal)
+except ValueError:
+    pass
@@ -0,0 +1,269 @@
+"""
+This module exposes Prometheus metrics of StatisticsAPI.
+uWSGI serves requests from several worker processes, each one counting its own requests; when the
+ENV variable PROMETHEUS_MULTIPROC_DIR is set (see config/uwsgi.ini), every worker writes its
+values to memory-mapped files of this directory and export() aggregates the files of all workers,
+so /metrics reports the same totals whatever the worker serving the scrape.
+
+* instrument() --> count requests & observe their latency per route, method and status code
+* time_db() --> observe the time spent in a phase (connect, execute, fetch) of a db_layer call
+* observe_in_flight() & observe_shed() --> requests in flight & requests shed (src.admission)
+* observe_read() & observe_replica() --> reads per endpoint (replica or primary) & lag of the replicas
+* observe_snapshot() --> counts answered by the shared snapshot, or read from the DB when stale
+* observe_single_flight() --> statistics reads run, or shared with an identical read in flight
+* observe_upstream() --> observe the time spent in a request to DeviceRegistrationAPI
+* observe_circuit_transition() & observe_circuit_rejection() --> state of the circuit breakers
+* export() --> metrics of all the workers, in the Prometheus text format
+
+@author: MMB
+"""
+import atexit
+import os
+import time
+from contextlib import contextmanager
+
+from flask import request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+try:
+    # only importable in a process run by uWSGI
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+REQUESTS = Counter(
+    "http_requests_total",
+    "HTTP requests served",
+    ["route", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "Time spent serving HTTP requests",
+    ["route", "method", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+# requests being served by the live workers, priority is health, write or read
+IN_FLIGHT = Gauge(
+    "http_requests_in_flight",
+    "HTTP requests in flight, admitted by admission control",
+    ["route", "priority"],
+    multiprocess_mode="livesum",
+)
+# limit is route, in_flight, reads, queue, pool or upstream
+SHED = Counter(
+    "http_requests_shed_total",
+    "HTTP requests answered with 503 by admission control",
+    ["route", "priority", "limit"],
+)
+# connect is the checkout of a connection from the pool of the worker, opening it when none is idle
+DB_LATENCY = Histogram(
+    "db_operation_duration_seconds",
+    "Time spent in db_layer calls, per phase",
+    ["operation", "phase"],
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1, 5),
+)
+DB_ERRORS = Counter(
+    "db_operation_errors_total",
+    "db_layer calls which failed",
+    ["operation"],
+)
+# role is replica or primary, the endpoint is host:port
+DB_READS = Counter(
+    "db_reads_total",
+    "Read queries served, per database endpoint",
+    ["endpoint", "role"],
+)
+# the worst lag seen by the live workers, NaN while the replica can't be queried
+REPLICA_LAG = Gauge(
+    "db_replica_lag_seconds",
+    "Replay lag of a read replica",
+    ["endpoint"],
+    multiprocess_mode="livemax",
+)
+REPLICA_HEALTHY = Gauge(
+    "db_replica_healthy",
+    "Read replica in use (1) or ejected (0)",
+    ["endpoint"],
+    multiprocess_mode="livemin",
+)
+# result is hit (answered by the snapshot) or stale (read from the DB)
+SNAPSHOT_READS = Counter(
+    "count_snapshot_reads_total",
+    "Counts of device types looked up in the shared snapshot",
+    ["result"],
+)
+# role is leader (the read ran), follower (shared in the worker) or shared (across workers)
+SINGLE_FLIGHT = Counter(
+    "single_flight_reads_total",
+    "Statistics reads, run or shared with an identical read in flight",
+    ["operation", "role"],
+)
+# status is "error" when no response was received (e.g., connection refused, timeout)
+UPSTREAM_LATENCY = Histogram(
+    "upstream_request_duration_seconds",
+    "Time spent in requests to remote servers",
+    ["host", "method", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+# the worst state over the live workers: 0 closed, 1 half-open, 2 open
+CIRCUIT_STATE = Gauge(
+    "circuit_breaker_state",
+    "State of the circuit breaker to a remote server",
+    ["host"],
+    multiprocess_mode="livemax",
+)
+CIRCUIT_TRANSITIONS = Counter(
+    "circuit_breaker_transitions_total",
+    "Transitions of the circuit breaker to a remote server",
+    ["host", "from_state", "to_state"],
+)
+CIRCUIT_REJECTED = Counter(
+    "circuit_breaker_rejected_total",
+    "Requests refused by an open circuit breaker",
+    ["host"],
+)
+CIRCUIT_STATES = {"closed": 0, "half_open": 1, "open": 2}
+
+
+def instrument(app):
+    """
+    Count the requests of a Flask application and observe their latency
+    :param Flask app: application to instrument
+    """
+    wsgi_app = app.wsgi_app
+
+    def timed_wsgi_app(environ, start_response):
+        environ["metrics.start"] = time.perf_counter()
+        return wsgi_app(environ, start_response)
+
+    @app.after_request
+    def observe_request(response):
+        start = request.environ.get("metrics.start")
+        if start is not None:
+            # the rule, not the path, to keep one serie per route
+            # (e.g., /Log/auth/statistics/<deviceType>)
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            labels = (route, request.method, str(response.status_code))
+            REQUESTS.labels(*labels).inc()
+            REQUEST_LATENCY.labels(*labels).observe(time.perf_counter() - start)
+        return response
+
+    app.wsgi_app = timed_wsgi_app
+
+
+@contextmanager
+def time_db(operation, phase):
+    """
+    Observe the time spent in the with block
+    :param str operation: db_layer call (e.g., read)
+    :param str phase: connect, execute or fetch
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        DB_LATENCY.labels(operation, phase).observe(time.perf_counter() - start)
+
+
+def observe_in_flight(route, priority, delta):
+    """Count a request admitted (delta 1) or done (delta -1) by src.admission"""
+    IN_FLIGHT.labels(route, priority).inc(delta)
+
+
+def observe_shed(route, priority, limit):
+    """Count a request refused by src.admission"""
+    SHED.labels(route, priority, limit).inc()
+
+
+def observe_read(endpoint, role):
+    """Count a read query served by a database endpoint (replica or primary)"""
+    DB_READS.labels(endpoint, role).inc()
+
+
+def observe_replica(replica):
+    """Observe the outcome of a health check of a replica (src.replicas)"""
+    REPLICA_LAG.labels(replica.name).set(
+        float("nan") if replica.lag is None else replica.lag
+    )
+    REPLICA_HEALTHY.labels(replica.name).set(1 if replica.healthy else 0)
+
+
+def observe_snapshot(result):
+    """Count a lookup in the shared snapshot of counts (src.count_snapshot)"""
+    SNAPSHOT_READS.labels(result).inc()
+
+
+def observe_single_flight(operation, role):
+    """Count a statistics read coalesced by src.single_flight"""
+    SINGLE_FLIGHT.labels(operation, role).inc()
+
+
+def observe_upstream(host, method, status, seconds):
+    """
+    Observe the time spent in a request to a remote server
+    :param str host: host:port of the remote server
+    :param str method: HTTP method
+    :param status: status code of the response, or "error"
+    :param float seconds: time spent
+    """
+    UPSTREAM_LATENCY.labels(host, method, str(status)).observe(seconds)
+
+
+def observe_circuit_transition(host, old_state, new_state):
+    """Count a transition of the circuit breaker of the worker to a remote server"""
+    if old_state is not None:
+        CIRCUIT_TRANSITIONS.labels(host, old_state, new_state).inc()
+    CIRCUIT_STATE.labels(host).set(CIRCUIT_STATES[new_state])
+
+
+def observe_circuit_rejection(host):
+    """Count a request refused by the circuit breaker of the worker"""
+    CIRCUIT_REJECTED.labels(host).inc()
+
+
+def _mark_process_dead():
+    # gauges of a worker which exits are no more reported
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(os.getpid())
+
+
+
+def _at_exit(func):
+    """Call func when the worker exits, uWSGI ending its workers without the atexit hooks"""
+    atexit.register(func)
+    if uwsgi is not None:
+        previous = getattr(uwsgi, "atexit", None)
+
+        def hook():
+            func()
+            if previous is not None:
+                previous()
+
+        uwsgi.atexit = hook
+
+
+_at_exit(_mark_process_dead)
+
+
+def export() -> (bytes, str):
+    """
+    Metrics of all the workers, in the Prometheus text format
+    :return tuple: body & content type of the response
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        # a single process, e.g. the Flask development server
+        registry = REGISTRY
+
+    return (generate_latest(registry), CONTENT_TYPE_LATEST)
@@ -0,0 +1,191 @@
+"""
+This module routes the read-only queries of a worker to the read replicas of the database.
+A background thread of the worker checks every replica each CHECK_INTERVAL seconds; a replica
+which can't be reached, or whose replay lag is above MAX_LAG seconds, is ejected until a later
+check finds it healthy again. Requests never wait for a check, and the primary serves the reads
+when no replica is healthy.
+
+* Replica --> health, lag & reads of a read endpoint
+* ReplicaSet --> round-robin over the healthy replicas, and the thread checking them
+* get_replica_set() --> returns the replica set of the current worker process, started after fork
+* get_replica_stats() --> returns health, lag & reads of every replica of the worker
+
+@author: MMB
+"""
+
+import itertools
+import os
+import threading
+import time
+
+
+class Replica:
+    """A read endpoint of the database"""
+
+    def __init__(self, host, port):
+        """
+        :param str host: host of the replica
+        :param str port: port of the replica
+        """
+        self.host = host
+        self.port = port
+        self.name = "{}:{}".format(host, port)
+
+        # unknown until the first check, a replica is not used before
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+        self.error = None
+        self.reads = 0
+        self.ejections = 0
+
+    def stats(self) -> dict:
+        return {
+            "endpoint": self.name,
+            "healthy": self.healthy,
+            "lag": self.lag,
+            "checked_ago": None
+            if self.checked_at is None
+            else round(time.monotonic() - self.checked_at, 3),
+            "error": self.error,
+            "reads": self.reads,
+            "ejections": self.ejections,
+        }
+
+
+class ReplicaSet:
+    """The replicas of a worker, health-checked by a background thread"""
+
+    def __init__(self, endpoints, check, max_lag=10, check_interval=5, on_check=None):
+        """
+        :param list endpoints: (host, port) of every replica
+        :param callable check: function (host, port) returning the replay lag of a replica in
+        seconds, raising an exception when the replica can't be queried
+        :param float max_lag: lag in seconds above which a replica is ejected
+        :param float check_interval: seconds between two checks of the replicas
+        :param on_check: called with (replica) after every check
+        """
+        self.endpoints = tuple(endpoints)
+        self.replicas = [Replica(host, port) for host, port in self.endpoints]
+        self.check = check
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.on_check = on_check
+
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="replica-checker", daemon=True
+        )
+        self._thread.start()
+
+    def _check(self, replica):
+        try:
+            lag = self.check(replica.host, replica.port)
+            error = None if lag <= self.max_lag else "lag above {}s".format(self.max_lag)
+        except Exception as err:
+            lag = None
+            error = str(err).strip() or type(err).__name__
+
+        with self._lock:
+            if replica.healthy and error is not None:
+                replica.ejections += 1
+                print("[Replica] {} ejected: {}".format(replica.name, error))
+            elif not replica.healthy and error is None:
+                print("[Replica] {} is healthy, lag {}s".format(replica.name, lag))
+            replica.healthy = error is None
+            replica.lag = lag
+            replica.error = error
+            replica.checked_at = time.monotonic()
+
+        if self.on_check is not None:
+            self.on_check(replica)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            for replica in self.replicas:
+                self._check(replica)
+            self._stopping.wait(self.check_interval)
+
+    def candidates(self) -> list:
+        """
+        Healthy replicas to send a read to, in order of preference: each call starts with the
+        next replica, so the reads of the worker are spread over them
+        :return list: Replica
+        """
+        with self._lock:
+            healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            return []
+
+        start = next(self._next) % len(healthy)
+        return healthy[start:] + healthy[:start]
+
+    def record_read(self, replica):
+        """Count a read served by the replica"""
+        with self._lock:
+            replica.reads += 1
+
+    def eject(self, replica, err):
+        """Eject a replica which failed a read, until its next successful check"""
+        with self._lock:
+            if replica.healthy:
+                replica.healthy = False
+                replica.ejections += 1
+                replica.error = str(err).strip() or type(err).__name__
+                print("[Replica] {} ejected: {}".format(replica.name, replica.error))
+
+    def close(self):
+        """Stop checking the replicas"""
+        self._stopping.set()
+
+    def stats(self) -> list:
+        """Return health, lag & reads of every replica"""
+        with self._lock:
+            return [replica.stats() for replica in self.replicas]
+
+
+_replica_set = None
+_replica_set_pid = None
+_replica_set_endpoints = ()
+_replica_set_lock = threading.Lock()
+
+
+def get_replica_set(endpoints, check, **replica_set_kwargs) -> ReplicaSet:
+    """
+    Return the replica set of the current process, created (with its thread) after fork,
+    and created again when the endpoints change (e.g., settings reloaded)
+    :param list endpoints: (host, port) of every replica, empty when reads go to the primary
+    :param callable check: function returning the replay lag of a replica, see ReplicaSet
+    :param replica_set_kwargs: parameters of ReplicaSet, used when the set is created
+    :return: ReplicaSet, or None without endpoints
+    """
+    global _replica_set, _replica_set_pid, _replica_set_endpoints
+
+    endpoints = tuple(endpoints)
+    with _replica_set_lock:
+        if _replica_set_pid != os.getpid() or _replica_set_endpoints != endpoints:
+            # the thread of a set inherited from the parent process is not running
+            if _replica_set is not None and _replica_set_pid == os.getpid():
+                _replica_set.close()
+            _replica_set = (
+                ReplicaSet(endpoints, check, **replica_set_kwargs) if endpoints else None
+            )
+            _replica_set_pid = os.getpid()
+            _replica_set_endpoints = endpoints
+
+        return _replica_set
+
+
+def get_replica_stats() -> list:
+    """
+    Return health, lag & reads of the replicas of the current process
+    :return list: one dict per replica
+    """
+    with _replica_set_lock:
+        if _replica_set_pid != os.getpid() or _replica_set is None:
+            return []
+        replica_set = _replica_set
+
+    return replica_set.stats()
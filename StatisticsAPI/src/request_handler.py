@@ -1,12 +1,239 @@
 """
 This moudle handles Http requests to a remote server.
-Two functions implemented:
-* send_post_request() --> send a POST request to the remove through requests lib
-* send_get_request() --> send a GET request to the remove through requests lib
+Requests go through a session owned by the worker process, which keeps connections alive
+in a pool and reuses them across requests.
+Every remote host is guarded by a circuit breaker of the worker (src.circuit_breaker): while it
+is open, requests fail at once with CircuitOpenError instead of waiting for their timeout.
+Failed requests are retried with a jittered exponential backoff, within a deadline per request.
+Besides http(s)://, the session sends http+unix://<percent-encoded socket path>/<path> URLs
+through a unix socket (requests_unixsocket), e.g. to a DeviceRegistrationAPI on the same host.
+Functions implemented:
+* send_post_request() --> send a POST request to the remove through the session of the worker
+* send_get_request() --> send a GET request to the remove through the session of the worker
+* get_breaker() --> return the circuit breaker of the worker for a remote host
+* remote_host() --> host:port (or socket path) of a URL, naming its breaker & metrics
+* backoff_delay() & retry_after_seconds() --> delay before a retry
+* get_session_stats() --> return connection reuse statistics of the session of the worker
+* get_breaker_stats() --> return state & transitions of the circuit breakers of the worker
+
+The time spent in every request is observed in src.metrics, per remote host & status code.
 
 @author: MMB
 """
+import os
+import random
+import threading
+import time
+from urllib.parse import unquote, urlsplit
+
 import requests
+import requests_unixsocket
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError, ProtocolError
+from src import circuit_breaker
+from src import metrics
+from src import settings
+from src.circuit_breaker import CircuitOpenError
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+_requests_sent = 0
+_breakers = {}
+
+# DeviceRegistrationAPI answers 503 when it did not store the event (e.g., write-behind buffer
+# full), thus a POST is sent again; other statuses of gateways are retried for a GET only.
+RETRY_STATUS_POST = (503,)
+RETRY_STATUS_GET = (502, 503, 504)
+
+
+def _get_session() -> requests.Session:
+    """Return the session of the current process, created after fork"""
+    global _session, _session_pid, _requests_sent
+
+    with _session_lock:
+        if _session_pid != os.getpid():
+            conf = settings.get_settings()
+
+            # retries are made by _send_request(), within the deadline of the request
+            adapter = HTTPAdapter(
+                pool_connections=conf.http_pool_connections,
+                pool_maxsize=conf.http_pool_maxsize,
+                max_retries=0,
+            )
+
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            # the timeout of every request is given to the connections, as for TCP
+            session.mount(
+                requests_unixsocket.DEFAULT_SCHEME,
+                requests_unixsocket.UnixAdapter(
+                    timeout=conf.http_connect_timeout,
+                    pool_connections=conf.http_pool_connections,
+                ),
+            )
+            if not conf.http_keep_alive:
+                session.headers["Connection"] = "close"
+
+            _session = session
+            _session_pid = os.getpid()
+            _requests_sent = 0
+            _breakers.clear()
+
+        return _session
+
+
+def _on_transition(host, old_state, new_state):
+    print("[CircuitBreaker] {}: {} -> {}".format(host, old_state, new_state))
+    metrics.observe_circuit_transition(host, old_state, new_state)
+
+
+def get_breaker(host):
+    """
+    Return the circuit breaker of the worker for a remote host
+    :param str host: host:port of the remote server
+    :return CircuitBreaker: or None when disabled in the settings
+    """
+    conf = settings.get_settings()
+    if not conf.circuit_breaker_enabled:
+        return None
+
+    _get_session()
+    with _session_lock:
+        breaker = _breakers.get(host)
+        if breaker is None:
+            breaker = circuit_breaker.CircuitBreaker(
+                host,
+                window=conf.circuit_breaker_window,
+                min_calls=conf.circuit_breaker_min_calls,
+                failure_ratio=conf.circuit_breaker_failure_ratio,
+                open_seconds=conf.circuit_breaker_open_seconds,
+                half_open_max_calls=conf.circuit_breaker_half_open_max_calls,
+                on_transition=_on_transition,
+            )
+            _breakers[host] = breaker
+            metrics.observe_circuit_transition(host, None, circuit_breaker.CLOSED)
+
+        return breaker
+
+
+def remote_host(url) -> str:
+    """
+    Name of the remote server of a URL
+    :param str url: e.g. http://host:port/path or http+unix://%2Ftmp%2Fapi.sock/path
+    :return str: host:port, or the path of the unix socket
+    """
+    return unquote(urlsplit(url).netloc)
+
+
+def backoff_delay(attempt) -> float:
+    """
+    Delay before a retry: exponential backoff with full jitter, so the retries of many
+    workers failing at the same time are spread instead of hitting the server together
+    :param int attempt: number of the retry, from 0
+    :return float: seconds
+    """
+    conf = settings.get_settings()
+    ceiling = min(conf.http_retry_backoff_max, conf.http_retry_backoff * (2**attempt))
+    return random.uniform(0, ceiling)
+
+
+def _count_request():
+    global _requests_sent
+
+    with _session_lock:
+        _requests_sent += 1
+
+
+def _never_sent(err) -> bool:
+    """The request failed before reaching the server, thus sending it again is safe"""
+    if isinstance(err, requests.exceptions.ConnectTimeout):
+        return True
+
+    if not isinstance(err, requests.exceptions.ConnectionError) or not err.args:
+        return False
+
+    # MaxRetryError wraps the error of the connection in its reason
+    reason = getattr(err.args[0], "reason", None) or err.args[0]
+    if isinstance(reason, NewConnectionError):
+        return True
+
+    # over a unix socket (requests_unixsocket), a missing or refused socket fails in connect()
+    # and is wrapped in a ProtocolError
+    return (
+        isinstance(reason, ProtocolError)
+        and len(reason.args) > 1
+        and isinstance(reason.args[1], (FileNotFoundError, ConnectionRefusedError))
+    )
+
+
+def retry_after_seconds(res) -> float:
+    """Seconds of the Retry-After header of a response (requests or httpx), 0 when absent"""
+    try:
+        return float(res.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0.0
+
+
+def _send_request(method, url, **kwargs) -> requests.Response:
+    """
+    Send a request through the session of the worker, retrying failures within the deadline
+    :raise CircuitOpenError: when the circuit of the remote host is open
+    :raise requests.exceptions.RequestException: when no response was received
+    """
+    conf = settings.get_settings()
+    session = _get_session()
+    host = remote_host(url)
+    breaker = get_breaker(host)
+    deadline = time.monotonic() + conf.http_deadline
+    retry_status = RETRY_STATUS_GET if method == "GET" else RETRY_STATUS_POST
+
+    attempt = 0
+    while True:
+        if breaker is not None:
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                metrics.observe_circuit_rejection(host)
+                raise
+
+        _count_request()
+        remaining = max(deadline - time.monotonic(), 0.001)
+        timeout = (
+            min(conf.http_connect_timeout, remaining),
+            min(conf.http_read_timeout, remaining),
+        )
+        req = None
+        error = None
+        start = time.perf_counter()
+        try:
+            req = session.request(method, url, verify=False, timeout=timeout, **kwargs)
+        except requests.exceptions.RequestException as err:
+            error = err
+        finally:
+            status = req.status_code if req is not None else "error"
+            metrics.observe_upstream(host, method, status, time.perf_counter() - start)
+            if breaker is not None:
+                breaker.record(failed=req is None or req.status_code >= 500)
+
+        if req is not None:
+            if req.status_code not in retry_status:
+                return req
+            delay = max(backoff_delay(attempt), retry_after_seconds(req))
+        else:
+            # a POST which may have reached the server is not sent twice
+            if method != "GET" and not _never_sent(error):
+                raise error
+            delay = backoff_delay(attempt)
+
+        if attempt >= conf.http_retries or time.monotonic() + delay >= deadline:
+            if req is not None:
+                return req
+            raise error
+
+        time.sleep(delay)
+        attempt += 1
 
 
 def send_post_request(url, json_data, headers):
@@ -16,8 +243,7 @@ def send_post_request(url, json_data, headers):
     :param json headers: headers of http request
     :return list: request status_code & json
     """
-
-    req = requests.post(url, data=json_data, headers=headers, verify=False, timeout=10)
+    req = _send_request("POST", url, data=json_data, headers=headers)
     return (req.status_code, req.json())
 
 
@@ -27,6 +253,56 @@ def send_get_request(url, headers):
     :param json headers: headers of http request
     :return list: request status_code & json
     """
-    req = requests.get(url, headers=headers, verify=False, timeout=10)
+    req = _send_request("GET", url, headers=headers)
 
     return (req.status_code, req.json())
+
+
+def get_session_stats() -> dict:
+    """
+    Return connection reuse statistics of the session of the worker
+    :return dict: requests sent & connections opened, in total and per remote host
+    """
+    with _session_lock:
+        if _session_pid != os.getpid():
+            return {"requests": 0, "connections_opened": 0, "hosts": {}}
+        session = _session
+        requests_sent = _requests_sent
+
+    hosts = {}
+    for adapter in set(session.adapters.values()):
+        # UnixAdapter keeps its own pools, one per URL of a socket
+        if isinstance(adapter, requests_unixsocket.UnixAdapter):
+            pools = adapter.pools
+        else:
+            pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            if isinstance(adapter, requests_unixsocket.UnixAdapter):
+                name = remote_host(pool.socket_path)
+            else:
+                name = "{}:{}".format(pool.host, pool.port)
+            counts = hosts.setdefault(name, {"requests": 0, "connections_opened": 0})
+            counts["requests"] += pool.num_requests
+            counts["connections_opened"] += pool.num_connections
+
+    return {
+        "requests": requests_sent,
+        "connections_opened": sum(h["connections_opened"] for h in hosts.values()),
+        "hosts": hosts,
+    }
+
+
+def get_breaker_stats() -> dict:
+    """
+    Return state & transitions of the circuit breakers of the worker
+    :return dict: stats per remote host
+    """
+    with _session_lock:
+        if _session_pid != os.getpid():
+            return {}
+        breakers = dict(_breakers)
+
+    return {host: breaker.stats() for host, breaker in breakers.items()}
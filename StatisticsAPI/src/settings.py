@@ -0,0 +1,416 @@
+"""
+This module loads the configuration of StatisticsAPI once, into an immutable object.
+Values of config/params.ini are merged with ENV variables (DATABASE_*, DEVICEREGISTRATIONAPI_*,
+STATISTICS_USER_KEY), ENV variables taking precedence, and derived values (e.g., URL of
+DeviceRegistrationAPI, DB connection DSN) are prebuilt.
+
+* Settings --> immutable configuration of the application
+* get_settings() --> returns the current settings, without any I/O
+* reload_settings() --> reloads the settings of the process from disk and ENV
+* request_reload() --> asks every worker to reload its settings, e.g. on SIGUSR2 or an admin call
+* check_generation() --> reloads the settings of the worker when a reload was requested
+* on_reload() --> registers a function rebuilding an object from the settings once they are reloaded
+* instrument() --> checks the generation of the settings before every request of a Flask application
+
+A reload is requested by replacing the generation file (GENERATION_FILE, shared by the workers of
+a host): each worker compares it with the one of its settings once per request (a stat), and
+reloads its settings when it changed.
+
+@author: MMB
+"""
+
+import configparser
+import os
+import threading
+import time
+from dataclasses import dataclass
+from urllib.parse import quote
+
+from psycopg2.extensions import make_dsn
+
+CONFIG_FILE = "config/params.ini"
+# replaced to ask every worker to reload its settings
+GENERATION_FILE = os.getenv(
+    "SETTINGS_GENERATION_FILE", "/tmp/statisticsapi-settings.generation"
+)
+
+
+@dataclass(frozen=True)
+class Settings:
+    """Configuration of StatisticsAPI"""
+
+    # Token to get access to this api, this is equal to userKey
+    user_key: str
+
+    # DEVICEREGISTRATIONAPI section & ENV
+    deviceregistration_host: str
+    deviceregistration_port: str
+    deviceregistration_socket: str
+    deviceregistration_url: str
+    deviceregistration_batch_url: str
+
+    # HTTP_CLIENT section
+    http_pool_connections: int
+    http_pool_maxsize: int
+    http_keep_alive: bool
+    http_connect_timeout: float
+    http_read_timeout: float
+    http_retries: int
+    http_retry_backoff: float
+    http_retry_backoff_max: float
+    http_deadline: float
+
+    # CIRCUIT_BREAKER section
+    circuit_breaker_enabled: bool
+    circuit_breaker_window: int
+    circuit_breaker_min_calls: int
+    circuit_breaker_failure_ratio: float
+    circuit_breaker_open_seconds: float
+    circuit_breaker_half_open_max_calls: int
+
+    # CACHE section
+    cache_max_size: int
+    cache_ttl: float
+    cache_stale_ttl: float
+
+    # STATISTICS section
+    statistics_max_series_points: int
+    statistics_default_range_days: int
+    statistics_bulk_max_types: int
+    statistics_bulk_page_size: int
+    statistics_cache_control: str
+
+    # SNAPSHOT section
+    snapshot_enabled: bool
+    snapshot_path: str
+    snapshot_slots: int
+    snapshot_max_age: float
+    snapshot_resync_interval: float
+
+    # SINGLE_FLIGHT section
+    single_flight_enabled: bool
+    single_flight_cross_worker: bool
+    single_flight_dir: str
+    single_flight_wait_timeout: float
+
+    # EXPORT section
+    export_batch_size: int
+
+    # PROFILING section
+    profiling_enabled: bool
+    profiling_sample_rate: float
+    profiling_header: bool
+    profiling_dir: str
+    profiling_slow_ms: float
+    profiling_max_files: int
+
+    # ADMISSION section
+    admission_enabled: bool
+    admission_path: str
+    admission_slots: int
+    admission_health_routes: tuple
+    admission_max_in_flight: int
+    admission_max_reads: int
+    admission_route_limits: tuple
+    admission_read_max_queue_ms: float
+    admission_write_max_queue_ms: float
+    admission_pool_max_waiting: int
+    admission_pool_timeout_seconds: float
+    admission_pool_exempt_routes: tuple
+    admission_retry_after: str
+
+    # ASYNC section
+    async_max_concurrency: int
+    async_wsgi_threads: int
+
+    # DATABASE section & ENV
+    db_name: str
+    db_table: str
+    db_user: str
+    db_password: str
+    db_host: str
+    db_port: str
+    db_dsn: str
+    db_connect_timeout: int
+    db_pool_min_size: int
+    db_pool_max_size: int
+    db_pool_max_lifetime: float
+    db_pool_health_check_interval: float
+    db_pool_checkout_timeout: float
+
+    # REPLICAS section & ENV
+    db_read_hosts: tuple
+    replica_max_lag: float
+    replica_check_interval: float
+    replica_fallback_to_primary: bool
+
+
+def load_settings(config_file=CONFIG_FILE) -> Settings:
+    """
+    Read the configuration file and ENV variables
+    :param str config_file: path of the configuration file
+    :return: Settings
+    """
+    config = configparser.ConfigParser()
+    config.read(config_file)
+    conf_deviceregistration = config["DEVICEREGISTRATIONAPI"]
+    conf_client = config["HTTP_CLIENT"]
+    conf_breaker = config["CIRCUIT_BREAKER"]
+    conf_cache = config["CACHE"]
+    conf_statistics = config["STATISTICS"]
+    conf_snapshot = config["SNAPSHOT"]
+    conf_single_flight = config["SINGLE_FLIGHT"]
+    conf_export = config["EXPORT"]
+    conf_profiling = config["PROFILING"]
+    conf_admission = config["ADMISSION"]
+    conf_async = config["ASYNC"]
+    conf_db = config["DATABASE"]
+    conf_replicas = config["REPLICAS"]
+
+    deviceregistration_host = os.getenv(
+        "DEVICEREGISTRATIONAPI_HOST", conf_deviceregistration.get("HOST")
+    )
+    deviceregistration_port = os.getenv(
+        "DEVICEREGISTRATIONAPI_PORT", conf_deviceregistration.get("PORT")
+    )
+    deviceregistration_socket = os.getenv(
+        "DEVICEREGISTRATIONAPI_SOCKET", conf_deviceregistration.get("SOCKET", "")
+    )
+    if deviceregistration_socket:
+        # DeviceRegistrationAPI shares the host (or pod): requests go through its unix socket,
+        # the netloc of an http+unix URL being the percent-encoded path of the socket
+        deviceregistration_base_url = "http+unix://{}".format(
+            quote(deviceregistration_socket, safe="")
+        )
+    else:
+        deviceregistration_base_url = "http://{}:{}".format(
+            deviceregistration_host, deviceregistration_port
+        )
+
+    db_name = os.getenv("DATABASE_NAME", conf_db.get("NAME"))
+    db_user = os.getenv("DATABASE_USER", conf_db.get("USER"))
+    db_password = os.getenv("DATABASE_PASSWORD", conf_db.get("PASSWORD"))
+    db_host = os.getenv("DATABASE_HOST", conf_db.get("HOST"))
+    db_port = os.getenv("DATABASE_PORT", conf_db.get("PORT"))
+    db_connect_timeout = conf_db.getint("CONNECT_TIMEOUT", 5)
+
+    # host:port of every replica separated by commas, the port of the primary by default
+    db_read_hosts = tuple(
+        (host, port or db_port)
+        for host, _, port in (
+            endpoint.strip().partition(":")
+            for endpoint in os.getenv(
+                "DATABASE_READ_HOSTS", conf_replicas.get("READ_HOSTS", "")
+            ).split(",")
+        )
+        if host
+    )
+
+    return Settings(
+        user_key=os.getenv("STATISTICS_USER_KEY"),
+        deviceregistration_host=deviceregistration_host,
+        deviceregistration_port=deviceregistration_port,
+        deviceregistration_socket=deviceregistration_socket or None,
+        deviceregistration_url=deviceregistration_base_url
+        + conf_deviceregistration.get("ENDPOINT_STORE_EVENT"),
+        deviceregistration_batch_url=deviceregistration_base_url
+        + conf_deviceregistration.get("ENDPOINT_STORE_EVENT_BATCH"),
+        http_pool_connections=conf_client.getint("POOL_CONNECTIONS", 4),
+        http_pool_maxsize=conf_client.getint("POOL_MAXSIZE", 10),
+        http_keep_alive=conf_client.getboolean("KEEP_ALIVE", True),
+        http_connect_timeout=conf_client.getfloat("CONNECT_TIMEOUT", 2),
+        http_read_timeout=conf_client.getfloat("READ_TIMEOUT", 10),
+        http_retries=conf_client.getint("RETRIES", 2),
+        http_retry_backoff=conf_client.getfloat("RETRY_BACKOFF", 0.1),
+        http_retry_backoff_max=conf_client.getfloat("RETRY_BACKOFF_MAX", 1),
+        http_deadline=conf_client.getfloat("DEADLINE", 5),
+        circuit_breaker_enabled=conf_breaker.getboolean("ENABLED", True),
+        circuit_breaker_window=conf_breaker.getint("WINDOW", 20),
+        circuit_breaker_min_calls=conf_breaker.getint("MIN_CALLS", 10),
+        circuit_breaker_failure_ratio=conf_breaker.getfloat("FAILURE_RATIO", 0.5),
+        circuit_breaker_open_seconds=conf_breaker.getfloat("OPEN_SECONDS", 5),
+        circuit_breaker_half_open_max_calls=conf_breaker.getint(
+            "HALF_OPEN_MAX_CALLS", 2
+        ),
+        cache_max_size=conf_cache.getint("MAX_SIZE", 1024),
+        cache_ttl=conf_cache.getfloat("TTL", 5),
+        cache_stale_ttl=conf_cache.getfloat("STALE_TTL", 30),
+        statistics_max_series_points=conf_statistics.getint("MAX_SERIES_POINTS", 2000),
+        statistics_default_range_days=conf_statistics.getint("DEFAULT_RANGE_DAYS", 7),
+        statistics_bulk_max_types=conf_statistics.getint("BULK_MAX_TYPES", 1000),
+        statistics_bulk_page_size=conf_statistics.getint("BULK_PAGE_SIZE", 500),
+        statistics_cache_control=conf_statistics.get(
+            "CACHE_CONTROL", "public, max-age=1"
+        ),
+        snapshot_enabled=conf_snapshot.getboolean("ENABLED", False),
+        snapshot_path=conf_snapshot.get("PATH", "/dev/shm/statisticsapi-counts"),
+        snapshot_slots=conf_snapshot.getint("SLOTS", 4096),
+        snapshot_max_age=conf_snapshot.getfloat("MAX_AGE", 5),
+        snapshot_resync_interval=conf_snapshot.getfloat("RESYNC_INTERVAL", 60),
+        single_flight_enabled=conf_single_flight.getboolean("ENABLED", True),
+        single_flight_cross_worker=conf_single_flight.getboolean("CROSS_WORKER", False),
+        single_flight_dir=conf_single_flight.get(
+            "DIR", "/dev/shm/statisticsapi-single-flight"
+        ),
+        single_flight_wait_timeout=conf_single_flight.getfloat("WAIT_TIMEOUT", 5),
+        export_batch_size=conf_export.getint("BATCH_SIZE", 1000),
+        profiling_enabled=conf_profiling.getboolean("ENABLED", False),
+        profiling_sample_rate=conf_profiling.getfloat("SAMPLE_RATE", 0.01),
+        profiling_header=conf_profiling.getboolean("HEADER", True),
+        profiling_dir=conf_profiling.get("DIR", "/tmp/statisticsapi-profiles"),
+        profiling_slow_ms=conf_profiling.getfloat("SLOW_MS", 100),
+        profiling_max_files=conf_profiling.getint("MAX_FILES", 200),
+        admission_enabled=conf_admission.getboolean("ENABLED", False),
+        admission_path=conf_admission.get("PATH", "/dev/shm/statisticsapi-in-flight"),
+        admission_slots=conf_admission.getint("SLOTS", 64),
+        admission_health_routes=tuple(
+            route.strip()
+            for route in conf_admission.get(
+                "HEALTH_ROUTES", "/api/status, /metrics"
+            ).split(",")
+            if route.strip()
+        ),
+        admission_max_in_flight=conf_admission.getint("MAX_IN_FLIGHT", 0),
+        admission_max_reads=conf_admission.getint("MAX_READS", 0),
+        # rule=limit separated by commas, e.g. /Log/auth/export=2
+        admission_route_limits=tuple(
+            (route.strip(), int(limit))
+            for route, _, limit in (
+                item.rpartition("=")
+                for item in conf_admission.get("ROUTE_LIMITS", "").split(",")
+            )
+            if route.strip()
+        ),
+        admission_read_max_queue_ms=conf_admission.getfloat("READ_MAX_QUEUE_MS", 0),
+        admission_write_max_queue_ms=conf_admission.getfloat("WRITE_MAX_QUEUE_MS", 0),
+        admission_pool_max_waiting=conf_admission.getint("POOL_MAX_WAITING", 0),
+        admission_pool_timeout_seconds=conf_admission.getfloat("POOL_TIMEOUT_SECONDS", 0),
+        admission_pool_exempt_routes=tuple(
+            route.strip()
+            for route in conf_admission.get("POOL_EXEMPT_ROUTES", "/Log/auth, /Log/auth/batch").split(",")
+            if route.strip()
+        ),
+        admission_retry_after=conf_admission.get("RETRY_AFTER", "1"),
+        async_max_concurrency=conf_async.getint("MAX_CONCURRENCY", 1000),
+        async_wsgi_threads=conf_async.getint("WSGI_THREADS", 10),
+        db_name=db_name,
+        db_table=conf_db.get("TABLE", "devices"),
+        db_user=db_user,
+        db_password=db_password,
+        db_host=db_host,
+        db_port=db_port,
+        db_dsn=make_dsn(
+            dbname=db_name,
+            user=db_user,
+            password=db_password,
+            host=db_host,
+            port=db_port,
+            connect_timeout=db_connect_timeout,
+        ),
+        db_connect_timeout=db_connect_timeout,
+        db_pool_min_size=conf_db.getint("POOL_MIN_SIZE", 1),
+        db_pool_max_size=conf_db.getint("POOL_MAX_SIZE", 5),
+        db_pool_max_lifetime=conf_db.getfloat("POOL_MAX_LIFETIME", 3600),
+        db_pool_health_check_interval=conf_db.getfloat(
+            "POOL_HEALTH_CHECK_INTERVAL", 30
+        ),
+        db_pool_checkout_timeout=conf_db.getfloat("POOL_CHECKOUT_TIMEOUT", 5),
+        db_read_hosts=db_read_hosts,
+        replica_max_lag=conf_replicas.getfloat("MAX_LAG", 10),
+        replica_check_interval=conf_replicas.getfloat("CHECK_INTERVAL", 5),
+        replica_fallback_to_primary=conf_replicas.getboolean(
+            "FALLBACK_TO_PRIMARY", True
+        ),
+    )
+
+
+def _read_generation() -> tuple:
+    """Identity of the generation file, None when no reload was ever requested"""
+    try:
+        stat = os.stat(GENERATION_FILE)
+    except FileNotFoundError:
+        return None
+    # the file is replaced, not written: a new inode even within the resolution of mtime
+    return (stat.st_ino, stat.st_mtime_ns)
+
+
+_settings = load_settings()
+_generation = _read_generation()
+# reentrant: a reload may be requested by a signal handler while the thread reloads
+_reload_lock = threading.RLock()
+_reload_callbacks = []
+
+
+def get_settings() -> Settings:
+    """Return the current settings of the process"""
+    return _settings
+
+
+def reload_settings() -> Settings:
+    """
+    Reload the settings from the configuration file and ENV variables of the process, then call
+    the functions registered with on_reload(). Other objects built from the settings
+    (e.g., sessions, pools) keep their sizing until the worker restarts.
+    :return: the new Settings
+    """
+    global _settings
+
+    # the reference is swapped at once, requests being served keep a consistent object
+    _settings = load_settings()
+    for callback in _reload_callbacks:
+        try:
+            callback(_settings)
+        except Exception as err:
+            print("[Exception] unable to apply the reloaded settings:", err)
+    return _settings
+
+
+def on_reload(callback):
+    """
+    Register a function called with the new settings after every reload of the process
+    :param callable callback: function of the Settings, e.g. rebuilding a cache
+    """
+    _reload_callbacks.append(callback)
+
+
+def request_reload():
+    """Ask every worker of the host to reload its settings, at its next request"""
+    tmp_path = "{}.{}.tmp".format(GENERATION_FILE, os.getpid())
+    with open(tmp_path, "w") as generation_file:
+        generation_file.write(str(time.time_ns()))
+    os.replace(tmp_path, GENERATION_FILE)
+
+
+def check_generation() -> bool:
+    """
+    Reload the settings of the worker when a reload was requested since they were loaded
+    :return bool: True if the settings were reloaded
+    """
+    global _generation
+
+    generation = _read_generation()
+    if generation == _generation:
+        return False
+
+    with _reload_lock:
+        if generation == _generation:
+            return False
+        # a reload requested meanwhile changes the generation again, it is not missed
+        _generation = generation
+        reload_settings()
+
+    return True
+
+
+def instrument(app):
+    """
+    Reload the settings of the worker before a request, when a reload was requested
+    :param Flask app: application whose requests check the generation of the settings
+    """
+    wsgi_app = app.wsgi_app
+
+    def reloading_wsgi_app(environ, start_response):
+        check_generation()
+        return wsgi_app(environ, start_response)
+
+    app.wsgi_app = reloading_wsgi_app
@@ -0,0 +1,197 @@
+"""
+This module coalesces identical reads running at the same time (e.g., the count of a deviceType
+requested by a fleet of dashboards when its cache entry expires), so that one query reaches the DB
+and every caller shares its result.
+
+Within a worker, the first caller of a key (the leader) runs the read, and the callers of the same
+key arriving meanwhile (followers) wait for its result, or its exception. A result of None is a
+failed read: it is never shared, every follower runs its own read.
+
+With a directory, the leaders of the workers are coalesced too. A key is hashed to one of a fixed
+number of stripes: a flock on <directory>/<stripe>.lock elects one of the leaders, which writes its
+result to the slot of the stripe in <directory>/results, a file of fixed size memory-mapped by
+every worker (e.g., in /dev/shm). The others wait for the lock and share the result if it is the
+one of their key and was written after they started, instead of running the read again. Whatever
+the keys received, the directory holds the same files; keys of the same stripe wait for each other,
+and a result larger than a slot isn't shared.
+
+* SingleFlight --> runs one call per key at a time, shared by the concurrent callers
+
+@author: MMB
+"""
+
+import fcntl
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+# role of a caller, returned by SingleFlight.do()
+LEADER = "leader"
+FOLLOWER = "follower"
+SHARED = "shared"
+
+# slot of a stripe: time the result was read, SHA-1 of its key & length of its JSON, then the JSON
+RESULT = struct.Struct("<d20sI")
+RESULTS_FILE = "results"
+
+
+class _Call:
+    """A call in flight in the worker, and its outcome"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Coalesces the concurrent calls of a key, within the worker and optionally across workers"""
+
+    def __init__(self, directory=None, wait_timeout=5.0, stripes=64, value_size=32768):
+        """
+        :param str directory: directory of the lock & result files shared by the workers,
+        None to only coalesce the calls of the worker
+        :param float wait_timeout: seconds a caller waits for the call of another one before
+        running its own
+        :param int stripes: number of locks & result slots shared by the workers
+        :param int value_size: maximum size of a result shared by the workers, in JSON
+        """
+        self.directory = directory
+        self.wait_timeout = wait_timeout
+        self.stripes = stripes
+        self.value_size = value_size
+        self.stride = RESULT.size + value_size
+
+        self._results = None
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            self._results = self._map_results()
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {LEADER: 0, FOLLOWER: 0, SHARED: 0, "timeouts": 0, "failures": 0}
+
+    def _map_results(self) -> mmap.mmap:
+        """Map the result slots of the stripes, shared by the workers"""
+        size = self.stripes * self.stride
+        fd = os.open(os.path.join(self.directory, RESULTS_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            if os.fstat(fd).st_size != size:
+                # left by other settings: the results of every stripe are dropped
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            results = mmap.mmap(fd, size)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            # the mapping keeps the file
+            os.close(fd)
+
+        return results
+
+    def do(self, key, fn) -> (object, str):
+        """
+        Return the result of fn(), shared with the concurrent callers of the same key
+        :param str key: identity of the call, e.g. "count:IOS"
+        :param callable fn: function without argument returning None when it fails, its result
+        must be JSON serializable when calls are coalesced across workers
+        :return tuple: result & role of the caller (LEADER, FOLLOWER or SHARED)
+        :raise Exception: the exception raised by fn, for the leader & its followers
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+
+        if not leader:
+            if call.done.wait(self.wait_timeout):
+                if call.error is not None:
+                    self._count(FOLLOWER)
+                    raise call.error
+                if call.value is not None:
+                    self._count(FOLLOWER)
+                    return (call.value, FOLLOWER)
+
+                # the read of the leader failed, its result isn't shared
+                self._count("failures")
+                return (fn(), LEADER)
+
+            # the leader is stuck, e.g. waiting for a connection of the pool
+            self._count("timeouts")
+            return (fn(), LEADER)
+
+        try:
+            if self.directory is None:
+                call.value, role = (fn(), LEADER)
+            else:
+                call.value, role = self._do_across_workers(key, fn)
+            self._count(role)
+            return (call.value, role)
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _do_across_workers(self, key, fn) -> (object, str):
+        """Run fn() once across the workers, or share the result written by another worker"""
+        start = time.time()
+        digest = hashlib.sha1(key.encode()).digest()
+        stripe = int.from_bytes(digest[:4], "little") % self.stripes
+        offset = stripe * self.stride
+
+        lock_fd = os.open(
+            os.path.join(self.directory, "{}.lock".format(stripe)),
+            os.O_RDWR | os.O_CREAT,
+            0o644,
+        )
+        try:
+            deadline = time.monotonic() + self.wait_timeout
+            while True:
+                try:
+                    fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    if time.monotonic() >= deadline:
+                        self._count("timeouts")
+                        return (fn(), LEADER)
+                    time.sleep(0.005)
+
+            # a result of the key written after this call started is as fresh as a read of this caller
+            at, owner, length = RESULT.unpack_from(self._results, offset)
+            if owner == digest and at >= start and 0 < length <= self.value_size:
+                data = self._results[offset + RESULT.size : offset + RESULT.size + length]
+                return (json.loads(data), SHARED)
+
+            value = fn()
+            if value is not None:
+                data = json.dumps(value).encode()
+                if len(data) <= self.value_size:
+                    # written under the lock of the stripe, read under it too
+                    self._results[offset + RESULT.size : offset + RESULT.size + len(data)] = data
+                    RESULT.pack_into(self._results, offset, time.time(), digest, len(data))
+
+            return (value, LEADER)
+        finally:
+            # closing the file releases the lock
+            os.close(lock_fd)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def stats(self) -> dict:
+        """Return the calls run (leader) & shared (follower, shared across workers) by the worker"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(
+                {"in_flight": len(self._calls), "cross_worker": self.directory is not None}
+            )
+        return stats
@@ -0,0 +1,548 @@
+"""
+This module is the load/benchmark harness of DeviceRegistrationAPI and StatisticsAPI.
+A scenario of benchmark/scenarios.ini seeds the devices table, then drives a mixed workload of
+/Device/register, /Log/auth and /Log/auth/statistics/<deviceType> at a fixed rate (open loop:
+requests are sent on schedule whatever the latency of the previous ones, and latency is measured
+from the scheduled time, so a slow server cannot hide its queueing delay).
+
+* start_services() --> start both applications under the Flask dev server or uWSGI
+* seed_database() --> fill the devices table with a given number of rows & device types
+* run_workload() --> send the mixed workload at a fixed rate and collect latencies
+* sample_db_connections() --> count sessions of the database by state, while the workload runs
+* build_report() --> machine-readable report: throughput, p50/p95/p99 latency, DB connections
+* compare_reports() --> compare a report with a stored baseline, exits 1 on regression
+
+Usage, from the root of the repository:
+    python benchmark/run.py run --scenario smoke --start dev --output report.json
+    python benchmark/run.py compare report.json benchmark/baselines/smoke.json
+
+@author: MMB
+"""
+import argparse
+import configparser
+import datetime
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import requests
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS_FILE = os.path.join(ROOT_DIR, "benchmark", "scenarios.ini")
+DEVICE_TYPE_PREFIX = "bench_type_"
+ENDPOINTS = ("register", "auth", "statistics")
+
+_local = threading.local()
+
+
+def load_scenario(name, scenarios_file=SCENARIOS_FILE) -> dict:
+    """
+    Read a scenario of the scenarios file, ENV variables DATABASE_* taking precedence
+    :param str name: section of the scenarios file
+    :param str scenarios_file: path of the scenarios file
+    :return dict: parameters of the scenario
+    """
+    config = configparser.ConfigParser()
+    config.read(scenarios_file)
+    if name not in config:
+        raise KeyError("Unknown scenario [{}] in {}".format(name, scenarios_file))
+    conf = config[name]
+
+    return {
+        "name": name,
+        "deviceregistration_url": conf.get("DEVICEREGISTRATION_URL"),
+        "statistics_url": conf.get("STATISTICS_URL"),
+        "user_key": os.getenv("BENCHMARK_USER_KEY", conf.get("USER_KEY")),
+        "seed_rows": conf.getint("SEED_ROWS"),
+        "seed_types": conf.getint("SEED_TYPES"),
+        "seed_days": conf.getint("SEED_DAYS"),
+        "rate": conf.getfloat("RATE"),
+        "duration": conf.getfloat("DURATION"),
+        "warmup": conf.getfloat("WARMUP"),
+        "concurrency": conf.getint("CONCURRENCY"),
+        "mix": {
+            "register": conf.getint("MIX_REGISTER"),
+            "auth": conf.getint("MIX_AUTH"),
+            "statistics": conf.getint("MIX_STATISTICS"),
+        },
+        "db_sample_interval": conf.getfloat("DB_SAMPLE_INTERVAL"),
+        "db_name": os.getenv("DATABASE_NAME", conf.get("DATABASE_NAME")),
+        "db_user": os.getenv("DATABASE_USER", conf.get("DATABASE_USER")),
+        "db_password": os.getenv("DATABASE_PASSWORD", conf.get("DATABASE_PASSWORD")),
+        "db_host": os.getenv("DATABASE_HOST", conf.get("DATABASE_HOST")),
+        "db_port": os.getenv("DATABASE_PORT", conf.get("DATABASE_PORT")),
+    }
+
+
+def _connect(scenario):
+    return psycopg2.connect(
+        database=scenario["db_name"],
+        user=scenario["db_user"],
+        password=scenario["db_password"],
+        host=scenario["db_host"],
+        port=scenario["db_port"],
+    )
+
+
+def _port(url) -> str:
+    return url.rsplit(":", 1)[1].split("/", 1)[0]
+
+
+def start_services(scenario, mode) -> list:
+    """
+    Start both applications on the ports of the scenario URLs
+    :param dict scenario: parameters of the scenario
+    :param str mode: dev (Flask dev server, threaded) or uwsgi (HTTP router of uWSGI)
+    :return list: started processes, to be terminated by stop_services()
+    """
+    env = dict(
+        os.environ,
+        DATABASE_NAME=scenario["db_name"],
+        DATABASE_USER=scenario["db_user"],
+        DATABASE_PASSWORD=scenario["db_password"],
+        DATABASE_HOST=scenario["db_host"],
+        DATABASE_PORT=str(scenario["db_port"]),
+        DEVICEREGISTRATION_USER_KEY=scenario["user_key"],
+        STATISTICS_USER_KEY=scenario["user_key"],
+        DEVICEREGISTRATIONAPI_HOST="127.0.0.1",
+        DEVICEREGISTRATIONAPI_PORT=_port(scenario["deviceregistration_url"]),
+    )
+
+    services = [
+        ("DeviceRegistrationAPI", _port(scenario["deviceregistration_url"])),
+        ("StatisticsAPI", _port(scenario["statistics_url"])),
+    ]
+    processes = []
+    for service, port in services:
+        if mode == "uwsgi":
+            command = [
+                "uwsgi",
+                "--http",
+                "127.0.0.1:{}".format(port),
+                "--module",
+                "src.wsgi:app",
+                "--processes",
+                str(os.cpu_count() or 1),
+                "--enable-threads",
+                "--die-on-term",
+                "--disable-logging",
+            ]
+        else:
+            command = [
+                sys.executable,
+                "-m",
+                "flask",
+                "--app",
+                "src.wsgi",
+                "run",
+                "--port",
+                port,
+            ]
+        processes.append(
+            subprocess.Popen(
+                command,
+                cwd=os.path.join(ROOT_DIR, service),
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        )
+
+    return processes
+
+
+def stop_services(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def wait_for_services(scenario, timeout=60):
+    """Wait until /api/status of both applications answers"""
+    deadline = time.monotonic() + timeout
+    for url in (scenario["deviceregistration_url"], scenario["statistics_url"]):
+        while True:
+            try:
+                if requests.get(url + "/api/status", timeout=1).status_code == 200:
+                    break
+            except requests.exceptions.RequestException:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError("{} is not available after {}s".format(url, timeout))
+            time.sleep(0.5)
+
+
+def seed_database(scenario, reset=True):
+    """
+    Fill the devices table with SEED_ROWS rows spread over SEED_TYPES device types and SEED_DAYS days.
+    The table and its rollups are created by DeviceRegistrationAPI when it starts.
+    :param dict scenario: parameters of the scenario
+    :param bool reset: empty the table and its rollups first, for a reproducible run
+    """
+    conn = _connect(scenario)
+    try:
+        with conn.cursor() as cursor:
+            if reset:
+                cursor.execute(
+                    "TRUNCATE devices, device_type_counts, device_type_hourly_counts RESTART IDENTITY;"
+                )
+            # one statement, thus the rollup triggers run once for all the rows
+            cursor.execute(
+                """
+                INSERT INTO devices (device_type, date_added)
+                SELECT %(prefix)s || lpad((g %% %(types)s)::text, 4, '0'),
+                       now() - random() * make_interval(days => %(days)s)
+                FROM generate_series(1, %(rows)s) AS g;
+                """,
+                {
+                    "prefix": DEVICE_TYPE_PREFIX,
+                    "types": scenario["seed_types"],
+                    "days": scenario["seed_days"],
+                    "rows": scenario["seed_rows"],
+                },
+            )
+        conn.commit()
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE devices;")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _session() -> requests.Session:
+    """Return the keep-alive session of the current load thread"""
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
+
+
+def _request(scenario, endpoint, device_type):
+    headers = {"userKey": scenario["user_key"], "Content-Type": "application/json"}
+    body = json.dumps({"deviceType": device_type})
+
+    if endpoint == "register":
+        url = scenario["deviceregistration_url"] + "/Device/register"
+        return _session().post(url, data=body, headers=headers, timeout=30)
+    if endpoint == "auth":
+        url = scenario["statistics_url"] + "/Log/auth"
+        return _session().post(url, data=body, headers=headers, timeout=30)
+
+    url = scenario["statistics_url"] + "/Log/auth/statistics/" + device_type
+    return _session().get(url, headers=headers, timeout=30)
+
+
+def _send(scenario, endpoint, device_type, scheduled, results, results_lock):
+    try:
+        status = _request(scenario, endpoint, device_type).status_code
+    except requests.exceptions.RequestException:
+        status = 0
+    # latency from the scheduled time includes the wait for a free load thread
+    latency = time.monotonic() - scheduled
+
+    with results_lock:
+        results.append((endpoint, status, latency, scheduled))
+
+
+def run_workload(scenario, duration, seed=0) -> list:
+    """
+    Send the mixed workload of the scenario at its fixed rate
+    :param dict scenario: parameters of the scenario
+    :param float duration: seconds of load
+    :param int seed: seed of the random choice of endpoints and device types
+    :return list: (endpoint, status code, latency in seconds, scheduled time) per request
+    """
+    rng = random.Random(seed)
+    mix = scenario["mix"]
+    endpoints = [name for name in ENDPOINTS if mix[name] > 0]
+    weights = [mix[name] for name in endpoints]
+    device_types = [
+        "{}{:04d}".format(DEVICE_TYPE_PREFIX, i) for i in range(scenario["seed_types"])
+    ]
+
+    results = []
+    results_lock = threading.Lock()
+    interval = 1.0 / scenario["rate"]
+    total = int(duration * scenario["rate"])
+
+    with ThreadPoolExecutor(max_workers=scenario["concurrency"]) as executor:
+        start = time.monotonic()
+        for i in range(total):
+            scheduled = start + i * interval
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(
+                _send,
+                scenario,
+                rng.choices(endpoints, weights)[0],
+                rng.choice(device_types),
+                scheduled,
+                results,
+                results_lock,
+            )
+
+    return results
+
+
+def sample_db_connections(scenario, interval, stop_event, samples):
+    """
+    Count sessions of the benchmarked database by state, until stop_event is set
+    :param dict scenario: parameters of the scenario
+    :param float interval: seconds between two samples
+    :param threading.Event stop_event: set at the end of the workload
+    :param list samples: receives one dict {state: count} per sample
+    """
+    conn = _connect(scenario)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            while not stop_event.is_set():
+                cursor.execute(
+                    """
+                    SELECT coalesce(state, 'unknown'), count(*)
+                    FROM pg_stat_activity
+                    WHERE datname = %s AND pid <> pg_backend_pid()
+                    GROUP BY 1;
+                    """,
+                    (scenario["db_name"],),
+                )
+                samples.append(dict(cursor.fetchall()))
+                stop_event.wait(interval)
+    finally:
+        conn.close()
+
+
+def percentile(sorted_values, pct) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def _summary(results, duration) -> dict:
+    latencies = sorted(latency for _, _, latency, _ in results)
+    errors = sum(1 for _, status, _, _ in results if status != 200)
+    statuses = {}
+    for _, status, _, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "error_rate": round(errors / len(results), 4) if results else 0.0,
+        "status_codes": statuses,
+        "throughput": round((len(results) - errors) / duration, 2),
+        "latency_ms": {
+            "mean": round(1000 * sum(latencies) / len(latencies), 2)
+            if latencies
+            else 0.0,
+            "p50": round(1000 * percentile(latencies, 50), 2),
+            "p95": round(1000 * percentile(latencies, 95), 2),
+            "p99": round(1000 * percentile(latencies, 99), 2),
+            "max": round(1000 * latencies[-1], 2) if latencies else 0.0,
+        },
+    }
+
+
+def build_report(scenario, results, samples, duration) -> dict:
+    """
+    Build the machine-readable report of a run
+    :param dict scenario: parameters of the scenario
+    :param list results: requests measured, warm-up excluded
+    :param list samples: sessions of the database by state
+    :param float duration: seconds of measured load
+    :return dict: report
+    """
+    totals = [sum(sample.values()) for sample in samples]
+    states = {}
+    for sample in samples:
+        for state, count in sample.items():
+            states[state] = max(states.get(state, 0), count)
+
+    return {
+        "scenario": scenario["name"],
+        "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "parameters": {
+            key: scenario[key]
+            for key in (
+                "seed_rows",
+                "seed_types",
+                "rate",
+                "duration",
+                "warmup",
+                "concurrency",
+                "mix",
+            )
+        },
+        "total": _summary(results, duration),
+        "endpoints": {
+            name: _summary([r for r in results if r[0] == name], duration)
+            for name in ENDPOINTS
+            if scenario["mix"][name] > 0
+        },
+        "db_connections": {
+            "samples": len(samples),
+            "max": max(totals) if totals else 0,
+            "mean": round(sum(totals) / len(totals), 2) if totals else 0.0,
+            "max_by_state": states,
+        },
+    }
+
+
+def compare_reports(report, baseline, max_throughput_drop, max_latency_increase) -> list:
+    """
+    Compare a report with a baseline of the same scenario
+    :param dict report: report of the current run
+    :param dict baseline: stored report
+    :param float max_throughput_drop: tolerated drop of throughput, in percent
+    :param float max_latency_increase: tolerated increase of p95 & p99, in percent
+    :return list: regressions found, empty when none
+    """
+    regressions = []
+    sections = dict(report["endpoints"], total=report["total"])
+    base_sections = dict(baseline["endpoints"], total=baseline["total"])
+
+    for name, base in base_sections.items():
+        current = sections.get(name)
+        if current is None:
+            regressions.append("{}: missing from the report".format(name))
+            continue
+
+        if base["throughput"] > 0:
+            drop = 100.0 * (base["throughput"] - current["throughput"]) / base["throughput"]
+            if drop > max_throughput_drop:
+                regressions.append(
+                    "{}: throughput {} -> {} (-{:.1f}%)".format(
+                        name, base["throughput"], current["throughput"], drop
+                    )
+                )
+
+        for pct in ("p95", "p99"):
+            before = base["latency_ms"][pct]
+            after = current["latency_ms"][pct]
+            if before > 0 and 100.0 * (after - before) / before > max_latency_increase:
+                regressions.append(
+                    "{}: {} latency {}ms -> {}ms (+{:.1f}%)".format(
+                        name, pct, before, after, 100.0 * (after - before) / before
+                    )
+                )
+
+        if current["error_rate"] > base["error_rate"] + 0.01:
+            regressions.append(
+                "{}: error rate {} -> {}".format(
+                    name, base["error_rate"], current["error_rate"]
+                )
+            )
+
+    return regressions
+
+
+def cmd_run(args):
+    scenario = load_scenario(args.scenario)
+    processes = start_services(scenario, args.start) if args.start != "none" else []
+    try:
+        wait_for_services(scenario)
+        if not args.no_seed:
+            print("[INFO] seeding {} rows".format(scenario["seed_rows"]))
+            seed_database(scenario)
+
+        if scenario["warmup"] > 0:
+            print("[INFO] warm-up for {}s".format(scenario["warmup"]))
+            run_workload(scenario, scenario["warmup"], seed=args.seed + 1)
+
+        samples = []
+        stop_event = threading.Event()
+        sampler = threading.Thread(
+            target=sample_db_connections,
+            args=(scenario, scenario["db_sample_interval"], stop_event, samples),
+            daemon=True,
+        )
+        sampler.start()
+
+        print(
+            "[INFO] {} req/s for {}s".format(scenario["rate"], scenario["duration"])
+        )
+        results = run_workload(scenario, scenario["duration"], seed=args.seed)
+        stop_event.set()
+        sampler.join()
+    finally:
+        stop_services(processes)
+
+    report = build_report(scenario, results, samples, scenario["duration"])
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as report_file:
+            report_file.write(output + "\n")
+    print(output)
+    return 0
+
+
+def cmd_compare(args):
+    with open(args.report) as report_file:
+        report = json.load(report_file)
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+
+    if report["scenario"] != baseline["scenario"]:
+        print(
+            "[ERROR] scenario [{}] compared with a baseline of [{}]".format(
+                report["scenario"], baseline["scenario"]
+            )
+        )
+        return 2
+
+    regressions = compare_reports(
+        report, baseline, args.max_throughput_drop, args.max_latency_increase
+    )
+    for regression in regressions:
+        print("[REGRESSION]", regression)
+    if not regressions:
+        print("[INFO] no regression against {}".format(args.baseline))
+
+    return 1 if regressions else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="seed the database and run a scenario")
+    run.add_argument("--scenario", default="mixed")
+    run.add_argument(
+        "--start",
+        choices=("none", "dev", "uwsgi"),
+        default="none",
+        help="start both applications, none when already running (e.g., docker compose)",
+    )
+    run.add_argument("--no-seed", action="store_true", help="keep the current rows")
+    run.add_argument("--seed", type=int, default=0, help="seed of the random workload")
+    run.add_argument("--output", help="path of the JSON report")
+    run.set_defaults(func=cmd_run)
+
+    compare = commands.add_parser("compare", help="compare a report with a baseline")
+    compare.add_argument("report")
+    compare.add_argument("baseline")
+    compare.add_argument("--max-throughput-drop", type=float, default=10.0)
+    compare.add_argument("--max-latency-increase", type=float, default=25.0)
+    compare.set_defaults(func=cmd_compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())